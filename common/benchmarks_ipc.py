@@ -0,0 +1,295 @@
+"""
+Micro-benchmarks of the ipc transports. Run explicitly and with output capture disabled e.g.
+    python -m pytest -s benchmarks_ipc.py
+    BYODR_BENCH_MESSAGES=1000 BYODR_BENCH_HWM=10 python -m pytest -s benchmarks_ipc.py -k stream
+The latency tests send one message at a time and wait for the listener of the receiver to see it arrive so that the
+latencies are end-to-end and not queueing. Their sockets have a high water mark beyond the number of messages in flight,
+so that a lost message is a failure of the transport and not a drop at the high water mark.
+The stream tests send the messages back to back and count the sequence numbers which arrive. Their sockets use the high
+water mark of the services by default, which decides how many messages are dropped at speed. The throughput is taken over
+the time from the first send to the last arrival.
+The cpu time per message covers both sides since publisher and consumer run in this process. The sender waits on an
+event of the listener and does not spin.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from byodr.utils import timestamp
+from byodr.utils.codec import (
+    BOOL,
+    FLOAT,
+    FLOAT_ARRAY,
+    INFERENCE_STATE,
+    INT,
+    PILOT_OUTPUT,
+    STRING,
+)
+from byodr.utils.ipc import (
+    CameraThread,
+    ImagePublisher,
+    JSONPublisher,
+    JSONZmqClient,
+    LocalIPCServer,
+    json_collector,
+)
+
+_MESSAGES = int(os.environ.get("BYODR_BENCH_MESSAGES", 200))
+_HWM = int(os.environ.get("BYODR_BENCH_HWM", 20))
+_PATIENCE = float(os.environ.get("BYODR_BENCH_PATIENCE_MS", 20)) * 1e-3
+# One message is in flight at a time in the latency tests.
+_LATENCY_HWM = 100
+_PORTS = itertools.count(20000 + os.getpid() % 10000)
+
+_SAMPLES = {
+    FLOAT: 0.12,
+    INT: 1,
+    BOOL: False,
+    STRING: "driver_mode.teleop.direct",
+    FLOAT_ARRAY: [0.0] * 10,
+}
+
+
+def _schema_payload(codec):
+    # Every field of the schema as it is published.
+    _message = dict((key, _SAMPLES[kind]) for key, kind in codec.get_fields())
+    _message.update(time=timestamp())
+    return _message
+
+
+# The topics with a registered schema codec so that the binary path is the one of the services.
+_PAYLOADS = {
+    "aav/pilot/output": lambda: _schema_payload(PILOT_OUTPUT),
+    "aav/inference/state": lambda: _schema_payload(INFERENCE_STATE),
+}
+
+
+class _Arrivals(object):
+    """
+    The arrival times of the messages by key as seen by the listener of a receiver. The sender waits for a number of
+    arrivals on an event.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._awaited = 0
+        self.times = collections.OrderedDict()
+
+    def expect(self, count):
+        with self._lock:
+            self._awaited = count
+            if len(self.times) >= count:
+                self._event.set()
+            else:
+                self._event.clear()
+
+    def on_message(self, key):
+        _now = timestamp()
+        with self._lock:
+            if key not in self.times:
+                self.times[key] = _now
+            if len(self.times) >= self._awaited:
+                self._event.set()
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+def _url(tmpdir, transport, name):
+    if transport == "ipc":
+        return "ipc://" + os.path.join(str(tmpdir.realpath()), name + ".sock")
+    # A fresh port per test since the sockets of the previous test may not have been released yet.
+    return "tcp://127.0.0.1:{}".format(next(_PORTS))
+
+
+def _report(name, latencies_us, lost, cpu_seconds, duration):
+    assert latencies_us, "No messages were received."
+    latencies = np.array(latencies_us, dtype=np.float64) * 1e-3
+    n = len(latencies)
+    print(
+        "\n{:<40} n={:<6} lost={:<5} {:>10.1f} msg/s  p50={:>8.3f}ms  p99={:>8.3f}ms  cpu={:>8.1f}us/msg".format(
+            name,
+            n,
+            lost,
+            n / duration,
+            np.percentile(latencies, 50),
+            np.percentile(latencies, 99),
+            cpu_seconds * 1e6 / max(1, n + lost),
+        )
+    )
+
+
+def _report_stream(name, received, lost, cpu_seconds, duration):
+    assert received, "No messages were received."
+    print(
+        "\n{:<40} n={:<6} lost={:<5} {:>10.1f} msg/s  cpu={:>8.1f}us/msg".format(
+            name,
+            received,
+            lost,
+            received / duration,
+            cpu_seconds * 1e6 / (received + lost),
+        )
+    )
+
+
+def _json_collector(tmpdir, transport, topic, codec, hwm, event):
+    url = _url(tmpdir, transport, "json_" + topic.split("/")[1])
+    publisher = JSONPublisher(url=url, topic=topic, hwm=hwm, binary=(codec == "binary"))
+    collector = json_collector(
+        url=url, topic=topic.encode("utf-8"), event=event, hwm=hwm
+    )
+    arrivals = _Arrivals()
+    collector.add_listener(lambda m: arrivals.on_message(m.get("seq")))
+    return publisher, collector, arrivals
+
+
+@pytest.mark.parametrize("transport", ["ipc", "tcp"])
+@pytest.mark.parametrize("codec", ["json", "binary"])
+@pytest.mark.parametrize("topic", sorted(_PAYLOADS.keys()))
+def test_json_publisher_collector(tmpdir, transport, codec, topic):
+    event = multiprocessing.Event()
+    publisher, collector, arrivals = _json_collector(
+        tmpdir, transport, topic, codec, _LATENCY_HWM, event
+    )
+    collector.start()
+    try:
+        time.sleep(0.2)
+        latencies, lost = [], 0
+        _cpu, _start = time.process_time(), time.time()
+        for i in range(_MESSAGES):
+            message = _PAYLOADS[topic]()
+            message["seq"] = i
+            arrivals.expect(len(arrivals.times) + 1)
+            _sent = timestamp()
+            publisher.publish(message)
+            if arrivals.wait(_PATIENCE) and i in arrivals.times:
+                latencies.append(arrivals.times[i] - _sent)
+            else:
+                lost += 1
+        _report(
+            "json {} {} {}".format(topic, codec, transport),
+            latencies,
+            lost,
+            time.process_time() - _cpu,
+            time.time() - _start,
+        )
+    finally:
+        event.set()
+        collector.join()
+
+
+@pytest.mark.parametrize("transport", ["ipc", "tcp"])
+@pytest.mark.parametrize("codec", ["json", "binary"])
+@pytest.mark.parametrize("topic", sorted(_PAYLOADS.keys()))
+def test_json_publisher_collector_stream(tmpdir, transport, codec, topic):
+    event = multiprocessing.Event()
+    publisher, collector, arrivals = _json_collector(
+        tmpdir, transport, topic, codec, _HWM, event
+    )
+    collector.start()
+    try:
+        time.sleep(0.2)
+        messages = []
+        for i in range(_MESSAGES):
+            messages.append(_PAYLOADS[topic]())
+            messages[-1]["seq"] = i
+        arrivals.expect(_MESSAGES)
+        _cpu, _start = time.process_time(), timestamp()
+        [publisher.publish(message) for message in messages]
+        # The messages dropped at the high water mark never arrive.
+        arrivals.wait(max(1.0, _MESSAGES * _PATIENCE))
+        _cpu = time.process_time() - _cpu
+        _received = len(arrivals.times)
+        _duration = (max(arrivals.times.values()) - _start) * 1e-6 if _received else 1.0
+        _report_stream(
+            "stream {} {} {} hwm={}".format(topic, codec, transport, _HWM),
+            _received,
+            _MESSAGES - _received,
+            _cpu,
+            _duration,
+        )
+    finally:
+        event.set()
+        collector.join()
+
+
+@pytest.mark.parametrize("transport", ["ipc", "ipc+shm", "tcp"])
+@pytest.mark.parametrize("shape", [(240, 320, 3), (480, 640, 3), (720, 1280, 3)])
+def test_image_publisher_camera(tmpdir, transport, shape):
+    event = multiprocessing.Event()
+    url = _url(tmpdir, transport.split("+")[0], "camera_{}".format(shape[1]))
+    publisher = ImagePublisher(
+        url=url,
+        topic="aav/camera/0",
+        hwm=_LATENCY_HWM,
+        shared_memory=transport.endswith("shm"),
+    )
+    camera = CameraThread(url=url, topic=b"aav/camera/0", event=event, hwm=_LATENCY_HWM)
+    # The frames are told apart by the timestamp of the publisher.
+    arrivals = _Arrivals()
+    camera.add_listener(lambda md, img: arrivals.on_message(md["time"]))
+    camera.start()
+    try:
+        time.sleep(0.2)
+        image = np.random.randint(0, 255, size=shape, dtype=np.uint8)
+        latencies, lost = [], 0
+        _cpu, _start = time.process_time(), time.time()
+        for i in range(_MESSAGES):
+            arrivals.expect(len(arrivals.times) + 1)
+            publisher.publish(image)
+            if arrivals.wait(_PATIENCE):
+                _published, _arrived = next(reversed(arrivals.times.items()))
+                latencies.append(_arrived - _published)
+            else:
+                lost += 1
+        _report(
+            "camera {}x{} {}".format(shape[1], shape[0], transport),
+            latencies,
+            lost,
+            time.process_time() - _cpu,
+            time.time() - _start,
+        )
+    finally:
+        event.set()
+        camera.join()
+
+
+@pytest.mark.parametrize("transport", ["ipc", "tcp"])
+def test_json_server_client(tmpdir, transport):
+    event = multiprocessing.Event()
+    url = _url(tmpdir, transport, "server")
+    server = LocalIPCServer("bench", url, event)
+    server.register_start(errors=[], capabilities=_PAYLOADS["aav/inference/state"]())
+    server.start()
+    client = JSONZmqClient(urls=url, hwm=_HWM, receive_timeout_ms=int(_PATIENCE * 1e3))
+    try:
+        time.sleep(0.2)
+        latencies, lost = [], 0
+        _cpu, _start = time.process_time(), time.time()
+        for i in range(_MESSAGES):
+            _sent = timestamp()
+            if "bench" in client.call(dict(request="system/service/capabilities")):
+                latencies.append(timestamp() - _sent)
+            else:
+                lost += 1
+        _report(
+            "request-reply {}".format(transport),
+            latencies,
+            lost,
+            time.process_time() - _cpu,
+            time.time() - _start,
+        )
+    finally:
+        client.quit()
+        event.set()
+        server.join()
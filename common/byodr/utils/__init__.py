@@ -4,6 +4,7 @@ import collections
 import logging
 import multiprocessing
 import signal
+import threading
 import time
 import traceback
 from abc import ABCMeta, abstractmethod
@@ -13,19 +14,180 @@ from contextlib import contextmanager
 import numpy as np
 import six
 
+from byodr.utils.metrics import Histogram
 from byodr.utils.option import hash_dict
+from byodr.utils.profiling import ProfileSession
 
 logger = logging.getLogger(__name__)
 
 
+def _monotonic_clock():
+    # Python 2 has no monotonic clock in the standard library - read the one of the system through librt instead.
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        _library = ctypes.CDLL(
+            ctypes.util.find_library("rt") or "librt.so.1", use_errno=True
+        )
+        _clock_gettime = _library.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+        def _monotonic():
+            _ts = _Timespec()
+            # Clock id 1 is CLOCK_MONOTONIC on linux.
+            _clock_gettime(1, ctypes.byref(_ts))
+            return _ts.tv_sec + _ts.tv_nsec * 1e-9
+
+        _monotonic()
+        return _monotonic
+    except (OSError, AttributeError):
+        return time.time
+
+
+_system_monotonic = _monotonic_clock()
+
+
+class SystemClock(object):
+    """
+    The wall and monotonic clocks of the host, in seconds.
+    A clock also sleeps and waits for events in its own time.
+    """
+
+    @staticmethod
+    def time():
+        return time.time()
+
+    @staticmethod
+    def monotonic():
+        return _system_monotonic()
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+    @staticmethod
+    def wait(event, seconds):
+        """
+        :return: Whether the event was set before the time ran out.
+        """
+        return event.wait(seconds)
+
+
+class ManualClock(object):
+    """
+    Virtual clock which only moves when it is advanced e.g. to step simulations faster than real time.
+    Both clocks advance together - the wall time starts at the time given and the monotonic time at zero.
+    Sleeping advances the clock at once so that loops on this clock run as fast as they can.
+    """
+
+    def __init__(self, start=None):
+        self._wall = time.time() if start is None else start
+        self._elapsed = 0.0
+
+    def time(self):
+        return self._wall + self._elapsed
+
+    def monotonic(self):
+        return self._elapsed
+
+    def advance(self, seconds):
+        self._elapsed += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, seconds):
+        if event.is_set():
+            return True
+        self.advance(seconds)
+        return event.is_set()
+
+
+class AcceleratedClock(object):
+    """
+    Virtual clock which runs the factor times faster than the system clock, from now on.
+    """
+
+    def __init__(self, factor=10.0, start=None):
+        self._factor = float(factor)
+        self._wall = time.time() if start is None else start
+        self._origin = _system_monotonic()
+
+    def monotonic(self):
+        return (_system_monotonic() - self._origin) * self._factor
+
+    def time(self):
+        return self._wall + self.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds / self._factor)
+
+    def wait(self, event, seconds):
+        return event.wait(seconds / self._factor)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock=None):
+    """
+    Replace the clock of the process, the system clock when none is given. Everything that reads the time through
+    timestamp(), monotonic_timestamp() or monotonic() follows the clock.
+    :return: The previous clock.
+    """
+    global _clock
+    _previous, _clock = _clock, (SystemClock() if clock is None else clock)
+    return _previous
+
+
+def monotonic():
+    return _clock.monotonic()
+
+
+# What the deadline scheduler does when a step overruns its period.
+# Catch up: run the missed steps back to back, up to a limit, to keep the average rate.
+# Skip: drop the missed periods and continue on the next deadline in the original grid.
+OVERRUN_CATCH_UP = "catch_up"
+OVERRUN_SKIP = "skip"
+
+
 def timestamp(value=None):
     """
     Timestamp as integer to retain precision e.g. when serializing to string.
     """
-    ts = time.time() if value is None else value
+    ts = _clock.time() if value is None else value
     return int(ts * 1e6)
 
 
+def monotonic_timestamp():
+    """
+    Timestamp of the monotonic clock in integer microseconds. Unlike the wall time it does not jump with clock adjustments
+    e.g. ntp steps, but it is only comparable between processes on the same host.
+    """
+    return int(_clock.monotonic() * 1e6)
+
+
+def message_age(message, same_host=True):
+    """
+    :param same_host: Whether the message was sent from this host, the monotonic timestamp of another host is ignored.
+    :return: The age of the message in microseconds, by its monotonic timestamp when it carries one.
+    """
+    _mono = message.get("mono") if same_host else None
+    if _mono is not None:
+        return monotonic_timestamp() - _mono
+    return timestamp() - message.get("time", 0)
+
+
 def entropy(x, eps=1e-20):
     return abs(-np.sum(x * np.log(np.clip(x, eps, 1.0))))
 
@@ -101,9 +263,46 @@ class Configurable(six.with_metaclass(ABCMeta, object)):
         return _reconfigured
 
 
+class _Task(object):
+    def __init__(self, name, fn, hz, priority, due):
+        self.name = name
+        self.fn = fn
+        self.period = 1.0 / hz
+        self.priority = priority
+        self.due = due
+        self.runs = 0
+        self.deferred = 0
+        self.duration = Histogram()
+
+    def to_dict(self):
+        return dict(
+            hz=1.0 / self.period,
+            priority=self.priority,
+            runs=self.runs,
+            deferred=self.deferred,
+            duration_ms=self.duration.to_dict(),
+        )
+
+
 class Application(object):
-    def __init__(self, run_hz=10, quit_event=None):
+    def __init__(
+        self,
+        run_hz=10,
+        quit_event=None,
+        deadlines=False,
+        overrun=OVERRUN_SKIP,
+        max_catch_up=5,
+        clock=None,
+    ):
+        """
+        :param deadlines: Schedule the steps on absolute deadlines of the monotonic clock instead of sleeping for the
+        remainder of the period after every step.
+        :param overrun: The deadline policy for steps that take longer than the period.
+        :param max_catch_up: The maximum number of missed steps to run back to back under the catch up policy.
+        :param clock: The clock that schedules the steps, the clock of the process when not given.
+        """
         self.logger = logging.getLogger(__name__)
+        self._clock = clock
         self._hz = run_hz
         self._sleep = 0.100
         self.set_hz(run_hz)
@@ -115,6 +314,26 @@ class Application(object):
             self.quit_event = quit_event
         # Recent window to calculate the actual processing frequency.
         self._rt_queue = collections.deque(maxlen=50)
+        self._deadlines = deadlines
+        self._overrun = overrun
+        self._max_catch_up = max_catch_up
+        # The lateness of the step starts and the excess duration of the overrunning steps in milliseconds.
+        self._jitter = Histogram()
+        self._overruns = Histogram()
+        self._skipped = 0
+        # The periodic tasks next to the step and the execution times of the step itself.
+        self._tasks = []
+        self._step_duration = Histogram()
+        # In reactive mode a step also starts as soon as wake() is called e.g. by a message listener.
+        self._reactive = False
+        self._wake_event = threading.Event()
+        self._woken = 0
+        # Profiles of the running application on request - the service names the session and its directory.
+        self.profiler = ProfileSession()
+        # The loop stops after a number of steps when the run is limited.
+        self._max_steps = None
+        self._num_steps = 0
+        self._is_setup = False
 
     def _interrupt(self):
         self.logger.info("Received interrupt, quitting.")
@@ -123,22 +342,105 @@ class Application(object):
     @staticmethod
     def _latest_or_none(receiver, patience):
         candidate = receiver()
-        _time = candidate.get("time", 0) if candidate is not None else 0
-        _on_time = (timestamp() - _time) < patience
+        _on_time = candidate is not None and message_age(candidate) < patience
         return candidate if _on_time else None
 
+    def get_clock(self):
+        return get_clock() if self._clock is None else self._clock
+
     def get_hz(self):
         return self._hz
 
     def get_actual_hz(self):
         return (1.0 / np.mean(self._rt_queue)) if self._rt_queue else 0
 
+    def get_schedule_stats(self):
+        return dict(
+            hz=self._hz,
+            actual_hz=self.get_actual_hz(),
+            deadlines=self._deadlines,
+            overrun_policy=self._overrun,
+            skipped=self._skipped,
+            reactive=self._reactive,
+            woken=self._woken,
+            jitter_ms=self._jitter.to_dict(),
+            overrun_ms=self._overruns.to_dict(),
+        )
+
+    def get_task_stats(self):
+        stats = dict((task.name, task.to_dict()) for task in self._tasks)
+        stats["step"] = dict(hz=self._hz, duration_ms=self._step_duration.to_dict())
+        return stats
+
+    def add_task(self, fn, hz, priority=0, name=None):
+        """
+        Run the callable periodically on the application thread in between the steps.
+        :param hz: The frequency of the task which is typically well below the step frequency.
+        :param priority: Due tasks run highest priority first. A task with a negative priority is background work which is
+        deferred while the remainder of the step period is too short for it - for at most one of its own periods.
+        :param name: The name in the task statistics.
+        """
+        _name = name or getattr(fn, "__name__", str(fn))
+        self._tasks.append(
+            _Task(_name, fn, hz, priority, due=self.get_clock().monotonic())
+        )
+        self._tasks.sort(key=lambda t: -t.priority)
+
+    def _run_tasks(self, deadline):
+        _clock = self.get_clock()
+        for task in self._tasks:
+            _now = _clock.monotonic()
+            if _now < task.due:
+                continue
+            _mean = task.duration.get_mean()
+            _no_slack = _mean is not None and _now + _mean * 1e-3 > deadline
+            if task.priority < 0 and _no_slack and _now - task.due < task.period:
+                task.deferred += 1
+                continue
+            try:
+                task.fn()
+            finally:
+                task.runs += 1
+                task.duration.record((_clock.monotonic() - _now) * 1e3)
+                # Keep to the grid of the task unless it has fallen more than a period behind.
+                task.due = max(task.due + task.period, _now)
+
+    def _step(self):
+        self.profiler.attach()
+        _clock = self.get_clock()
+        _start = _clock.monotonic()
+        self.step()
+        self._num_steps += 1
+        self._step_duration.record((_clock.monotonic() - _start) * 1e3)
+
     def set_hz(self, hz):
         self._hz = hz
         self._sleep = 1.0 / hz
 
+    def set_reactive(self, reactive):
+        """
+        Run the next step as soon as wake() is called instead of waiting for the period to end. The period remains as
+        the longest time between two steps. The timed wait is only precise on python 3.
+        """
+        self._reactive = reactive
+
+    def wake(self):
+        self._wake_event.set()
+
+    def _wait(self, seconds):
+        # :return: Whether the wait was cut short by a wake call.
+        if not self._reactive:
+            self.get_clock().sleep(seconds)
+            return False
+        _woken = self.get_clock().wait(self._wake_event, seconds)
+        self._wake_event.clear()
+        if _woken:
+            self._woken += 1
+        return _woken
+
     def active(self):
-        return not self.quit_event.is_set()
+        _limited = self._max_steps is not None and self._num_steps >= self._max_steps
+        return not (self.quit_event.is_set() or _limited)
 
     def quit(self):
         self.quit_event.set()
@@ -152,16 +454,60 @@ class Application(object):
     def finish(self):
         pass
 
-    def run(self):
+    def _run_relative(self):
+        _clock = self.get_clock()
+        while self.active():
+            _start = _clock.monotonic()
+            self._step()
+            if self._tasks:
+                self._run_tasks(_start + self._sleep)
+            _duration = _clock.monotonic() - _start
+            self._wait(max(0.0, self._sleep - _duration))
+            # Report the actual clock frequency which includes the user specified wait time.
+            self._rt_queue.append(_clock.monotonic() - _start)
+
+    def _run_deadlines(self):
+        _clock = self.get_clock()
+        _deadline = _clock.monotonic()
+        _previous = None
+        while self.active():
+            _start = _clock.monotonic()
+            self._jitter.record(max(0.0, _start - _deadline) * 1e3)
+            if _previous is not None:
+                self._rt_queue.append(_start - _previous)
+            _previous = _start
+            self._step()
+            # The period is read every step since set_hz may be called from the step.
+            _period = self._sleep
+            _deadline += _period
+            _now = _clock.monotonic()
+            if _now > _deadline:
+                self._overruns.record((_now - _deadline) * 1e3)
+                _missed = int((_now - _deadline) / _period)
+                if self._overrun == OVERRUN_CATCH_UP:
+                    # Run late steps immediately but do not fall further behind than the limit.
+                    _skip = max(0, _missed - self._max_catch_up)
+                else:
+                    # Continue at the next deadline that is still ahead.
+                    _skip = _missed + 1
+                self._skipped += _skip
+                _deadline += _skip * _period
+            if self._tasks:
+                self._run_tasks(_deadline)
+            if self._wait(max(0.0, _deadline - _clock.monotonic())):
+                # The early step starts a new period so that the tick only fires after a quiet period.
+                _deadline = _clock.monotonic()
+
+    def _loop(self, steps):
+        self._max_steps = None if steps is None else self._num_steps + steps
         try:
-            self.setup()
-            while self.active():
-                _start = time.time()
-                self.step()
-                _duration = time.time() - _start
-                time.sleep(max(0.0, self._sleep - _duration))
-                # Report the actual clock frequency which includes the user specified wait time.
-                self._rt_queue.append(time.time() - _start)
+            if not self._is_setup:
+                self._is_setup = True
+                self.setup()
+            if self._deadlines:
+                self._run_deadlines()
+            else:
+                self._run_relative()
         except Exception as e:
             # Quit first to be sure - the traceback may in some cases raise another exception.
             self.quit()
@@ -170,7 +516,19 @@ class Application(object):
         except KeyboardInterrupt:
             self.quit()
         finally:
-            self.finish()
+            if self.quit_event.is_set():
+                self.finish()
+
+    def run(self):
+        self._loop(steps=None)
+
+    def step_for(self, steps):
+        """
+        Run the loop for this number of steps and return e.g. to step a service deterministically on a virtual clock.
+        The setup runs with the first steps and the finish once the application quits, so the loop continues where it left
+        off at the next call.
+        """
+        self._loop(steps=steps)
 
 
 class ApplicationExit(object):
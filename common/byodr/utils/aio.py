@@ -0,0 +1,191 @@
+"""
+Asyncio counterparts of the ipc primitives for the python 3 services that run an event loop e.g. teleop.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+
+import zmq
+import zmq.asyncio
+
+from byodr.utils.ipc import decode_json, is_same_host, receive_age
+from byodr.utils.metrics import topic_stats
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncJSONSubscriber(object):
+    """
+    Subscription which is read by a task on the event loop so that handlers get the messages without a thread hand-off.
+    Latest value: peek() or await wait() to be woken up by the next message.
+    Stream: async for message in subscriber.stream() - a slow consumer loses the oldest messages from its own queue only.
+    """
+
+    def __init__(self, url, topic=b"", hwm=1, consumer=None):
+        """
+        :param consumer: The name to keep the statistics of this subscription apart from the other receivers of the topic.
+        """
+        self._url = url
+        self._topic = topic
+        self._hwm = hwm
+        self._same_host = is_same_host(url)
+        self._stats = topic_stats(topic, consumer=consumer)
+        # The longest of the stream queues, the latest value is not queued.
+        self._stats.set_queue(
+            lambda: max([len(queue) for queue in self._streams] + [0]), hwm
+        )
+        self._socket = None
+        self._task = None
+        self._latest = None
+        self._seq = 0
+        self._waiters = []
+        self._streams = []
+
+    def start(self):
+        # To be called from the event loop thread.
+        socket = zmq.asyncio.Context.instance().socket(zmq.SUB)
+        socket.set_hwm(self._hwm)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self._url)
+        socket.setsockopt(zmq.SUBSCRIBE, self._topic)
+        self._socket = socket
+        self._task = asyncio.ensure_future(self._run())
+
+    def _publish(self, message):
+        self._latest = message
+        self._seq += 1
+        self._stats.on_consume(receive_age(message, self._same_host))
+        waiters, self._waiters = self._waiters, []
+        [f.set_result(self._seq) for f in waiters if not f.done()]
+        for queue in self._streams:
+            if len(queue) == queue.maxlen:
+                self._stats.on_overwrite()
+            queue.append(message)
+            if queue.event is not None:
+                queue.event.set()
+
+    async def _run(self):
+        while True:
+            try:
+                parts = await self._socket.recv_multipart()
+                self._publish(decode_json(parts))
+            except ValueError as e:
+                logger.warning(e)
+            except asyncio.CancelledError:
+                break
+
+    def get_seq(self):
+        """
+        :return: The number of messages received so far.
+        """
+        return self._seq
+
+    def peek(self):
+        return self._latest
+
+    def get(self):
+        return self._latest
+
+    async def wait(self, after=None, timeout=None):
+        """
+        Wait for a message newer than sequence number after - the current one when not given.
+        :return: The sequence number of the latest message, which is unchanged on timeout.
+        """
+        after = self._seq if after is None else after
+        if self._seq > after:
+            return self._seq
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if future in self._waiters:
+                self._waiters.remove(future)
+            return self._seq
+
+    async def stream(self, maxlen=10):
+        queue = _StreamQueue(maxlen)
+        self._streams.append(queue)
+        try:
+            while True:
+                if not queue:
+                    queue.event = asyncio.Event()
+                    await queue.event.wait()
+                    queue.event = None
+                yield queue.popleft()
+        finally:
+            self._streams.remove(queue)
+
+    def quit(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class _StreamQueue(collections.deque):
+    def __init__(self, maxlen):
+        super(_StreamQueue, self).__init__(maxlen=maxlen)
+        self.event = None
+
+
+class AsyncJSONZmqClient(object):
+    """
+    Scatter-gather client to json servers which can be awaited from the event loop.
+    See byodr.utils.ipc.JSONZmqClient for the semantics.
+    """
+
+    def __init__(self, urls, hwm=1, receive_timeout_ms=200):
+        self._urls = urls if isinstance(urls, list) else [urls]
+        self._receive_timeout = receive_timeout_ms
+        self._hwm = hwm
+        self._context = zmq.asyncio.Context.instance()
+        self._sockets = [self._create(url) for url in self._urls]
+
+    def _create(self, url):
+        socket = self._context.socket(zmq.DEALER)
+        socket.set_hwm(self._hwm)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(url)
+        return socket
+
+    def _recreate(self, index):
+        self._sockets[index].close()
+        self._sockets[index] = self._create(self._urls[index])
+
+    def quit(self):
+        [socket.close() for socket in self._sockets]
+        self._sockets = []
+
+    async def call(self, message):
+        payload = json.dumps(message).encode("utf-8")
+        futures = dict()
+        for i, socket in enumerate(self._sockets):
+            try:
+                await socket.send_multipart([b"", payload], zmq.NOBLOCK)
+                futures[asyncio.ensure_future(socket.recv_multipart())] = i
+            except zmq.Again:
+                self._recreate(i)
+        replies = dict()
+        if futures:
+            done, pending = await asyncio.wait(
+                list(futures.keys()), timeout=self._receive_timeout * 1e-3
+            )
+            for future in done:
+                _index = futures[future]
+                try:
+                    replies[_index] = json.loads(future.result()[-1].decode("utf-8"))
+                except ValueError as e:
+                    logger.warning(
+                        "Malformed reply from '{}': {}".format(self._urls[_index], e)
+                    )
+                    self._recreate(_index)
+            for future in pending:
+                future.cancel()
+                self._recreate(futures[future])
+        ret = {}
+        [ret.update(replies[i]) for i in sorted(replies.keys())]
+        return ret
@@ -0,0 +1,389 @@
+"""
+Record the ipc topics of the services to a bag file and replay them later - in real time, faster or as fast as possible.
+    python -m byodr.utils.bag record --bag /byodr/session.bag --jpeg 90
+    python -m byodr.utils.bag replay --bag /byodr/session.bag --rate 4
+A bag is an append-only sequence of records - recording time, kind, topic and payload - next to an index file with the
+time and file offset of every record. The index can always be rebuilt from the bag itself.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import bisect
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+
+import numpy as np
+
+from byodr.utils import monotonic_timestamp, timestamp
+from byodr.utils.ipc import CameraThread, ImagePublisher, JSONPublisher, ReceiverThread
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"BYODRBAG"
+_VERSION = 1
+_HEADER = struct.Struct("<8sI")
+# Recording time in microseconds, record kind, topic length and payload length.
+_RECORD = struct.Struct("<qBHI")
+# Recording time and the file offset of the record.
+_INDEX = struct.Struct("<qQ")
+_MD_LENGTH = struct.Struct("<I")
+
+KIND_JSON, KIND_IMAGE_RAW, KIND_IMAGE_JPEG = 0, 1, 2
+
+# The sockets of the services as url, topic and whether the topic carries images.
+SERVICE_TOPICS = (
+    ("ipc:///byodr/teleop.sock", "aav/teleop/input", False),
+    ("ipc:///byodr/ros.sock", "aav/ros/input", False),
+    ("ipc:///byodr/pilot.sock", "aav/pilot/output", False),
+    ("ipc:///byodr/vehicle.sock", "aav/vehicle/state", False),
+    ("ipc:///byodr/inference.sock", "aav/inference/state", False),
+    ("ipc:///byodr/camera_0.sock", "aav/camera/0", True),
+    ("ipc:///byodr/camera_1.sock", "aav/camera/1", True),
+)
+
+
+def _index_path(path):
+    return path + ".idx"
+
+
+class BagWriter(object):
+    """
+    Thread-safe writer of bag records. Images are stored raw or as jpeg when a quality is given.
+    """
+
+    def __init__(self, path, jpeg_quality=None):
+        if jpeg_quality is not None and cv2 is None:
+            raise ValueError("Jpeg images require opencv.")
+        self._lock = threading.Lock()
+        self._jpeg_quality = jpeg_quality
+        _exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, "ab")
+        self._index = open(_index_path(path), "ab")
+        if not _exists:
+            self._file.write(_HEADER.pack(_MAGIC, _VERSION))
+        self._n_records = 0
+
+    def get_num_records(self):
+        return self._n_records
+
+    def _append(self, kind, topic, payload, ts):
+        _topic = topic.encode("utf-8") if not isinstance(topic, bytes) else topic
+        _ts = timestamp() if ts is None else ts
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(_RECORD.pack(_ts, kind, len(_topic), len(payload)))
+            self._file.write(_topic)
+            self._file.write(payload)
+            self._index.write(_INDEX.pack(_ts, offset))
+            self._n_records += 1
+
+    def write_json(self, topic, message, ts=None):
+        self._append(KIND_JSON, topic, json.dumps(message).encode("utf-8"), ts)
+
+    def write_image(self, topic, md, image, ts=None):
+        md = dict(md)
+        md["shape"] = list(image.shape)
+        if self._jpeg_quality is None:
+            kind, data = (
+                KIND_IMAGE_RAW,
+                np.ascontiguousarray(image, dtype=np.uint8).tobytes(),
+            )
+        else:
+            kind, data = (
+                KIND_IMAGE_JPEG,
+                cv2.imencode(
+                    ".jpg", image, [int(cv2.IMWRITE_JPEG_QUALITY), self._jpeg_quality]
+                )[1].tobytes(),
+            )
+        # The ring details of shared memory frames have no meaning outside of the recording.
+        md.pop("ring", None)
+        _md = json.dumps(md).encode("utf-8")
+        self._append(kind, topic, _MD_LENGTH.pack(len(_md)) + _md + data, ts)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._index.close()
+
+
+class BagReader(object):
+    """
+    Random access to the records of a bag. Json records read as the message and images as the tuple (md, image).
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "rb")
+        magic, version = _HEADER.unpack(self._file.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("The file '{}' is not a bag.".format(path))
+        self._times, self._offsets = self._load_index()
+
+    def _load_index(self):
+        _size = os.path.getsize(self._path)
+        _ipath = _index_path(self._path)
+        if os.path.exists(_ipath):
+            with open(_ipath, "rb") as f:
+                data = f.read()
+            entries = [
+                _INDEX.unpack_from(data, i)
+                for i in range(0, len(data) - _INDEX.size + 1, _INDEX.size)
+            ]
+            # A record which is only partially written is left out.
+            entries = [(t, o) for t, o in entries if self._complete(o, _size)]
+        else:
+            entries = self._scan(_size)
+        return [t for t, _ in entries], [o for _, o in entries]
+
+    def _complete(self, offset, size):
+        if offset + _RECORD.size > size:
+            return False
+        self._file.seek(offset)
+        _, _, n_topic, n_payload = _RECORD.unpack(self._file.read(_RECORD.size))
+        return offset + _RECORD.size + n_topic + n_payload <= size
+
+    def _scan(self, size):
+        entries = []
+        offset = _HEADER.size
+        while self._complete(offset, size):
+            self._file.seek(offset)
+            ts, _, n_topic, n_payload = _RECORD.unpack(self._file.read(_RECORD.size))
+            entries.append((ts, offset))
+            offset += _RECORD.size + n_topic + n_payload
+        return entries
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def get_time_range(self):
+        return (self._times[0], self._times[-1]) if self._times else (None, None)
+
+    def find(self, ts):
+        """
+        :return: The position of the first record at or after the timestamp.
+        """
+        return bisect.bisect_left(self._times, ts)
+
+    def read(self, position):
+        """
+        :return: The recording time, topic and contents of the record at the position.
+        """
+        self._file.seek(self._offsets[position])
+        ts, kind, n_topic, n_payload = _RECORD.unpack(self._file.read(_RECORD.size))
+        topic = self._file.read(n_topic).decode("utf-8")
+        payload = self._file.read(n_payload)
+        if kind == KIND_JSON:
+            return ts, topic, json.loads(payload.decode("utf-8"))
+        n_md = _MD_LENGTH.unpack_from(payload, 0)[0]
+        md = json.loads(
+            payload[_MD_LENGTH.size : _MD_LENGTH.size + n_md].decode("utf-8")
+        )
+        data = np.frombuffer(payload[_MD_LENGTH.size + n_md :], dtype=np.uint8)
+        if kind == KIND_IMAGE_JPEG:
+            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        else:
+            image = data.reshape(md["shape"])
+        return ts, topic, (md, image)
+
+    def records(self, start=0):
+        for position in range(start, len(self)):
+            yield self.read(position)
+
+    def close(self):
+        self._file.close()
+
+
+def _retime(message):
+    # The monotonic clock of the recording means nothing after a reboot, so both stamps are replaced.
+    message["time"] = timestamp()
+    if "mono" in message:
+        message["mono"] = monotonic_timestamp()
+
+
+def replay(reader, sinks, rate=1.0, start=0, event=None, retime=True):
+    """
+    Hand the records to the sinks keeping the recorded intervals divided by the rate.
+    :param reader: The bag reader.
+    :param sinks: Callables by topic, called with the message or with md and image e.g. QueueReceiver.add and QueueCamera.add.
+    :param rate: The replay speed - zero or None replays as fast as possible.
+    :param start: The record position to start at.
+    :param event: Stops the replay when set.
+    :param retime: Give the messages the current time so that they are not taken for stale by the consumers.
+    :return: The number of records delivered.
+    """
+    n_delivered = 0
+    _first, _wall = None, None
+    for ts, topic, contents in reader.records(start):
+        if event is not None and event.is_set():
+            break
+        sink = sinks.get(topic)
+        if sink is None:
+            continue
+        if rate:
+            if _first is None:
+                _first, _wall = ts, time.time()
+            _delay = _wall + (ts - _first) * 1e-6 / rate - time.time()
+            if _delay > 0:
+                time.sleep(_delay)
+        if isinstance(contents, tuple):
+            md, image = contents
+            if retime:
+                _retime(md)
+            sink(md, image)
+        else:
+            if retime and isinstance(contents, dict):
+                _retime(contents)
+            sink(contents)
+        n_delivered += 1
+    return n_delivered
+
+
+def publisher_sinks(topics=SERVICE_TOPICS):
+    """
+    :return: Sinks which publish on the service sockets as if the services were running.
+    """
+    sinks = dict()
+    for url, topic, is_image in topics:
+        if is_image:
+            sinks[topic] = (lambda p: lambda md, image: p.publish(image))(
+                ImagePublisher(url=url, topic=topic)
+            )
+        else:
+            sinks[topic] = JSONPublisher(url=url, topic=topic).publish
+    return sinks
+
+
+def recorder_threads(writer, event, topics=SERVICE_TOPICS):
+    """
+    :return: The receiver threads which write every message of the topics to the bag.
+    """
+    threads = []
+    for url, topic, is_image in topics:
+        if is_image:
+            thread = CameraThread(url=url, topic=topic.encode("utf-8"), event=event)
+            thread.add_listener(
+                (lambda t: lambda md, image: writer.write_image(t, md, image))(topic)
+            )
+        else:
+            thread = ReceiverThread(
+                url=url, topic=topic.encode("utf-8"), event=event, receive_timeout_ms=50
+            )
+            thread.add_listener(
+                (lambda t: lambda message: writer.write_json(t, message))(topic)
+            )
+        threads.append(thread)
+    return threads
+
+
+quit_event = multiprocessing.Event()
+
+
+def _interrupt():
+    logger.info("Received interrupt, quitting.")
+    quit_event.set()
+
+
+def _select(names):
+    return (
+        SERVICE_TOPICS
+        if not names
+        else tuple(t for t in SERVICE_TOPICS if t[1] in names)
+    )
+
+
+def record(args):
+    writer = BagWriter(args.bag, jpeg_quality=args.jpeg)
+    threads = recorder_threads(writer, quit_event, topics=_select(args.topics))
+    [t.start() for t in threads]
+    logger.info("Recording to '{}'.".format(args.bag))
+    while not quit_event.is_set():
+        quit_event.wait(1)
+        writer.flush()
+    [t.join() for t in threads]
+    writer.close()
+    logger.info("Recorded {} messages.".format(writer.get_num_records()))
+
+
+def play(args):
+    reader = BagReader(args.bag)
+    sinks = publisher_sinks(topics=_select(args.topics))
+    # Give the subscribers the time to connect.
+    time.sleep(1)
+    logger.info(
+        "Replaying {} records from '{}' at rate {}.".format(
+            len(reader), args.bag, args.rate
+        )
+    )
+    n_delivered = replay(reader, sinks, rate=args.rate, event=quit_event)
+    reader.close()
+    logger.info("Replayed {} messages.".format(n_delivered))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay the ipc topics.")
+    subparsers = parser.add_subparsers(help="Methods.")
+
+    parser_a = subparsers.add_parser("record", help="Record the topics to a bag.")
+    parser_a.add_argument("--bag", type=str, required=True, help="Bag file path.")
+    parser_a.add_argument(
+        "--jpeg",
+        type=int,
+        default=None,
+        help="Store the images as jpeg at this quality.",
+    )
+    parser_a.add_argument(
+        "--topics",
+        type=str,
+        nargs="*",
+        default=None,
+        help="The topics to record - all by default.",
+    )
+    parser_a.set_defaults(func=record)
+
+    parser_b = subparsers.add_parser("replay", help="Publish the topics from a bag.")
+    parser_b.add_argument("--bag", type=str, required=True, help="Bag file path.")
+    parser_b.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="Replay speed - zero for as fast as possible.",
+    )
+    parser_b.add_argument(
+        "--topics",
+        type=str,
+        nargs="*",
+        default=None,
+        help="The topics to replay - all by default.",
+    )
+    parser_b.set_defaults(func=play)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, lambda sig, frame: _interrupt())
+    signal.signal(signal.SIGTERM, lambda sig, frame: _interrupt())
+    logging.basicConfig(
+        format="%(levelname)s: %(asctime)s %(filename)s %(funcName)s %(message)s",
+        datefmt="%Y%m%d:%H:%M:%S %p %Z",
+    )
+    logging.getLogger().setLevel(logging.INFO)
+    main()
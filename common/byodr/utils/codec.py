@@ -0,0 +1,309 @@
+"""
+Message codecs for the json topics.
+The default wire format is the legacy 'topic:json' string frame. Schema codecs encode the known fields of a topic in a fixed
+binary layout - numeric arrays as raw buffers - and carry whatever else is present in the message as a json tail.
+Binary messages are sent as three frames: topic, codec name and payload. Receivers detect the format per message so a
+publisher can switch codecs without the subscribers having to be reconfigured.
+"""
+
+from __future__ import absolute_import
+
+import functools
+import json
+import struct
+
+import numpy as np
+import six
+
+# Field kinds.
+FLOAT, INT, BOOL, STRING, FLOAT_ARRAY = ("d", "q", "?", "s", "d[]")
+
+_SCALARS = (FLOAT, INT, BOOL)
+_LENGTH = struct.Struct("<I")
+
+
+def _accepts(kind, value):
+    if kind == FLOAT:
+        return isinstance(value, (float, int)) and not isinstance(value, bool)
+    if kind == INT:
+        return isinstance(value, six.integer_types) and not isinstance(value, bool)
+    if kind == BOOL:
+        return isinstance(value, bool)
+    if kind == STRING:
+        return isinstance(value, six.string_types)
+    if kind == FLOAT_ARRAY:
+        return isinstance(value, (list, tuple, np.ndarray))
+    return False
+
+
+def _buffer(kind, value):
+    if kind == STRING:
+        return value.encode("utf-8")
+    # Only a flat array of numbers survives the round trip, e.g. a list with None in it goes to the json tail.
+    _array = np.asarray(value)
+    if _array.ndim != 1 or _array.dtype.kind not in "iuf":
+        return None
+    return np.ascontiguousarray(_array, dtype="<f8").tobytes()
+
+
+class JSONCodec(object):
+    name = b"json"
+
+    @staticmethod
+    def encode(data):
+        return json.dumps(data).encode("utf-8")
+
+    @staticmethod
+    def decode(payload):
+        return json.loads(payload.decode("utf-8"))
+
+
+class SchemaCodec(object):
+    """
+    Layout: presence bitmask, the scalar fields packed in schema order, the strings and arrays as length prefixed buffers
+    and finally a json object for the fields outside of the schema or with an unexpected type.
+    A field which is absent or None is not set in the presence mask and decodes as absent.
+    """
+
+    def __init__(self, name, fields):
+        assert len(fields) <= 64, "The presence mask holds up to 64 fields."
+        self.name = name
+        self._fields = tuple(fields)
+        self._names = tuple(k for k, _ in fields)
+        self._kinds = dict(fields)
+        self._scalars = tuple(
+            (i, k, t) for i, (k, t) in enumerate(fields) if t in _SCALARS
+        )
+        self._buffers = tuple(
+            (i, k, t) for i, (k, t) in enumerate(fields) if t not in _SCALARS
+        )
+        self._struct = struct.Struct("<Q" + "".join(t for _, _, t in self._scalars))
+        self._defaults = {FLOAT: 0.0, INT: 0, BOOL: False}
+
+    def get_fields(self):
+        return self._fields
+
+    def get_names(self):
+        return self._names
+
+    def is_field(self, key):
+        return key in self._kinds
+
+    def encode(self, data):
+        if isinstance(data, SchemaRecord):
+            # The fields are read straight from the slots of the record.
+            return self._pack(functools.partial(getattr, data), data.get_extras())
+        extras = dict(
+            (k, v) for k, v in data.items() if k not in self._kinds and v is not None
+        )
+        return self._pack(data.get, extras)
+
+    def _pack(self, value_of, extras):
+        mask, mismatches = 0, None
+        values = []
+        for i, key, kind in self._scalars:
+            value = value_of(key)
+            if value is not None and _accepts(kind, value):
+                mask |= 1 << i
+                values.append(value)
+            else:
+                values.append(self._defaults[kind])
+                if value is not None:
+                    mismatches = {} if mismatches is None else mismatches
+                    mismatches[key] = value
+        chunks = []
+        for i, key, kind in self._buffers:
+            value = value_of(key)
+            if value is None:
+                continue
+            _bytes = _buffer(kind, value) if _accepts(kind, value) else None
+            if _bytes is None:
+                mismatches = {} if mismatches is None else mismatches
+                mismatches[key] = value
+                continue
+            mask |= 1 << i
+            chunks.append(_LENGTH.pack(len(_bytes)))
+            chunks.append(_bytes)
+        if mismatches is not None:
+            mismatches.update(extras)
+            extras = mismatches
+        _tail = json.dumps(extras).encode("utf-8") if extras else b""
+        return b"".join([self._struct.pack(mask, *values)] + chunks + [_tail])
+
+    def decode(self, payload):
+        _unpacked = self._struct.unpack_from(payload, 0)
+        mask = _unpacked[0]
+        data = dict(
+            (key, value)
+            for (i, key, _), value in zip(self._scalars, _unpacked[1:])
+            if mask & (1 << i)
+        )
+        offset = self._struct.size
+        for i, key, kind in self._buffers:
+            if mask & (1 << i):
+                n_bytes = _LENGTH.unpack_from(payload, offset)[0]
+                offset += _LENGTH.size
+                _bytes = payload[offset : offset + n_bytes]
+                offset += n_bytes
+                if kind == STRING:
+                    data[key] = _bytes.decode("utf-8")
+                else:
+                    data[key] = np.frombuffer(_bytes, dtype="<f8").tolist()
+        if offset < len(payload):
+            data.update(json.loads(payload[offset:].decode("utf-8")))
+        return data
+
+
+class SchemaRecord(object):
+    """
+    Message with a slot per field of a schema, for publishers that build the same message every step. Subclasses set the
+    codec and declare its field names as slots - the record can then be kept and refilled instead of allocated anew and is
+    encoded without an intermediate dictionary. Fields outside of the schema are kept in a dictionary.
+    The record reads and writes like a dictionary for the code that handles messages.
+    """
+
+    __slots__ = ("_extras",)
+    codec = None
+
+    def __init__(self):
+        self._extras = {}
+        self.clear()
+
+    def clear(self):
+        for key in self.codec.get_names():
+            setattr(self, key, None)
+        self._extras.clear()
+
+    def get_extras(self):
+        return self._extras
+
+    def get(self, key, default=None):
+        if self.codec.is_field(key):
+            return getattr(self, key)
+        return self._extras.get(key, default)
+
+    def __getitem__(self, key):
+        if self.codec.is_field(key):
+            return getattr(self, key)
+        return self._extras[key]
+
+    def __setitem__(self, key, value):
+        if self.codec.is_field(key):
+            setattr(self, key, value)
+        else:
+            self._extras[key] = value
+
+    def __contains__(self, key):
+        return self.codec.is_field(key) or key in self._extras
+
+    def keys(self):
+        return list(self.codec.get_names()) + list(self._extras.keys())
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.codec.get_names()] + list(
+            self._extras.items()
+        )
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+PILOT_OUTPUT = SchemaCodec(
+    b"aav/pilot/output/2",
+    [
+        ("time", INT),
+        ("mono", INT),
+        ("cruise_speed", FLOAT),
+        ("desired_speed", FLOAT),
+        ("driver", STRING),
+        ("driver_activation_time", FLOAT),
+        ("forced_acceleration", BOOL),
+        ("forced_deceleration", BOOL),
+        ("forced_steering", BOOL),
+        ("forced_throttle", BOOL),
+        ("instruction", STRING),
+        ("save_event", BOOL),
+        ("speed_driver", STRING),
+        ("steering", FLOAT),
+        ("steering_scale", FLOAT),
+        ("steering_driver", STRING),
+        ("throttle", FLOAT),
+        ("arrow_up", INT),
+        ("arrow_down", INT),
+        ("button_left", INT),
+        ("button_right", INT),
+        ("navigation_active", BOOL),
+        ("navigation_route", STRING),
+        ("navigation_match_image", INT),
+        ("navigation_match_distance", FLOAT),
+        ("navigation_match_point", STRING),
+        ("inference_brake", FLOAT),
+    ],
+)
+
+VEHICLE_STATE = SchemaCodec(
+    b"aav/vehicle/state/2",
+    [
+        ("time", INT),
+        ("mono", INT),
+        ("latitude_geo", FLOAT),
+        ("longitude_geo", FLOAT),
+        ("heading", FLOAT),
+        ("velocity", FLOAT),
+        ("trust_velocity", INT),
+    ],
+)
+
+INFERENCE_STATE = SchemaCodec(
+    b"aav/inference/state/2",
+    [
+        ("time", INT),
+        ("mono", INT),
+        ("action", FLOAT),
+        ("obstacle", FLOAT),
+        ("surprise_out", FLOAT),
+        ("critic_out", FLOAT),
+        ("brake_critic_out", FLOAT),
+        ("steer_penalty", FLOAT),
+        ("brake_penalty", FLOAT),
+        ("total_penalty", FLOAT),
+        ("steer_confidence", FLOAT),
+        ("brake_confidence", FLOAT),
+        ("internal", FLOAT_ARRAY),
+        ("navigation_point", INT),
+        ("navigation_image", INT),
+        ("navigation_distance", FLOAT),
+        ("navigation_command", INT),
+        ("navigation_path", FLOAT_ARRAY),
+        ("_fps", FLOAT),
+    ],
+)
+
+# The codecs by topic for the publishers and by name for the receivers.
+_topic_codecs = dict()
+_named_codecs = {JSONCodec.name: JSONCodec}
+
+
+def register_codec(topic, codec):
+    _topic_codecs[topic] = codec
+    _named_codecs[codec.name] = codec
+
+
+def get_topic_codec(topic):
+    """
+    :return: The schema codec registered for the topic or None when the topic is to be sent as json.
+    """
+    return _topic_codecs.get(topic)
+
+
+def get_named_codec(name):
+    return _named_codecs.get(name)
+
+
+register_codec("aav/pilot/output", PILOT_OUTPUT)
+register_codec("aav/vehicle/state", VEHICLE_STATE)
+register_codec("aav/inference/state", INFERENCE_STATE)
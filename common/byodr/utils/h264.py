@@ -0,0 +1,229 @@
+"""
+Fan out of an h264 byte stream, a sample per access unit as from the gstreamer appsink, to the websocket clients.
+The hub takes each sample to the io loop once for all clients, instead of a callback per client, and keeps track of the
+bytes each client has yet to receive so that a client on a weak link skips to the next keyframe instead of slowing down
+the others and growing the queue of the io loop.
+"""
+
+from __future__ import absolute_import
+
+import functools
+import logging
+import threading
+
+import six
+from tornado.websocket import WebSocketClosedError
+
+logger = logging.getLogger(__name__)
+
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+
+_START_CODE = b"\x00\x00\x01"
+
+
+def nal_units(sample):
+    """
+    :return: The type, start and end of the nal units in the annex b byte stream - from the start code to the next one.
+    """
+    units = []
+    _start = sample.find(_START_CODE)
+    while _start >= 0:
+        _next = sample.find(_START_CODE, _start + 3)
+        # The four byte start code has a leading zero.
+        _end = (
+            len(sample)
+            if _next < 0
+            else (_next - 1 if sample[_next - 1 : _next] == b"\x00" else _next)
+        )
+        _begin = _start - 1 if sample[_start - 1 : _start] == b"\x00" else _start
+        if _start + 3 < len(sample):
+            units.append((six.indexbytes(sample, _start + 3) & 0x1F, _begin, _end))
+        _start = _next
+    return units
+
+
+class _Viewer(object):
+    __slots__ = ("client", "outstanding", "synced", "sent", "dropped")
+
+    def __init__(self, client):
+        self.client = client
+        # The bytes written to the connection that have not gone out yet.
+        self.outstanding = 0
+        # Whether the client has the keyframe the next sample depends on.
+        self.synced = False
+        self.sent = 0
+        self.dropped = 0
+
+    def to_dict(self):
+        return dict(
+            outstanding=self.outstanding,
+            synced=self.synced,
+            sent=self.sent,
+            dropped=self.dropped,
+        )
+
+
+class H264StreamHub(object):
+    """
+    One subscription to the video source for all of its clients. A client with more than the maximum bytes outstanding
+    drops the samples until a keyframe, which it gets with the sps and pps in front. The latest sps and pps and the samples
+    since the latest keyframe are kept so that a new client starts decoding at once.
+    The samples arrive on the thread of the source and everything else runs on the io loop.
+    """
+
+    def __init__(
+        self,
+        video_source,
+        io_loop,
+        max_outstanding_bytes=256 * 1024,
+        max_gop_bytes=None,
+        max_pending=8,
+    ):
+        """
+        :param max_gop_bytes: The most bytes of the samples since the keyframe to keep for new clients - up to the maximum
+        outstanding bytes as that is what a new client can take at once, which is also the default.
+        :param max_pending: The most samples waiting for the io loop - beyond that the samples are dropped for all clients.
+        """
+        self._source = video_source
+        self._io_loop = io_loop
+        self._max_outstanding = max_outstanding_bytes
+        self._max_gop = (
+            max_outstanding_bytes
+            if max_gop_bytes is None
+            else min(max_gop_bytes, max_outstanding_bytes)
+        )
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._gap = False
+        self._viewers = dict()
+        self._sps = None
+        self._pps = None
+        # The group of pictures since the latest keyframe, empty when it is incomplete.
+        self._gop = []
+        self._gop_bytes = 0
+        self._n_samples = 0
+        self._n_skipped = 0
+
+    def join(self, client):
+        if client in self._viewers:
+            return
+        viewer = _Viewer(client)
+        if not self._viewers:
+            self._source.add_listener(self._on_sample)
+        self._viewers[client] = viewer
+        # A keyframe on its own can be more than a new client can take, it then waits for the next one.
+        if (
+            self._gop
+            and self._sps is not None
+            and self._pps is not None
+            and self._gop_bytes <= self._max_outstanding
+        ):
+            viewer.synced = True
+            self._write(viewer, self._parameter_sets(self._gop[0]) + self._gop[0])
+            [self._write(viewer, sample) for sample in self._gop[1:]]
+
+    def leave(self, client):
+        if self._viewers.pop(client, None) is not None and not self._viewers:
+            self._source.remove_listener(self._on_sample)
+
+    def get_stats(self):
+        return dict(
+            clients=[v.to_dict() for v in self._viewers.values()],
+            samples=self._n_samples,
+            skipped=self._n_skipped,
+            gop_samples=len(self._gop),
+            gop_bytes=self._gop_bytes,
+        )
+
+    def _on_sample(self, sample):
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self._n_skipped += 1
+                self._gap = True
+                return
+            self._pending += 1
+        self._io_loop.add_callback(self._fan_out, sample)
+
+    def _parameter_sets(self, sample):
+        # The keyframes of some encoders come without the parameter sets.
+        _types = set(unit[0] for unit in nal_units(sample))
+        if NAL_SPS in _types and NAL_PPS in _types:
+            return b""
+        return self._sps + self._pps
+
+    def _cache(self, sample, keyframe, gap):
+        if keyframe:
+            self._gop, self._gop_bytes = [sample], len(sample)
+        elif self._gop and not gap and self._gop_bytes + len(sample) <= self._max_gop:
+            self._gop.append(sample)
+            self._gop_bytes += len(sample)
+        else:
+            self._gop, self._gop_bytes = [], 0
+
+    def _fan_out(self, sample):
+        with self._lock:
+            self._pending -= 1
+            _gap, self._gap = self._gap, False
+        self._n_samples += 1
+        _keyframe = False
+        for nal_type, begin, end in nal_units(sample):
+            if nal_type == NAL_SPS:
+                self._sps = sample[begin:end]
+            elif nal_type == NAL_PPS:
+                self._pps = sample[begin:end]
+            elif nal_type == NAL_IDR:
+                _keyframe = True
+        self._cache(sample, _keyframe, _gap)
+        _decodable = _keyframe and self._sps is not None and self._pps is not None
+        _prefixed = None
+        for viewer in list(self._viewers.values()):
+            if _gap or viewer.outstanding > self._max_outstanding:
+                viewer.synced = False
+            if viewer.synced:
+                self._write(viewer, sample)
+            elif _decodable and viewer.outstanding <= self._max_outstanding:
+                _prefixed = (
+                    (self._parameter_sets(sample) + sample)
+                    if _prefixed is None
+                    else _prefixed
+                )
+                viewer.synced = True
+                self._write(viewer, _prefixed)
+            else:
+                viewer.dropped += 1
+
+    def _write(self, viewer, data):
+        try:
+            future = viewer.client.write_message(data, binary=True)
+        except WebSocketClosedError:
+            self.leave(viewer.client)
+            return
+        viewer.sent += 1
+        if future is not None:
+            viewer.outstanding += len(data)
+            future.add_done_callback(
+                functools.partial(self._on_written, viewer, len(data))
+            )
+
+    @staticmethod
+    def _on_written(viewer, n_bytes, future):
+        viewer.outstanding -= n_bytes
+        # Retrieve the error of a closed connection so that it is not logged as unhandled.
+        future.exception()
+
+
+_hubs = dict()
+_hubs_lock = threading.Lock()
+
+
+def stream_hub(video_source, io_loop):
+    """
+    :return: The hub of the video source, created on first use.
+    """
+    with _hubs_lock:
+        if video_source not in _hubs:
+            _hubs[video_source] = H264StreamHub(video_source, io_loop)
+        return _hubs[video_source]
@@ -6,14 +6,21 @@ import json
 import logging
 import multiprocessing
 import os
+import random
 import sys
 import threading
 import time
 
 import numpy as np
+import six
 import zmq
+from six.moves import queue
 
-from byodr.utils import timestamp
+from byodr.utils import timestamp, monotonic, monotonic_timestamp, message_age
+from byodr.utils.codec import get_named_codec, get_topic_codec
+from byodr.utils.metrics import ipc_stats, topic_stats
+from byodr.utils.protocol import ClockOffsetEstimator, SequenceFilter
+from byodr.utils.sharedmem import SharedFrameRing, ring_path
 
 if sys.version_info > (3,):
     # noinspection PyShadowingBuiltins
@@ -37,44 +44,130 @@ else:
 logger = logging.getLogger(__name__)
 
 
+def _context():
+    # One context per process serves all sockets.
+    return zmq.Context.instance()
+
+
+def _bytes(val):
+    return val.encode('utf-8') if isinstance(val, six.text_type) else val
+
+
+def _text(val):
+    return val.decode('utf-8') if isinstance(val, six.binary_type) else val
+
+
+def is_same_host(url):
+    """
+    :return: Whether the endpoint is on this host so that the monotonic timestamps of its messages can be compared.
+    """
+    _host = url.split('://')[-1].rsplit(':', 1)[0]
+    return url.startswith('ipc://') or url.startswith('inproc://') or _host in ('127.0.0.1', 'localhost')
+
+
+def receive_age(message, same_host):
+    """
+    :return: The age of a received message in microseconds or None when it carries no timestamp.
+    """
+    if not isinstance(message, dict) or not (message.get('time') or (same_host and message.get('mono') is not None)):
+        return None
+    return message_age(message, same_host=same_host)
+
+
+def _clock_reply(message, reply, received):
+    # Requests that carry the send time of the client are answered with the receive and send times of the server.
+    if isinstance(message, dict) and 'clock' in message and isinstance(reply, dict):
+        return dict(reply, clock=[received, monotonic_timestamp()])
+    return reply
+
+
+def receive_json(subscriber, flags=0):
+    """
+    Receive one message in either the legacy 'topic:json' string format or as topic, codec name and payload frames.
+    """
+    return decode_json(subscriber.recv_multipart(flags))
+
+
+def decode_json(parts):
+    if len(parts) == 1:
+        return json.loads(_text(parts[0]).split(':', 1)[1])
+    codec = get_named_codec(parts[1])
+    if codec is None:
+        raise ValueError("Unknown codec '{}'.".format(_text(parts[1])))
+    return codec.decode(parts[2])
+
+
 class JSONPublisher(object):
-    def __init__(self, url, topic='', hwm=1, clean_start=True):
+    def __init__(self, url, topic='', hwm=1, clean_start=True, binary=False):
         if clean_start and url.startswith('ipc://') and os.path.exists(url[6:]):
             os.remove(url[6:])
-        publisher = zmq.Context().socket(zmq.PUB)
+        publisher = _context().socket(zmq.PUB)
         publisher.set_hwm(hwm)
         publisher.bind(url)
         self._publisher = publisher
         self._topic = topic
+        # Topics without a registered schema codec remain json.
+        self._binary = binary
 
     def publish(self, data, topic=None):
         _topic = self._topic if topic is None else topic
         if data is not None:
-            data = dict((k, v) for k, v in data.items() if v is not None)
-            send_string(self._publisher, '{}:{}'.format(_topic, json.dumps(data)), zmq.NOBLOCK)
+            _stats = topic_stats(_topic)
+            codec = get_topic_codec(_topic) if self._binary else None
+            try:
+                if codec is None:
+                    data = dict((k, v) for k, v in data.items() if v is not None)
+                    send_string(self._publisher, '{}:{}'.format(_topic, json.dumps(data)), zmq.NOBLOCK)
+                else:
+                    self._publisher.send_multipart([_bytes(_topic), codec.name, codec.encode(data)], zmq.NOBLOCK)
+                _stats.on_publish()
+            except zmq.Again:
+                _stats.on_eagain()
 
 
 class ImagePublisher(object):
-    def __init__(self, url, topic='', hwm=1, clean_start=True):
+    def __init__(self, url, topic='', hwm=1, clean_start=True, shared_memory=False, num_slots=8):
         if clean_start and url.startswith('ipc://') and os.path.exists(url[6:]):
             os.remove(url[6:])
-        publisher = zmq.Context().socket(zmq.PUB)
+        publisher = _context().socket(zmq.PUB)
         publisher.set_hwm(hwm)
         publisher.bind(url)
         self._publisher = publisher
         self._topic = topic
+        # The frames are copied once into a ring of shared slots and the socket only carries a slot notification.
+        self._ring_path = ring_path(url) if (shared_memory and url.startswith('ipc://')) else None
+        self._num_slots = num_slots
+        self._ring = None
+
+    def _shared_ring(self, _img):
+        if self._ring is None or not self._ring.fits(_img):
+            self._ring = SharedFrameRing.create(self._ring_path, num_slots=self._num_slots, slot_bytes=_img.nbytes)
+            logger.info("Created frame ring '{}' with {} slots of {} bytes.".format(self._ring_path, self._num_slots, _img.nbytes))
+        return self._ring
 
     def publish(self, _img, topic=None):
-        _topic = self._topic if topic is None else topic
-        self._publisher.send_multipart([_topic,
-                                        json.dumps(dict(time=timestamp(), shape=_img.shape)),
-                                        np.ascontiguousarray(_img, dtype=np.uint8)],
-                                       flags=zmq.NOBLOCK)
+        _topic = _bytes(self._topic if topic is None else topic)
+        _stats = topic_stats(_topic)
+        _time = timestamp()
+        try:
+            if self._ring_path is None:
+                self._publisher.send_multipart([_topic,
+                                                _bytes(json.dumps(dict(time=_time, shape=_img.shape))),
+                                                np.ascontiguousarray(_img, dtype=np.uint8)],
+                                               flags=zmq.NOBLOCK)
+            else:
+                ring = self._shared_ring(_img)
+                slot, seq = ring.write(_img, _time)
+                md = dict(time=_time, shape=_img.shape, ring=dict(id=ring.get_id(), slot=slot, seq=seq))
+                self._publisher.send_multipart([_topic, _bytes(json.dumps(md))], flags=zmq.NOBLOCK)
+            _stats.on_publish()
+        except zmq.Again:
+            _stats.on_eagain()
 
 
 class JSONReceiver(object):
     def __init__(self, url, topic=b'', hwm=1, receive_timeout_ms=2, pop=False):
-        subscriber = zmq.Context().socket(zmq.SUB)
+        subscriber = _context().socket(zmq.SUB)
         subscriber.set_hwm(hwm)
         subscriber.setsockopt(zmq.RCVTIMEO, receive_timeout_ms)
         subscriber.setsockopt(zmq.LINGER, 0)
@@ -85,24 +178,62 @@ class JSONReceiver(object):
         self._subscriber = subscriber
         self._lock = threading.Lock()
         self._queue = collections.deque(maxlen=hwm)
+        self._unread = 0
+        self._same_host = is_same_host(url)
+        self._stats = topic_stats(topic)
+        self._stats.set_queue(lambda: len(self._queue), hwm)
+        self._listeners = []
+
+    def add_listener(self, c):
+        self._listeners.append(c)
+
+    def get_socket(self):
+        return self._subscriber
+
+    def _append(self, message):
+        # A message is lost when it is pushed out of the queue before anyone has looked at it.
+        if len(self._queue) == self._queue.maxlen and self._unread >= self._queue.maxlen:
+            self._stats.on_overwrite()
+        self._queue.appendleft(message)
+        self._unread = min(self._unread + 1, self._queue.maxlen)
+        self._stats.on_consume(receive_age(message, self._same_host))
+        list(map(lambda x: x(message), self._listeners))
 
     def consume(self):
         with self._lock:
             try:
                 # Does not replace local queue messages when none are available.
-                self._queue.appendleft(json.loads(receive_string(self._subscriber).split(':', 1)[1]))
+                self._append(receive_json(self._subscriber))
+            except ValueError as e:
+                logger.warning(e)
             except zmq.Again:
                 pass
 
+    def drain(self):
+        # Take all the messages that are available without blocking.
+        with self._lock:
+            while True:
+                try:
+                    self._append(receive_json(self._subscriber, zmq.NOBLOCK))
+                except ValueError as e:
+                    logger.warning(e)
+                except zmq.Again:
+                    break
+
     def get(self):
+        self._unread = 0
         _view = self._queue[0] if (self._queue and self._unpack) else list(self._queue) if self._queue else None
         if self._pop:
             self._queue.clear()
         return _view
 
     def peek(self):
+        self._unread = 0
         return self._queue[0] if self._queue else None
 
+    def close(self):
+        self._subscriber.close()
+
 
 class CollectorThread(threading.Thread):
     def __init__(self, receivers, event=None, hz=1000):
@@ -130,14 +261,132 @@ class CollectorThread(threading.Thread):
             time.sleep(self._sleep)
 
 
+class IPCHub(threading.Thread):
+    """
+    A single poller thread which serves the subscriptions of the process.
+    The thread wakes up on incoming messages only. A subscription is closed as soon as one of its events is set and the
+    thread stops once the events of all its subscriptions are set. A hub which has stopped cannot be started again.
+    """
+
+    def __init__(self, poll_timeout_ms=100):
+        super(IPCHub, self).__init__()
+        self._poll_timeout = poll_timeout_ms
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._events = []
+        self._quit_event = threading.Event()
+        self._running = False
+        self._finished = False
+
+    def register(self, receiver, *events):
+        # The subscription is done when any of its events is set.
+        with self._lock:
+            if self._finished:
+                raise RuntimeError("The hub has finished, subscriptions go to a new hub.")
+            self._pending.append((receiver, events))
+            self._events.append(events)
+
+    def is_finished(self):
+        with self._lock:
+            return self._finished or (self._running and not self.is_alive())
+
+    def start(self):
+        with self._lock:
+            if self._finished:
+                raise RuntimeError("The hub has finished and cannot be started again.")
+            if not self._running:
+                self._running = True
+                super(IPCHub, self).start()
+
+    def quit(self):
+        self._quit_event.set()
+
+    def _active(self):
+        with self._lock:
+            _done = self._quit_event.is_set() or (self._events and all(any(e.is_set() for e in _events) for _events in self._events))
+            # Decided under the lock so that no subscription is registered on a hub that is about to stop.
+            self._finished = bool(_done)
+            return not self._finished
+
+    def run(self):
+        poller = zmq.Poller()
+        receivers = {}
+        while self._active():
+            # Sockets are registered on this thread to keep their use to a single thread after creation.
+            while self._pending:
+                receiver, events = self._pending.popleft()
+                receivers[receiver.get_socket()] = (receiver, events)
+                poller.register(receiver.get_socket(), zmq.POLLIN)
+            for socket, _ in poller.poll(self._poll_timeout):
+                receivers[socket][0].drain()
+            # The subscriptions which are done release their socket while the others are still served.
+            for socket in [s for s, (_, events) in receivers.items() if any(e.is_set() for e in events)]:
+                poller.unregister(socket)
+                receivers.pop(socket)[0].close()
+        [r.close() for r, _ in receivers.values()]
+
+
+_hub_lock = threading.Lock()
+_hub = None
+
+
+def ipc_hub():
+    """
+    :return: The hub of this process - a new one when the previous has finished.
+    """
+    global _hub
+    with _hub_lock:
+        if _hub is None or _hub.is_finished():
+            _hub = IPCHub()
+        return _hub
+
+
+class HubCollector(object):
+    """
+    The collector api over a subscription served by the process hub.
+    Start and join are forwarded to the hub so the collector fits in with the service threads. On quit the hub closes the
+    subscription, a collector cannot be started again once its hub has finished.
+    """
+
+    def __init__(self, receiver, event, hub=None):
+        self._receiver = receiver
+        self._quit_event = threading.Event()
+        self._hub = ipc_hub() if hub is None else hub
+        self._hub.register(receiver, event, self._quit_event)
+
+    def start(self):
+        self._hub.start()
+
+    def join(self, timeout=None):
+        self._hub.join(timeout)
+
+    def is_alive(self):
+        return self._hub.is_alive()
+
+    def add_listener(self, c):
+        # Listeners are called from the hub thread.
+        self._receiver.add_listener(c)
+
+    # noinspection PyUnusedLocal
+    def get(self, index=0):
+        return self._receiver.get()
+
+    # noinspection PyUnusedLocal
+    def peek(self, index=0):
+        return self._receiver.peek()
+
+    def quit(self):
+        self._quit_event.set()
+
+
 def json_collector(url, topic, event, receive_timeout_ms=1000, hwm=1, pop=False):
-    return CollectorThread(JSONReceiver(url, topic, hwm=hwm, receive_timeout_ms=receive_timeout_ms, pop=pop), event=event)
+    return HubCollector(JSONReceiver(url, topic, hwm=hwm, receive_timeout_ms=receive_timeout_ms, pop=pop), event=event)
 
 
 class ReceiverThread(threading.Thread):
     def __init__(self, url, event=None, topic=b'', hwm=1, receive_timeout_ms=1):
         super(ReceiverThread, self).__init__()
-        subscriber = zmq.Context().socket(zmq.SUB)
+        subscriber = _context().socket(zmq.SUB)
         subscriber.set_hwm(hwm)
         subscriber.setsockopt(zmq.RCVTIMEO, receive_timeout_ms)
         subscriber.setsockopt(zmq.LINGER, 0)
@@ -147,14 +396,20 @@ class ReceiverThread(threading.Thread):
         self._quit_event = multiprocessing.Event() if event is None else event
         self._queue = collections.deque(maxlen=1)
         self._listeners = []
+        self._unread = False
+        self._same_host = is_same_host(url)
+        self._stats = topic_stats(topic)
+        self._stats.set_queue(lambda: len(self._queue), hwm)
 
     def add_listener(self, c):
         self._listeners.append(c)
 
     def get_latest(self):
+        self._unread = False
         return self._queue[0] if bool(self._queue) else None
 
     def pop_latest(self):
+        self._unread = False
         return self._queue.popleft() if bool(self._queue) else None
 
     def quit(self):
@@ -163,17 +418,122 @@ class ReceiverThread(threading.Thread):
     def run(self):
         while not self._quit_event.is_set():
             try:
-                _latest = json.loads(receive_string(self._subscriber).split(':', 1)[1])
+                _latest = receive_json(self._subscriber)
+                if self._unread and self._queue and not self._listeners:
+                    self._stats.on_overwrite()
                 self._queue.appendleft(_latest)
+                self._unread = True
+                self._stats.on_consume(receive_age(_latest, self._same_host))
                 list(map(lambda x: x(_latest), self._listeners))
+            except ValueError as e:
+                logger.warning(e)
             except zmq.Again:
                 pass
 
 
+class JSONPushClient(object):
+    """
+    Sender of the latest command that never blocks e.g. for the drive commands. The socket only queues on completed
+    connections and keeps just the latest message, so a message that cannot be handed over right away is dropped instead
+    of delivered late. The messages are numbered within the session of the client for the receiver to drop stale ones.
+    ZeroMQ reconnects on its own with the interval doubling up to the maximum.
+    """
+
+    def __init__(self, url, reconnect_ivl_ms=100, reconnect_ivl_max_ms=5000):
+        self._url = url
+        self._reconnect_ivl = reconnect_ivl_ms
+        self._reconnect_ivl_max = reconnect_ivl_max_ms
+        self._session = random.getrandbits(31)
+        self._sequence = 0
+        self._dropped = 0
+        self._socket = self._create()
+
+    def _create(self):
+        socket = _context().socket(zmq.PUSH)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.CONFLATE, 1)
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.setsockopt(zmq.RECONNECT_IVL, self._reconnect_ivl)
+        socket.setsockopt(zmq.RECONNECT_IVL_MAX, self._reconnect_ivl_max)
+        socket.connect(self._url)
+        return socket
+
+    def send(self, message):
+        """
+        :return: Whether the message was queued for the receiver.
+        """
+        self._sequence += 1
+        _payload = _bytes(json.dumps(dict(message, session=self._session, seq=self._sequence)))
+        try:
+            self._socket.send(_payload, zmq.NOBLOCK)
+            return True
+        except zmq.Again:
+            self._dropped += 1
+            return False
+
+    def reconnect(self):
+        self._socket.close()
+        self._socket = self._create()
+
+    def get_stats(self):
+        return dict(sent=self._sequence - self._dropped, dropped=self._dropped)
+
+    def quit(self):
+        self._socket.close()
+
+
+class JSONPullThread(threading.Thread):
+    """
+    Receiver of push clients on the bound url, see JSONPushClient. Only the latest message is kept and the messages behind
+    the latest of their session are dropped.
+    """
+
+    def __init__(self, url, event=None, receive_timeout_ms=50):
+        super(JSONPullThread, self).__init__()
+        puller = _context().socket(zmq.PULL)
+        puller.setsockopt(zmq.CONFLATE, 1)
+        puller.setsockopt(zmq.RCVTIMEO, receive_timeout_ms)
+        puller.setsockopt(zmq.LINGER, 0)
+        puller.bind(url)
+        self._puller = puller
+        self._quit_event = multiprocessing.Event() if event is None else event
+        self._queue = collections.deque(maxlen=1)
+        self._listeners = []
+        self._sequence = SequenceFilter()
+
+    def add_listener(self, c):
+        self._listeners.append(c)
+
+    def get_latest(self):
+        return self._queue[0] if bool(self._queue) else None
+
+    def pop_latest(self):
+        return self._queue.popleft() if bool(self._queue) else None
+
+    def get_stats(self):
+        return self._sequence.to_dict()
+
+    def quit(self):
+        self._quit_event.set()
+
+    def run(self):
+        while not self._quit_event.is_set():
+            try:
+                message = json.loads(_text(self._puller.recv()))
+                if self._sequence.accept(message.get('session'), message.get('seq')):
+                    self._queue.appendleft(message)
+                    list(map(lambda x: x(message), self._listeners))
+            except ValueError as e:
+                logger.warning(e)
+            except zmq.Again:
+                pass
+        self._puller.close()
+
+
 class CameraThread(threading.Thread):
     def __init__(self, url, event, topic=b'', hwm=1, receive_timeout_ms=25):
         super(CameraThread, self).__init__()
-        subscriber = zmq.Context().socket(zmq.SUB)
+        subscriber = _context().socket(zmq.SUB)
         subscriber.set_hwm(hwm)
         subscriber.setsockopt(zmq.RCVTIMEO, receive_timeout_ms)
         subscriber.setsockopt(zmq.LINGER, 0)
@@ -182,20 +542,61 @@ class CameraThread(threading.Thread):
         self._subscriber = subscriber
         self._quit_event = event
         self._images = collections.deque(maxlen=1)
+        self._ring_path = ring_path(url) if url.startswith('ipc://') else None
+        self._ring = None
+        self._unread = False
+        self._same_host = is_same_host(url)
+        self._stats = topic_stats(topic)
+        self._stats.set_queue(lambda: len(self._images), hwm)
+        self._listeners = []
+
+    def add_listener(self, c):
+        self._listeners.append(c)
+
+    def _shared_ring(self, ring_id):
+        if self._ring is None or self._ring.get_id() != ring_id:
+            self._ring = SharedFrameRing.open(self._ring_path)
+        return self._ring
 
     def capture(self):
-        return self._images[0] if bool(self._images) else (None, None)
+        """
+        Frames from a shared memory ring are read-only views which remain valid until the publisher wraps around the ring.
+        Take a copy when the image is to be kept or modified.
+        """
+        self._unread = False
+        md, img = self._images[0] if bool(self._images) else (None, None)
+        if md is not None and 'ring' in md:
+            _ring = md['ring']
+            if not self._ring.is_valid(_ring['slot'], _ring['seq']):
+                return None, None
+        return md, img
+
+    def _receive(self, parts):
+        if len(parts) == 2:
+            # Shared memory notification.
+            md = json.loads(parts[1])
+            _ring = md['ring']
+            img = self._shared_ring(_ring['id']).read(_ring['slot'], _ring['seq'])
+            if img is None:
+                raise ValueError("Frame ring slot {} was overwritten before it was read.".format(_ring['slot']))
+        else:
+            [_, md, data] = parts
+            md = json.loads(md)
+            height, width, channels = md['shape']
+            img = np.frombuffer(buffer(data), dtype=np.uint8)
+            img = img.reshape((height, width, channels))
+        if self._unread and self._images and not self._listeners:
+            self._stats.on_overwrite()
+        self._images.appendleft((md, img))
+        self._unread = True
+        self._stats.on_consume(receive_age(md, self._same_host))
+        list(map(lambda x: x(md, img), self._listeners))
 
     def run(self):
         while not self._quit_event.is_set():
             try:
-                [_, md, data] = self._subscriber.recv_multipart()
-                md = json.loads(md)
-                height, width, channels = md['shape']
-                img = np.frombuffer(buffer(data), dtype=np.uint8)
-                img = img.reshape((height, width, channels))
-                self._images.appendleft((md, img))
-            except ValueError as e:
+                self._receive(self._subscriber.recv_multipart())
+            except (ValueError, IOError, OSError) as e:
                 logger.warning(e)
             except zmq.Again:
                 pass
@@ -204,7 +605,7 @@ class CameraThread(threading.Thread):
 class JSONServerThread(threading.Thread):
     def __init__(self, url, event, hwm=1, receive_timeout_ms=50):
         super(JSONServerThread, self).__init__()
-        server = zmq.Context().socket(zmq.REP)
+        server = _context().socket(zmq.REP)
         server.set_hwm(hwm)
         server.setsockopt(zmq.RCVTIMEO, receive_timeout_ms)
         server.setsockopt(zmq.LINGER, 0)
@@ -234,8 +635,9 @@ class JSONServerThread(threading.Thread):
         while not self._quit_event.is_set():
             try:
                 message = json.loads(receive_string(self._server))
+                _received = monotonic_timestamp()
                 self.on_message(message)
-                send_string(self._server, json.dumps(self.serve(message)))
+                send_string(self._server, json.dumps(_clock_reply(message, self.serve(message), _received)))
             except zmq.Again:
                 pass
 
@@ -246,6 +648,13 @@ class LocalIPCServer(JSONServerThread):
         self._name = name
         self._m_startup = collections.deque(maxlen=1)
         self._m_capabilities = collections.deque(maxlen=1)
+        self._handlers = dict()
+
+    def register_request(self, request, fn):
+        """
+        Answer the request with the return value of fn, called with the message, under the name of this service.
+        """
+        self._handlers[request] = fn
 
     def register_start(self, errors, capabilities=None):
         capabilities = {} if capabilities is None else capabilities
@@ -254,7 +663,9 @@ class LocalIPCServer(JSONServerThread):
 
     def serve(self, message):
         try:
-            if message.get('request') == 'system/startup/list' and self._m_startup:
+            if message.get('request') in self._handlers:
+                return {self._name: self._handlers[message.get('request')](message)}
+            elif message.get('request') == 'system/startup/list' and self._m_startup:
                 ts, errors = self._m_startup[-1]
                 messages = ['No errors']
                 if errors:
@@ -264,41 +675,209 @@ class LocalIPCServer(JSONServerThread):
                 return {self._name: {ts: messages}}
             elif message.get('request') == 'system/service/capabilities' and self._m_capabilities:
                 return {self._name: self._m_capabilities[-1]}
+            elif message.get('request') == 'system/ipc/stats':
+                return {self._name: ipc_stats()}
         except IndexError:
             pass
         return {}
 
 
+def request_priority(message):
+    """
+    Introspection requests are served after everything else.
+    """
+    _name = message.get('method', message.get('request', '')) if isinstance(message, dict) else ''
+    return 1 if str(_name).startswith('system/') else 0
+
+
+class JSONRouterServerThread(threading.Thread):
+    """
+    Json server on a router socket which answers multiple clients without the lockstep of the reply socket.
+    Requests of the highest priority (zero) are served on the socket thread itself as soon as they arrive. The other requests
+    are queued by priority and served by a pool of workers so that a slow request never delays the next urgent one.
+    Listeners and serve() are therefore called from several threads.
+    The clients can be request or dealer sockets.
+    """
+
+    def __init__(self, url, event, hwm=100, receive_timeout_ms=50, workers=1, priority=request_priority):
+        super(JSONRouterServerThread, self).__init__()
+        server = _context().socket(zmq.ROUTER)
+        server.set_hwm(hwm)
+        server.setsockopt(zmq.LINGER, 0)
+        server.bind(url)
+        self._server = server
+        self._quit_event = event
+        self._poll_timeout = receive_timeout_ms
+        self._priority = priority
+        # The latest message by method or request so that e.g. a configuration does not displace a pending drive.
+        self._lock = threading.Lock()
+        self._latest = collections.OrderedDict()
+        self._listeners = []
+        # The workers hand their replies back to the socket thread.
+        self._inproc = 'inproc://json-router-{}'.format(id(self))
+        self._replies = _context().socket(zmq.PULL)
+        self._replies.bind(self._inproc)
+        self._requests = queue.PriorityQueue()
+        self._sequence = 0
+        self._workers = [threading.Thread(target=self._work) for _ in range(workers)]
+
+    def add_listener(self, c):
+        self._listeners.append(c)
+
+    def on_message(self, message):
+        _name = message.get('method', message.get('request')) if isinstance(message, dict) else None
+        with self._lock:
+            # Move the name to the end as the most recent.
+            self._latest.pop(_name, None)
+            self._latest[_name] = message
+        list(map(lambda x: x(message), self._listeners))
+
+    def _find_latest(self, name, pop):
+        with self._lock:
+            if name is None:
+                name = next(reversed(self._latest)) if bool(self._latest) else None
+            return self._latest.pop(name, None) if pop else self._latest.get(name)
+
+    def get_latest(self, name=None):
+        """
+        :param name: The method or request of the message or None for the most recent message of any.
+        """
+        return self._find_latest(name, pop=False)
+
+    def pop_latest(self, name=None):
+        return self._find_latest(name, pop=True)
+
+    def serve(self, request):
+        return {}
+
+    def _handle(self, message, received):
+        self.on_message(message)
+        return _bytes(json.dumps(_clock_reply(message, self.serve(message), received)))
+
+    def _work(self):
+        pusher = _context().socket(zmq.PUSH)
+        pusher.setsockopt(zmq.LINGER, 0)
+        pusher.connect(self._inproc)
+        while not self._quit_event.is_set():
+            try:
+                _, _, envelope, message, received = self._requests.get(timeout=self._poll_timeout * 1e-3)
+            except queue.Empty:
+                continue
+            try:
+                pusher.send_multipart(envelope + [self._handle(message, received)])
+            except Exception as e:
+                logger.warning("Request '{}' failed: {}".format(message, e))
+        pusher.close()
+
+    def _receive(self):
+        parts = self._server.recv_multipart()
+        _received = monotonic_timestamp()
+        # The envelope holds the client identity and the empty delimiter.
+        envelope, message = parts[:-1], json.loads(_text(parts[-1]))
+        _priority = self._priority(message)
+        if _priority <= 0:
+            try:
+                self._server.send_multipart(envelope + [self._handle(message, _received)])
+            except Exception as e:
+                logger.warning("Request '{}' failed: {}".format(message, e))
+        else:
+            self._sequence += 1
+            self._requests.put((_priority, self._sequence, envelope, message, _received))
+
+    def run(self):
+        [w.start() for w in self._workers]
+        poller = zmq.Poller()
+        poller.register(self._server, zmq.POLLIN)
+        poller.register(self._replies, zmq.POLLIN)
+        while not self._quit_event.is_set():
+            for socket, _ in poller.poll(self._poll_timeout):
+                try:
+                    if socket is self._server:
+                        self._receive()
+                    else:
+                        self._server.send_multipart(self._replies.recv_multipart())
+                except ValueError as e:
+                    logger.warning(e)
+        [w.join() for w in self._workers]
+        self._replies.close()
+        self._server.close()
+
+
 class JSONZmqClient(object):
-    def __init__(self, urls, hwm=1, receive_timeout_ms=200):
+    """
+    Scatter-gather client to json servers. The request is sent to all endpoints at once over one dealer socket per
+    endpoint and the replies that arrive within the overall deadline are merged. The socket of an endpoint which missed the
+    deadline is recreated so that its late reply cannot be taken for the answer to a next request.
+    With clock on the requests carry their send time and the timestamps in the replies feed an estimate of the offset of the
+    monotonic clock of each endpoint, see byodr.utils.protocol.ClockOffsetEstimator.
+    """
+
+    def __init__(self, urls, hwm=1, receive_timeout_ms=200, clock=False):
         self._urls = urls if isinstance(urls, list) else [urls]
         self._receive_timeout = receive_timeout_ms
-        self._context = None
-        self._socket = None
         self._hwm = hwm
-        self._create(self._urls)
+        self._sockets = [self._create(url) for url in self._urls]
+        self._clocks = [ClockOffsetEstimator() for _ in self._urls] if clock else None
 
-    def _create(self, locations):
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
+    def get_clock(self, index=0):
+        """
+        :return: The offset estimator of the endpoint or None when the clock is off.
+        """
+        return None if self._clocks is None else self._clocks[index]
+
+    def _create(self, url):
+        socket = _context().socket(zmq.DEALER)
         socket.set_hwm(self._hwm)
-        socket.setsockopt(zmq.RCVTIMEO, self._receive_timeout)
         socket.setsockopt(zmq.LINGER, 0)
-        [socket.connect(location) for location in locations]
-        self._context = context
-        self._socket = socket
+        socket.connect(url)
+        return socket
+
+    def _recreate(self, index):
+        self._sockets[index].close()
+        self._sockets[index] = self._create(self._urls[index])
 
     def quit(self):
-        if self._context is not None:
-            self._context.destroy()
+        # The context is shared by the process and stays.
+        [socket.close() for socket in self._sockets]
+        self._sockets = []
+
+    def _on_clock(self, index, t0, reply):
+        _clock = reply.pop('clock', None) if isinstance(reply, dict) else None
+        if self._clocks is not None and _clock is not None:
+            self._clocks[index].add(t0, _clock[0], _clock[1], monotonic_timestamp())
+        return reply
 
     def call(self, message):
-        ret = {}
-        for i in range(len(self._urls)):
+        _t0 = monotonic_timestamp()
+        if self._clocks is not None:
+            message = dict(message, clock=_t0)
+        payload = _bytes(json.dumps(message))
+        poller = zmq.Poller()
+        waiting = dict()
+        for i, socket in enumerate(self._sockets):
             try:
-                send_string(self._socket, json.dumps(message), zmq.NOBLOCK)
-                ret.update(json.loads(receive_string(self._socket)))
-            except zmq.ZMQError:
-                j = i + 1
-                self._create(self._urls[j:] + self._urls[:j])
+                # The empty delimiter frame makes the dealer compatible with reply sockets.
+                socket.send_multipart([b'', payload], zmq.NOBLOCK)
+                poller.register(socket, zmq.POLLIN)
+                waiting[socket] = i
+            except zmq.Again:
+                self._recreate(i)
+        replies = dict()
+        deadline = monotonic() + self._receive_timeout * 1e-3
+        while waiting:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            for socket, _ in poller.poll(remaining * 1e3):
+                parts = socket.recv_multipart()
+                _index = waiting.pop(socket)
+                poller.unregister(socket)
+                try:
+                    replies[_index] = self._on_clock(_index, _t0, json.loads(_text(parts[-1])))
+                except ValueError as e:
+                    logger.warning("Malformed reply from '{}': {}".format(self._urls[_index], e))
+                    self._recreate(_index)
+        [self._recreate(i) for i in waiting.values()]
+        ret = {}
+        [ret.update(replies[i]) for i in sorted(replies.keys())]
         return ret
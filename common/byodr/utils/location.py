@@ -3,6 +3,8 @@ import collections
 import cachetools
 from geographiclib.geodesic import Geodesic
 
+from byodr.utils import monotonic
+
 
 def _distance_bearing(from_position, to_position):
     c_latitude, c_longitude = to_position
@@ -21,7 +23,7 @@ class GeoTracker(object):
     def __init__(self, cache_ttl=10.0, min_distance_meters=0.10):
         self._min_distance = min_distance_meters
         self._positions = collections.deque(maxlen=8)
-        self._cache = cachetools.TTLCache(maxsize=100, ttl=cache_ttl)
+        self._cache = cachetools.TTLCache(maxsize=100, ttl=cache_ttl, timer=monotonic)
 
     def _begin(self, current):
         n_positions = len(self._positions)
@@ -0,0 +1,213 @@
+from __future__ import absolute_import
+
+import bisect
+import collections
+import threading
+import time
+
+# Bucket upper bounds in milliseconds - the last bucket counts everything above.
+DEFAULT_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """
+    Fixed size histogram of values e.g. latencies. Memory use does not grow with the number of recorded values.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS_MS):
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def record(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._min = value if self._min is None else min(self._min, value)
+        self._max = value if self._max is None else max(self._max, value)
+
+    def get_count(self):
+        return self._count
+
+    def get_mean(self):
+        return self._sum / self._count if self._count else None
+
+    def percentile(self, p):
+        """
+        :return: The upper bound of the bucket which holds the p-th percentile or the maximum for the overflow bucket.
+        """
+        if self._count == 0:
+            return None
+        rank = p / 100.0 * self._count
+        total = 0
+        for i, n in enumerate(self._counts):
+            total += n
+            if total >= rank and n > 0:
+                return self._bounds[i] if i < len(self._bounds) else self._max
+        return self._max
+
+    def reset(self):
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count, self._sum, self._min, self._max = 0, 0.0, None, None
+
+    def to_dict(self):
+        return dict(
+            count=self._count,
+            mean=(self._sum / self._count if self._count else None),
+            min=self._min,
+            max=self._max,
+            p50=self.percentile(50),
+            p99=self.percentile(99),
+            bounds=list(self._bounds),
+            buckets=list(self._counts),
+        )
+
+
+class TopicStats(object):
+    """
+    The telemetry of one topic in this process as publisher or as consumer.
+    The age is the time between the embedded message timestamp and the moment of consumption.
+    Jitter is the absolute difference between two consecutive inter-arrival times.
+    The queue length is the number of messages held by the receiver at the time of the report, next to its high water mark.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._age = Histogram()
+        self._jitter = Histogram()
+        self._published = 0
+        self._consumed = 0
+        self._eagain = 0
+        self._overwritten = 0
+        self._last_arrival = None
+        self._last_interval = None
+        self._depth = None
+        self._hwm = None
+        self._started = time.time()
+
+    def on_publish(self):
+        with self._lock:
+            self._published += 1
+
+    def on_eagain(self):
+        with self._lock:
+            self._eagain += 1
+
+    def on_overwrite(self):
+        with self._lock:
+            self._overwritten += 1
+
+    def set_queue(self, depth, hwm):
+        """
+        :param depth: Callable which returns the number of messages in the queue of the receiver.
+        :param hwm: The high water mark of the receiver.
+        """
+        with self._lock:
+            self._depth = depth
+            self._hwm = hwm
+
+    def on_consume(self, age=None):
+        """
+        :param age: The age of the message at consumption in microseconds, see byodr.utils.message_age.
+        """
+        _now = time.time()
+        with self._lock:
+            self._consumed += 1
+            if age is not None:
+                self._age.record(max(0.0, age * 1e-3))
+            if self._last_arrival is not None:
+                interval = _now - self._last_arrival
+                if self._last_interval is not None:
+                    self._jitter.record(abs(interval - self._last_interval) * 1e3)
+                self._last_interval = interval
+            self._last_arrival = _now
+
+    def to_dict(self):
+        with self._lock:
+            _duration = max(1e-3, time.time() - self._started)
+            return dict(
+                published=self._published,
+                consumed=self._consumed,
+                publish_rate=self._published / _duration,
+                consume_rate=self._consumed / _duration,
+                drops_eagain=self._eagain,
+                drops_overwritten=self._overwritten,
+                queue_length=(None if self._depth is None else self._depth()),
+                queue_hwm=self._hwm,
+                age_ms=self._age.to_dict(),
+                jitter_ms=self._jitter.to_dict(),
+            )
+
+
+class CommandLatency(object):
+    """
+    The latency of commands from their origin to the confirmation of their actuation, by correlation id.
+    A command collects the timestamps of the services it passes as hops i.e. [[name, microseconds], ..]. The total is the
+    time from the first hop to the arrival of the confirmation, both on the clock of the origin. The time between two
+    consecutive hops on different hosts includes the offset between their clocks.
+    """
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        # Only the first confirmation of a command counts - later ones are of the same command applied again.
+        self._recent = collections.deque(maxlen=window)
+        self._seen = set()
+        self._total = Histogram()
+        self._hops = collections.OrderedDict()
+
+    def on_confirmation(self, cid, hops, received=None):
+        """
+        :return: The total latency in milliseconds or None when the command was seen before.
+        """
+        _received = time.time() * 1e6 if received is None else received
+        with self._lock:
+            if cid is None or not hops or cid in self._seen:
+                return None
+            if len(self._recent) == self._recent.maxlen:
+                self._seen.discard(self._recent[0])
+            self._recent.append(cid)
+            self._seen.add(cid)
+            for (a, t0), (b, t1) in zip(hops[:-1], hops[1:]):
+                _key = "{} > {}".format(a, b)
+                if _key not in self._hops:
+                    self._hops[_key] = Histogram()
+                self._hops[_key].record((t1 - t0) * 1e-3)
+            _total = (_received - hops[0][1]) * 1e-3
+            self._total.record(_total)
+            return _total
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                total_ms=self._total.to_dict(),
+                hops_ms=collections.OrderedDict(
+                    (k, h.to_dict()) for k, h in self._hops.items()
+                ),
+            )
+
+
+_lock = threading.Lock()
+_topics = dict()
+
+
+def topic_stats(topic, consumer=None):
+    """
+    :param consumer: The name of a receiver with its own subscription to a topic which has more than one in the process - each
+    receiver gets every message so the counts and the jitter of the receivers are kept apart e.g. 'aav/pilot/output@websocket'.
+    :return: The statistics of the topic in this process - created on first use.
+    """
+    topic = topic.decode("utf-8") if isinstance(topic, bytes) else topic
+    topic = topic if consumer is None else "{}@{}".format(topic, consumer)
+    with _lock:
+        if topic not in _topics:
+            _topics[topic] = TopicStats()
+        return _topics[topic]
+
+
+def ipc_stats():
+    with _lock:
+        _items = list(_topics.items())
+    return dict((topic, stats.to_dict()) for topic, stats in _items)
@@ -0,0 +1,209 @@
+"""
+Profiling of a running service on request e.g. from teleop through the ipc server of the service.
+The deterministic mode runs cProfile on the application thread only - the profiler hooks the thread that enables it - and
+saves the stats for pstats or snakeviz. The sampling mode takes the stacks of all threads of the process at a fixed rate,
+with an overhead independent of the number of calls, and saves them in the folded format of the flamegraph tools.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from cProfile import Profile
+
+logger = logging.getLogger(__name__)
+
+MODE_DETERMINISTIC = "deterministic"
+MODE_SAMPLING = "sampling"
+
+# The number of functions in the summary of a profile.
+_TOP = 20
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """
+    Counts the distinct stacks of the other threads of the process, sampled at the frequency.
+    """
+
+    def __init__(self, hz=100):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self._period = 1.0 / hz
+        self._running = True
+        self._stacks = collections.Counter()
+        self._n_samples = 0
+
+    def run(self):
+        _own = threading.current_thread().ident
+        while self._running:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident != _own:
+                    self._stacks[(names.get(ident, str(ident)),) + _stack(frame)] += 1
+            self._n_samples += 1
+            time.sleep(self._period)
+
+    def quit(self):
+        self._running = False
+        self.join()
+
+    def get_num_samples(self):
+        return self._n_samples
+
+    def write_folded(self, path):
+        with open(path, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write("{} {}\n".format(";".join(stack), count))
+
+    def summary(self):
+        # The share of samples in which a function is running (self) or on the stack (inclusive).
+        _self, _inclusive = collections.Counter(), collections.Counter()
+        for stack, count in self._stacks.items():
+            if len(stack) > 1:
+                _self[stack[-1]] += count
+            for name in set(stack[1:]):
+                _inclusive[name] += count
+        _total = float(max(1, sum(self._stacks.values())))
+        return dict(
+            samples=self._n_samples,
+            self=[(name, round(n / _total, 4)) for name, n in _self.most_common(_TOP)],
+            inclusive=[
+                (name, round(n / _total, 4)) for name, n in _inclusive.most_common(_TOP)
+            ],
+        )
+
+
+def _profile_summary(profile):
+    _stats = pstats.Stats(profile).stats
+    _rows = sorted(_stats.items(), key=lambda x: -x[1][2])[:_TOP]
+    # Function as file:line(name) with the number of calls, self time and cumulative time in milliseconds.
+    return dict(
+        functions=[
+            (
+                "{}:{}({})".format(os.path.basename(f), line, name),
+                nc,
+                round(tt * 1e3, 3),
+                round(ct * 1e3, 3),
+            )
+            for (f, line, name), (cc, nc, tt, ct, callers) in _rows
+        ]
+    )
+
+
+class ProfileSession(object):
+    """
+    Start and stop a profile of the running process. The application thread calls attach() every step so that the
+    deterministic profiler is enabled and disabled on that thread.
+    """
+
+    def __init__(self, name="application", directory=None, timeout=2.0):
+        self._lock = threading.Lock()
+        self._name = name
+        self._directory = tempfile.gettempdir() if directory is None else directory
+        self._timeout = timeout
+        self._mode = None
+        self._started = None
+        self._sampler = None
+        # The profile that should be enabled and the one that is enabled on the attached thread.
+        self._profile = None
+        self._attached = None
+        self._detached = threading.Event()
+
+    def is_active(self):
+        return self._mode is not None
+
+    def attach(self):
+        _profile = self._profile
+        if _profile is not self._attached:
+            if self._attached is not None:
+                self._attached.disable()
+                self._detached.set()
+            if _profile is not None:
+                _profile.enable()
+            self._attached = _profile
+
+    def start(self, mode=MODE_DETERMINISTIC, hz=100):
+        with self._lock:
+            if self._mode is not None:
+                return dict(error="A {} profile is already running.".format(self._mode))
+            if mode == MODE_SAMPLING:
+                self._sampler = StackSampler(hz=hz)
+                self._sampler.start()
+            elif mode == MODE_DETERMINISTIC:
+                self._detached.clear()
+                self._profile = Profile()
+            else:
+                return dict(error="Unknown profile mode '{}'.".format(mode))
+            self._mode = mode
+            self._started = time.time()
+            logger.info("Started a {} profile.".format(mode))
+            return dict(mode=mode, started=self._started)
+
+    def stop(self):
+        """
+        :return: The location of the saved profile and a summary of the functions that take the most time.
+        """
+        with self._lock:
+            if self._mode is None:
+                return dict(error="There is no profile running.")
+            _mode, _duration = self._mode, time.time() - self._started
+            _path = os.path.join(
+                self._directory,
+                "{}-{}".format(self._name, time.strftime("%Y%m%dT%H%M%S")),
+            )
+            result = dict(mode=_mode, duration=round(_duration, 3))
+            try:
+                if _mode == MODE_SAMPLING:
+                    self._sampler.quit()
+                    result["file"] = _path + ".folded"
+                    self._sampler.write_folded(result["file"])
+                    result.update(self._sampler.summary())
+                else:
+                    _profile, self._profile = self._profile, None
+                    # The profile can only be disabled by the thread it runs on.
+                    if not self._detached.wait(self._timeout):
+                        result["error"] = "The profiled thread did not respond."
+                        return result
+                    result["file"] = _path + ".stats"
+                    _profile.dump_stats(result["file"])
+                    result.update(_profile_summary(_profile))
+            except (IOError, OSError) as e:
+                result["error"] = str(e)
+            finally:
+                self._mode, self._sampler = None, None
+            logger.info(
+                "Stopped the {} profile after {:2.1f} seconds.".format(_mode, _duration)
+            )
+            return result
+
+
+def register_profiler(server, session):
+    """
+    Serve the start and stop requests of the profile session on the ipc server.
+    """
+    server.register_request(
+        "system/profile/start",
+        lambda m: session.start(
+            mode=m.get("mode", MODE_DETERMINISTIC), hz=m.get("hz", 100)
+        ),
+    )
+    server.register_request("system/profile/stop", lambda m: session.stop())
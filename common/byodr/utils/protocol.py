@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
-from byodr.utils import timestamp
+import collections
+import threading
+
+from byodr.utils import monotonic_timestamp
 
 
 class MessageStreamProtocol(object):
@@ -11,7 +14,7 @@ class MessageStreamProtocol(object):
         Because the clocks are not synced remote and local timestamps are not directly comparable.
         Timestamps:
         1. remote as reported by the sender
-        2. local as recorded by the receiver
+        2. local as recorded by the receiver, on the monotonic clock so that time adjustments do not count as delays
         -
         The protocol can be validated or invalidated.
         There is a warm-up period with invalidated protocol, after system reboot.
@@ -42,7 +45,7 @@ class MessageStreamProtocol(object):
 
     def on_message(self, message_timestamp_micro):
         # This is our time in microseconds.
-        local_time = timestamp()
+        local_time = monotonic_timestamp()
         if local_time - self._last_protocol_time > self._max_delay_micro:
             self._violation()
         elif message_timestamp_micro - self._last_message_time > self._max_age_micro:
@@ -53,6 +56,86 @@ class MessageStreamProtocol(object):
         self._last_protocol_time = local_time
 
     def check(self):
-        if timestamp() - self._last_protocol_time > self._max_delay_micro:
+        if monotonic_timestamp() - self._last_protocol_time > self._max_delay_micro:
             self._violation()
         return self._n_violations
+
+
+class SequenceFilter(object):
+    """
+    Latest wins for a stream of numbered messages. A message is accepted when its number is ahead of the last accepted one
+    of the same session and a new session, e.g. of a restarted sender, starts over. The skipped numbers count as lost.
+    """
+
+    def __init__(self):
+        self._session = None
+        self._sequence = None
+        self._accepted = 0
+        self._stale = 0
+        self._lost = 0
+
+    def accept(self, session, sequence):
+        if sequence is None:
+            return True
+        if session != self._session or self._sequence is None:
+            self._session = session
+        elif sequence <= self._sequence:
+            self._stale += 1
+            return False
+        else:
+            self._lost += sequence - self._sequence - 1
+        self._sequence = sequence
+        self._accepted += 1
+        return True
+
+    def to_dict(self):
+        return dict(accepted=self._accepted, stale=self._stale, lost=self._lost)
+
+
+class ClockOffsetEstimator(object):
+    """
+    Offset of a remote clock from request and reply timestamps as in ntp. The request leaves at t0 and arrives at t1, the
+    reply leaves at t2 and arrives at t3 - t0 and t3 on the local clock and t1 and t2 on the remote clock.
+        offset = ((t1 - t0) + (t2 - t3)) / 2    remote minus local
+        delay = (t3 - t0) - (t2 - t1)           the round trip on the wire
+    The offset is exact when both legs take equally long. Queueing makes the legs asymmetric so the estimate is the offset of
+    the exchange with the smallest delay in the window.
+    """
+
+    def __init__(self, window=32):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=window)
+        self._offset = None
+        self._delay = None
+
+    def add(self, t0, t1, t2, t3):
+        _offset = ((t1 - t0) + (t2 - t3)) / 2.
+        _delay = (t3 - t0) - (t2 - t1)
+        with self._lock:
+            self._samples.append((max(0, _delay), _offset))
+            self._delay, self._offset = min(self._samples)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._offset, self._delay = None, None
+
+    def get_offset(self):
+        """
+        :return: The remote minus the local time in microseconds or None without samples.
+        """
+        return self._offset
+
+    def get_delay(self):
+        return self._delay
+
+    def to_local(self, remote_time):
+        """
+        :return: The remote time on the local clock or None when the offset is not known yet.
+        """
+        _offset = self._offset
+        return None if (_offset is None or remote_time is None) else remote_time - _offset
+
+    def to_dict(self):
+        with self._lock:
+            return dict(offset_us=self._offset, delay_us=self._delay, samples=len(self._samples))
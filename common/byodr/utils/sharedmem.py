@@ -0,0 +1,169 @@
+"""
+Frame rings in shared memory between the processes on one host. A ring is a file next to the ipc socket that it goes with
+and is memory mapped by the publisher and the receivers. The directory has to be in memory for this to be shared memory
+instead of file io - in docker-compose.yml the volume of the sockets at /byodr is a tmpfs for this reason. A ring on a
+disk backed volume still works but the kernel writes the dirty pages of every frame back to the disk.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import struct
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"BYODRRNG"
+# Magic, version, number of slots, slot data size in bytes and the ring identifier.
+_RING_HEADER = struct.Struct("<8sIIQ16s")
+_RING_HEADER_SIZE = 64
+# Sequence, time, height, width, channels and the number of bytes in use.
+_SLOT_HEADER = struct.Struct("<QqIIIQ")
+_SLOT_HEADER_SIZE = 64
+_ALIGNMENT = 64
+
+
+def _aligned(n):
+    return ((n + _ALIGNMENT - 1) // _ALIGNMENT) * _ALIGNMENT
+
+
+def ring_path(url):
+    """
+    The location of the frame ring that accompanies an ipc socket url e.g. ipc:///byodr/camera_0.sock.
+    The ring file is placed next to the socket so that it is shared through the same volume, which is to be a tmpfs.
+    """
+    assert url.startswith("ipc://"), "Shared memory is only available for ipc urls."
+    return url[6:] + ".ring"
+
+
+class SharedFrameRing(object):
+    """
+    A fixed number of preallocated frame slots in a memory mapped file.
+    Every slot carries a seqlock header. The writer makes the sequence odd while the slot is being written and even again
+    when done. Readers accept a slot only when the sequence equals the one from the notification.
+    A slot remains valid until the writer wraps around the ring, which is after num_slots - 1 subsequent frames.
+    """
+
+    def __init__(self, path, mm, num_slots, slot_bytes, ring_id, writable):
+        self._path = path
+        self._mm = mm
+        self._num_slots = num_slots
+        self._slot_bytes = slot_bytes
+        self._ring_id = ring_id
+        self._writable = writable
+        self._count = 0
+        self._sequences = [0] * num_slots
+
+    @staticmethod
+    def _file_size(num_slots, slot_bytes):
+        return _RING_HEADER_SIZE + num_slots * (
+            _SLOT_HEADER_SIZE + _aligned(slot_bytes)
+        )
+
+    @classmethod
+    def create(cls, path, num_slots, slot_bytes):
+        ring_id = uuid.uuid4().hex[:16].encode("ascii")
+        size = cls._file_size(num_slots, slot_bytes)
+        # Write to a new file and move it in place so readers never see a partially initialized ring.
+        _tmp = "{}.{}".format(path, os.getpid())
+        with open(_tmp, "wb") as f:
+            f.truncate(size)
+            f.write(_RING_HEADER.pack(_MAGIC, 1, num_slots, slot_bytes, ring_id))
+        os.rename(_tmp, path)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        return cls(path, mm, num_slots, slot_bytes, ring_id, writable=True)
+
+    @classmethod
+    def open(cls, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, version, num_slots, slot_bytes, ring_id = _RING_HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or version != 1:
+            raise ValueError("The file '{}' is not a frame ring.".format(path))
+        return cls(path, mm, num_slots, slot_bytes, ring_id, writable=False)
+
+    def _slot_offset(self, slot):
+        return _RING_HEADER_SIZE + slot * (
+            _SLOT_HEADER_SIZE + _aligned(self._slot_bytes)
+        )
+
+    def get_path(self):
+        return self._path
+
+    def get_id(self):
+        return self._ring_id.decode("ascii")
+
+    def get_num_slots(self):
+        return self._num_slots
+
+    def get_slot_bytes(self):
+        return self._slot_bytes
+
+    def fits(self, image):
+        return image.nbytes <= self._slot_bytes
+
+    def write(self, image, ts):
+        """
+        Copy the image into the next slot.
+        :return: The slot index and the sequence number for the notification.
+        """
+        assert self._writable, "The ring is opened read-only."
+        slot = self._count % self._num_slots
+        offset = self._slot_offset(slot)
+        seq = self._sequences[slot]
+        height, width, channels = image.shape
+        # Odd marks the slot as being written.
+        _SLOT_HEADER.pack_into(
+            self._mm, offset, seq + 1, ts, height, width, channels, image.nbytes
+        )
+        _view = np.ndarray(
+            shape=image.shape,
+            dtype=np.uint8,
+            buffer=self._mm,
+            offset=offset + _SLOT_HEADER_SIZE,
+        )
+        np.copyto(_view, image, casting="unsafe")
+        seq += 2
+        _SLOT_HEADER.pack_into(
+            self._mm, offset, seq, ts, height, width, channels, image.nbytes
+        )
+        self._sequences[slot] = seq
+        self._count += 1
+        return slot, seq
+
+    def is_valid(self, slot, seq):
+        return _SLOT_HEADER.unpack_from(self._mm, self._slot_offset(slot))[0] == seq
+
+    def read(self, slot, seq):
+        """
+        :return: A read-only view on the slot data or None when the slot was overwritten in the mean time.
+        """
+        if slot < 0 or slot >= self._num_slots:
+            return None
+        offset = self._slot_offset(slot)
+        _seq, _, height, width, channels, _ = _SLOT_HEADER.unpack_from(self._mm, offset)
+        if _seq != seq:
+            return None
+        view = np.ndarray(
+            shape=(height, width, channels),
+            dtype=np.uint8,
+            buffer=self._mm,
+            offset=offset + _SLOT_HEADER_SIZE,
+        )
+        view.flags.writeable = False
+        return view
+
+    def close(self):
+        # Views on the map could still be alive in the consumer - leave the unmapping to the garbage collector.
+        self._mm = None
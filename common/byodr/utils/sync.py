@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+
+import bisect
+import threading
+
+
+def _message_time(message):
+    return None if message is None else message.get("time")
+
+
+class TimeSeries(object):
+    """
+    Bounded buffer of messages kept in order of their time field. Lookups by time are bisections.
+    Messages normally arrive in order and are appended - the occasional late one is inserted at its place.
+    """
+
+    def __init__(self, maxlen=100):
+        self._maxlen = maxlen
+        self._times = []
+        self._messages = []
+
+    def __len__(self):
+        return len(self._times)
+
+    def add(self, message):
+        ts = _message_time(message)
+        if ts is None:
+            return
+        if not self._times or ts >= self._times[-1]:
+            self._times.append(ts)
+            self._messages.append(message)
+        else:
+            i = bisect.bisect_right(self._times, ts)
+            self._times.insert(i, ts)
+            self._messages.insert(i, message)
+        if len(self._times) > self._maxlen:
+            _excess = len(self._times) - self._maxlen
+            del self._times[:_excess]
+            del self._messages[:_excess]
+
+    def latest(self):
+        return self._messages[-1] if self._messages else None
+
+    def _around(self, ts):
+        # The positions of the messages just before and at or after the time.
+        i = bisect.bisect_left(self._times, ts)
+        return i - 1, i
+
+    def nearest(self, ts, tolerance=None):
+        """
+        :return: The message closest in time or None when there is none within the tolerance.
+        """
+        if not self._times:
+            return None
+        _before, _after = self._around(ts)
+        candidates = [i for i in (_before, _after) if 0 <= i < len(self._times)]
+        best = min(candidates, key=lambda i: abs(self._times[i] - ts))
+        if tolerance is not None and abs(self._times[best] - ts) > tolerance:
+            return None
+        return self._messages[best]
+
+    def since(self, start, end=None):
+        """
+        :return: The messages with start < time <= end.
+        """
+        i = 0 if start is None else bisect.bisect_right(self._times, start)
+        j = len(self._times) if end is None else bisect.bisect_right(self._times, end)
+        return [self._messages[k] for k in range(i, j)]
+
+    def interpolate(self, ts, fields, tolerance=None):
+        """
+        Linear interpolation of numeric fields between the messages around the time.
+        Outside of the recorded range the nearest message is used as is.
+        :return: Dictionary with the time and the interpolated fields or None when there is no message within the tolerance.
+        """
+        _nearest = self.nearest(ts, tolerance)
+        if _nearest is None:
+            return None
+        _before, _after = self._around(ts)
+        if _before < 0 or _after >= len(self._times) or self._times[_after] == ts:
+            return dict([("time", ts)] + [(f, _nearest.get(f)) for f in fields])
+        t0, t1 = self._times[_before], self._times[_after]
+        m0, m1 = self._messages[_before], self._messages[_after]
+        alpha = float(ts - t0) / (t1 - t0)
+        result = dict(time=ts)
+        for field in fields:
+            v0, v1 = m0.get(field), m1.get(field)
+            if (
+                isinstance(v0, (int, float))
+                and isinstance(v1, (int, float))
+                and not isinstance(v0, bool)
+            ):
+                result[field] = v0 + alpha * (v1 - v0)
+            else:
+                result[field] = _nearest.get(field)
+        return result
+
+
+class Synchronizer(object):
+    """
+    Time alignment of several topics e.g. the pilot, vehicle and inference messages around the time of a camera frame.
+    Thread-safe - messages are typically added from the ipc threads and looked up from an application thread.
+    """
+
+    def __init__(self, topics, maxlen=100):
+        self._lock = threading.Lock()
+        self._topics = tuple(topics)
+        self._series = dict((topic, TimeSeries(maxlen=maxlen)) for topic in topics)
+        # The time of the newest message taken per topic and reader.
+        self._taken = dict()
+
+    def add(self, topic, message):
+        with self._lock:
+            self._series[topic].add(message)
+
+    def listener(self, topic):
+        """
+        :return: A callable to register as listener of the topic receiver.
+        """
+        return lambda message: self.add(topic, message)
+
+    def latest(self, topic):
+        with self._lock:
+            return self._series[topic].latest()
+
+    def nearest(self, topic, ts, tolerance=None):
+        with self._lock:
+            return self._series[topic].nearest(ts, tolerance)
+
+    def take(self, topic, reader, start=None):
+        """
+        Deliver each message of the topic once to the reader.
+        :param start: Where a new reader begins - after this time or with all the messages.
+        :return: The messages newer than the ones taken before by the reader.
+        """
+        with self._lock:
+            _key = (topic, reader)
+            messages = self._series[topic].since(self._taken.get(_key, start))
+            if messages:
+                self._taken[_key] = messages[-1].get("time")
+            return messages
+
+    def since(self, topic, start, end=None):
+        with self._lock:
+            return self._series[topic].since(start, end)
+
+    def interpolate(self, topic, ts, fields, tolerance=None):
+        with self._lock:
+            return self._series[topic].interpolate(ts, fields, tolerance)
+
+    def join(self, ts, tolerance=None, topics=None):
+        """
+        :return: The nearest message of each topic, in the order of the topics.
+        """
+        with self._lock:
+            _topics = self._topics if topics is None else topics
+            return tuple(
+                self._series[topic].nearest(ts, tolerance) for topic in _topics
+            )
@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 import collections
+import contextlib
+
 from six.moves import map
 
+from byodr.utils import ManualClock, set_clock
+
 
 class QueueReceiver(object):
     def __init__(self, queue_max_size=100):
@@ -138,3 +142,18 @@ class CollectJSONClient(object):
 
     def quit(self):
         self.clear()
+
+
+@contextlib.contextmanager
+def virtual_clock(start=None):
+    """
+    Replace the process clock with a manual clock for the duration of the block e.g.
+        with virtual_clock() as clock:
+            application.step_for(100)
+    """
+    clock = ManualClock(start=start)
+    _previous = set_clock(clock)
+    try:
+        yield clock
+    finally:
+        set_clock(_previous)
@@ -0,0 +1,157 @@
+"""
+Lightweight tracing of the phases of the steps e.g.
+    with span('pilot/driver'):
+        ...
+The spans are recorded in a ring buffer of preallocated records per process, so tracing allocates nothing in the hot
+paths. The recent spans are served on request and can be merged into a chrome trace for chrome://tracing or perfetto.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+import threading
+import time
+
+from six.moves import _thread
+
+
+class SpanRecord(object):
+    """
+    A slot of the ring buffer which is also the context manager of the span it records.
+    """
+
+    __slots__ = ("name", "thread", "start", "end")
+
+    def __init__(self):
+        self.name = None
+        self.thread = None
+        self.start = 0.0
+        self.end = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.time()
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """
+    The records are overwritten in order once the capacity is reached. A span that is still open when its record is
+    reused is lost, which only happens for spans that last longer than the capacity worth of other spans.
+    """
+
+    def __init__(self, capacity=4096):
+        self._capacity = capacity
+        self._records = [SpanRecord() for _ in range(capacity)]
+        # The next value of a count is atomic under the interpreter lock.
+        self._counter = itertools.count()
+        self.enabled = True
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        record = self._records[next(self._counter) % self._capacity]
+        record.name = name
+        record.thread = _thread.get_ident()
+        record.start, record.end = 0.0, 0.0
+        return record
+
+    def recent(self, since=None):
+        """
+        :param since: Only the spans that started after this time in microseconds.
+        :return: The completed spans as name, start and duration in microseconds and thread name in order of start.
+        """
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        _since = 0 if since is None else since * 1e-6
+        spans = []
+        for record in self._records:
+            name, thread, start, end = (
+                record.name,
+                record.thread,
+                record.start,
+                record.end,
+            )
+            if start > _since and end >= start:
+                spans.append(
+                    (
+                        name,
+                        int(start * 1e6),
+                        int((end - start) * 1e6),
+                        names.get(thread, str(thread)),
+                    )
+                )
+        spans.sort(key=lambda x: x[1])
+        return spans
+
+
+_TRACER = Tracer()
+
+
+def get_tracer():
+    return _TRACER
+
+
+def span(name):
+    return _TRACER.span(name)
+
+
+def register_tracer(server, tracer=None):
+    """
+    Serve the recent spans of the process on the ipc server.
+    """
+    tracer = _TRACER if tracer is None else tracer
+    server.register_request(
+        "system/trace/spans", lambda m: tracer.recent(since=m.get("since"))
+    )
+
+
+def chrome_trace(spans_by_service):
+    """
+    :param spans_by_service: The recent spans by service name.
+    :return: The spans as complete events of the chrome trace format with a process per service and their threads.
+    """
+    events = []
+    for pid, service in enumerate(sorted(spans_by_service.keys())):
+        events.append(
+            dict(name="process_name", ph="M", pid=pid, tid=0, args=dict(name=service))
+        )
+        threads = dict()
+        for name, start, duration, thread in spans_by_service[service]:
+            if thread not in threads:
+                threads[thread] = len(threads) + 1
+                events.append(
+                    dict(
+                        name="thread_name",
+                        ph="M",
+                        pid=pid,
+                        tid=threads[thread],
+                        args=dict(name=thread),
+                    )
+                )
+            events.append(
+                dict(
+                    name=name,
+                    ph="X",
+                    ts=start,
+                    dur=duration,
+                    pid=pid,
+                    tid=threads[thread],
+                )
+            )
+    return dict(traceEvents=events, displayTimeUnit="ms")
@@ -2,12 +2,13 @@ from __future__ import absolute_import
 
 import json
 import logging
-import threading
 import traceback
 
 import gi
 from tornado import websocket
 
+from byodr.utils.h264 import stream_hub
+
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 
@@ -17,26 +18,14 @@ logger = logging.getLogger(__name__)
 
 
 class HttpLivePlayerVideoSocket(websocket.WebSocketHandler):
-    def __init__(self, application, request, **kwargs):
-        super(HttpLivePlayerVideoSocket, self).__init__(application, request, **kwargs)
-        self._lock = threading.Lock()
-        self._streaming = False
+    """
+    The client asks for the stream to start and stop, see byodr.utils.h264 for the fan out.
+    """
 
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
         self._video = kwargs.get('video_source')
-        self._io_loop = kwargs.get('io_loop')
-
-    def _push(self, _bytes):
-        with self._lock:
-            if self._streaming:
-                try:
-                    self.write_message(_bytes, binary=True)
-                except websocket.WebSocketClosedError:
-                    pass
-
-    def _client(self, _bytes):
-        self._io_loop.add_callback(lambda: self._push(_bytes))
+        self._hub = kwargs.get('hub') or stream_hub(self._video, kwargs.get('io_loop'))
 
     # noinspection PyUnusedLocal
     @staticmethod
@@ -48,17 +37,19 @@ class HttpLivePlayerVideoSocket(websocket.WebSocketHandler):
 
     # noinspection PyUnusedLocal
     def open(self, *args, **kwargs):
-        self._video.add_listener(self._client)
         self.write_message(json.dumps(dict(action='init', width=self._video.get_width(), height=self._video.get_height())))
 
     def on_close(self):
-        self._video.remove_listener(self._client)
+        self._hub.leave(self)
 
     def on_message(self, message):
         try:
-            with self._lock:
-                self._streaming = 'REQUESTSTREAM' in message
-                logger.info("On message - streaming = {}.".format(self._streaming))
+            _streaming = 'REQUESTSTREAM' in message
+            if _streaming:
+                self._hub.join(self)
+            else:
+                self._hub.leave(self)
+            logger.info("On message - streaming = {}.".format(_streaming))
         except Exception as e:
             logger.error("Stream socket@on_message: {} {}".format(e, traceback.format_exc()))
             logger.error("Input message:---\n{}\n---".format(message))
@@ -68,16 +59,7 @@ class JMuxerVideoStreamSocket(websocket.WebSocketHandler):
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
         self._video = kwargs.get('video_source')
-        self._io_loop = kwargs.get('io_loop')
-
-    def _push(self, _bytes):
-        try:
-            self.write_message(_bytes, binary=True)
-        except websocket.WebSocketClosedError:
-            pass
-
-    def _client(self, _bytes):
-        self._io_loop.add_callback(lambda: self._push(_bytes))
+        self._hub = kwargs.get('hub') or stream_hub(self._video, kwargs.get('io_loop'))
 
     # noinspection PyUnusedLocal
     @staticmethod
@@ -89,10 +71,10 @@ class JMuxerVideoStreamSocket(websocket.WebSocketHandler):
 
     # noinspection PyUnusedLocal
     def open(self, *args, **kwargs):
-        self._video.add_listener(self._client)
+        self._hub.join(self)
 
     def on_close(self):
-        self._video.remove_listener(self._client)
+        self._hub.leave(self)
 
     @staticmethod
     def on_message(message):
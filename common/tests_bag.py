@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from byodr.utils import message_age, monotonic_timestamp, timestamp
+from byodr.utils.bag import BagReader, BagWriter, recorder_threads, replay
+from byodr.utils.ipc import ImagePublisher, JSONPublisher
+from byodr.utils.testing import QueueCamera, QueueReceiver
+
+
+def _write_session(path, n=10):
+    writer = BagWriter(path)
+    _start = timestamp()
+    for i in range(n):
+        writer.write_json(
+            "aav/pilot/output",
+            dict(time=_start, steering=i * 0.1),
+            ts=_start + i * 10000,
+        )
+        writer.write_image(
+            "aav/camera/0",
+            dict(time=_start),
+            np.full((4, 6, 3), i, dtype=np.uint8),
+            ts=_start + i * 10000 + 5000,
+        )
+    writer.close()
+    return _start
+
+
+def test_bag_write_read(tmpdir):
+    path = os.path.join(str(tmpdir.realpath()), "session.bag")
+    _start = _write_session(path)
+    reader = BagReader(path)
+    assert len(reader) == 20
+    assert reader.get_time_range() == (_start, _start + 95000)
+    ts, topic, message = reader.read(reader.find(_start + 20000))
+    assert (ts, topic, message["steering"]) == (_start + 20000, "aav/pilot/output", 0.2)
+    ts, topic, (md, image) = reader.read(reader.find(_start + 20001))
+    assert topic == "aav/camera/0"
+    assert image.shape == (4, 6, 3) and np.all(image == 2)
+    reader.close()
+
+    # The index is rebuilt from the bag and a partially written record is left out.
+    os.remove(path + ".idx")
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 7)
+    reader = BagReader(path)
+    assert len(reader) == 20
+    reader.close()
+
+
+def test_bag_replay(tmpdir):
+    path = os.path.join(str(tmpdir.realpath()), "session.bag")
+    _write_session(path)
+    reader = BagReader(path)
+    receiver, camera = QueueReceiver(), QueueCamera()
+    sinks = {"aav/pilot/output": receiver.add, "aav/camera/0": camera.add}
+
+    # As fast as possible.
+    assert replay(reader, sinks, rate=0) == 20
+    assert receiver.get_latest()["steering"] == 0.9
+    assert np.all(camera.capture()[1] == 9)
+
+    # The recording spans 95ms - twice as fast takes about half of that.
+    _start = time.time()
+    replay(reader, sinks, rate=2)
+    assert 0.04 < time.time() - _start < 0.2
+    # The messages are retimed to appear fresh.
+    assert timestamp() - receiver.get_latest()["time"] < 1e6
+    reader.close()
+
+
+def test_bag_replay_monotonic(tmpdir):
+    path = os.path.join(str(tmpdir.realpath()), "session.bag")
+    writer = BagWriter(path)
+    # Recorded before a reboot - the monotonic clock of the recording is far off.
+    writer.write_json(
+        "aav/pilot/output",
+        dict(time=timestamp(), mono=monotonic_timestamp() - 3600 * 1e6, steering=0.1),
+    )
+    writer.write_image(
+        "aav/camera/0",
+        dict(time=timestamp(), mono=monotonic_timestamp() + 3600 * 1e6),
+        np.zeros((4, 6, 3), dtype=np.uint8),
+    )
+    writer.close()
+    reader = BagReader(path)
+    receiver, camera = QueueReceiver(), QueueCamera()
+    replay(
+        reader, {"aav/pilot/output": receiver.add, "aav/camera/0": camera.add}, rate=0
+    )
+    _patience = 100 * 1e3
+    assert 0 <= message_age(receiver.get_latest()) < _patience
+    assert 0 <= message_age(camera.capture()[0]) < _patience
+    reader.close()
+
+
+def test_bag_recorder(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    topics = (
+        ("ipc://" + os.path.join(directory, "pilot.sock"), "aav/pilot/output", False),
+        ("ipc://" + os.path.join(directory, "camera_0.sock"), "aav/camera/0", True),
+    )
+    publisher = JSONPublisher(url=topics[0][0], topic="aav/pilot/output")
+    camera = ImagePublisher(url=topics[1][0], topic="aav/camera/0")
+    path = os.path.join(directory, "session.bag")
+    writer = BagWriter(path)
+    threads = recorder_threads(writer, event, topics=topics)
+    [t.start() for t in threads]
+    try:
+        time.sleep(0.2)
+        for i in range(5):
+            publisher.publish(dict(time=timestamp(), i=i))
+            camera.publish(np.full((4, 6, 3), i, dtype=np.uint8))
+            time.sleep(0.02)
+    finally:
+        event.set()
+        [t.join() for t in threads]
+        writer.close()
+    reader = BagReader(path)
+    records = list(reader.records())
+    assert [r[2]["i"] for r in records if r[1] == "aav/pilot/output"] == list(range(5))
+    assert [int(r[2][1][0, 0, 0]) for r in records if r[1] == "aav/camera/0"] == list(
+        range(5)
+    )
+    reader.close()
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+
+from concurrent.futures import Future
+
+from byodr.utils.h264 import H264StreamHub, NAL_IDR, NAL_PPS, NAL_SPS, nal_units
+
+_SPS = b"\x00\x00\x00\x01\x67\x42\x00"
+_PPS = b"\x00\x00\x00\x01\x68\xce"
+_IDR = b"\x00\x00\x01\x65" + b"\xaa" * 100
+_P = b"\x00\x00\x01\x41" + b"\xbb" * 20
+
+
+class _Source(object):
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, c):
+        self.listeners.append(c)
+
+    def remove_listener(self, c):
+        self.listeners.remove(c)
+
+    def publish(self, sample):
+        [c(sample) for c in self.listeners]
+
+
+class _IOLoop(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def add_callback(self, fn, *args):
+        self.callbacks.append((fn, args))
+
+    def run(self):
+        _callbacks, self.callbacks = self.callbacks, []
+        [fn(*args) for fn, args in _callbacks]
+
+
+class _Client(object):
+    def __init__(self):
+        self.messages = []
+        self.futures = []
+
+    def write_message(self, data, binary=False):
+        assert binary
+        self.messages.append(data)
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def flush(self):
+        [f.set_result(None) for f in self.futures if not f.done()]
+
+
+def test_nal_units():
+    sample = _SPS + _PPS + _IDR
+    units = nal_units(sample)
+    assert [u[0] for u in units] == [NAL_SPS, NAL_PPS, NAL_IDR]
+    assert sample[units[0][1] : units[0][2]] == _SPS
+    assert sample[units[2][1] : units[2][2]] == _IDR
+    assert nal_units(b"\xff\xff") == []
+
+
+def test_stream_hub_fan_out_and_backpressure():
+    source, io_loop = _Source(), _IOLoop()
+    hub = H264StreamHub(source, io_loop, max_outstanding_bytes=200)
+    fast, slow = _Client(), _Client()
+    hub.join(fast)
+    hub.join(slow)
+    assert len(source.listeners) == 1
+    # One callback on the io loop per sample for all clients.
+    source.publish(_SPS + _PPS + _IDR)
+    source.publish(_P)
+    assert len(io_loop.callbacks) == 2
+    io_loop.run()
+    fast.flush()
+    assert len(fast.messages) == len(slow.messages) == 2
+
+    # The slow client does not get its bytes out and skips to the next keyframe, without the fast one noticing.
+    for _ in range(10):
+        source.publish(_P)
+        io_loop.run()
+        fast.flush()
+    assert len(fast.messages) == 12
+    assert hub.get_stats()["clients"][1]["dropped"] > 0
+    _received = len(slow.messages)
+    slow.flush()
+    source.publish(_P)
+    io_loop.run()
+    assert len(slow.messages) == _received
+    # This keyframe comes without the parameter sets.
+    source.publish(_IDR)
+    io_loop.run()
+    assert slow.messages[-1] == _SPS + _PPS + _IDR
+    assert fast.messages[-1] == _IDR
+
+    hub.leave(fast)
+    hub.leave(slow)
+    assert source.listeners == []
+
+
+def test_stream_hub_new_client_and_gaps():
+    source, io_loop = _Source(), _IOLoop()
+    hub = H264StreamHub(source, io_loop, max_pending=2)
+    first = _Client()
+    hub.join(first)
+    # A client that joins before the first keyframe waits for it.
+    source.publish(_P)
+    io_loop.run()
+    assert first.messages == []
+    [source.publish(sample) for sample in (_SPS + _PPS + _IDR, _P)]
+    io_loop.run()
+    # A new client starts with the samples since the keyframe.
+    late = _Client()
+    hub.join(late)
+    assert late.messages == [_SPS + _PPS + _IDR, _P]
+    # Samples that do not make it to the io loop break the stream for all until the next keyframe.
+    [source.publish(_P) for _ in range(3)]
+    io_loop.run()
+    assert hub.get_stats()["skipped"] == 1 and hub.get_stats()["gop_samples"] == 0
+    assert len(late.messages) == 2
+    source.publish(_IDR)
+    io_loop.run()
+    assert late.messages[-1] == _SPS + _PPS + _IDR
+
+
+def test_stream_hub_late_client_large_gop():
+    source, io_loop = _Source(), _IOLoop()
+    hub = H264StreamHub(source, io_loop, max_outstanding_bytes=200, max_gop_bytes=10000)
+    first = _Client()
+    hub.join(first)
+    [source.publish(sample) for sample in [_SPS + _PPS + _IDR] + [_P] * 10]
+    io_loop.run()
+    first.flush()
+    # The samples since the keyframe are kept up to what a new client can take at once.
+    assert hub.get_stats()["gop_samples"] == 0
+    late = _Client()
+    hub.join(late)
+    assert late.messages == []
+    source.publish(_SPS + _PPS + _IDR)
+    source.publish(_P)
+    io_loop.run()
+    assert late.messages == [_SPS + _PPS + _IDR, _P]
+    assert hub.get_stats()["clients"][1]["outstanding"] <= 200
+
+    # A keyframe larger than the outstanding bytes is not replayed either.
+    _large = _SPS + _PPS + b"\x00\x00\x01\x65" + b"\xaa" * 300
+    source.publish(_large)
+    io_loop.run()
+    other = _Client()
+    hub.join(other)
+    assert other.messages == []
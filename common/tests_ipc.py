@@ -0,0 +1,648 @@
+from __future__ import absolute_import
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from byodr.utils import monotonic_timestamp, timestamp
+from byodr.utils.codec import PILOT_OUTPUT, SchemaRecord, get_topic_codec
+from byodr.utils.aio import AsyncJSONSubscriber, AsyncJSONZmqClient
+from byodr.utils.ipc import (
+    CameraThread,
+    ImagePublisher,
+    HubCollector,
+    IPCHub,
+    JSONPublisher,
+    JSONPullThread,
+    JSONPushClient,
+    JSONReceiver,
+    JSONRouterServerThread,
+    JSONZmqClient,
+    LocalIPCServer,
+    is_same_host,
+    json_collector,
+    receive_age,
+)
+from byodr.utils.metrics import CommandLatency, Histogram, topic_stats
+from byodr.utils.protocol import ClockOffsetEstimator, SequenceFilter
+from byodr.utils.sharedmem import SharedFrameRing
+
+
+def test_shared_frame_ring(tmpdir):
+    path = os.path.join(str(tmpdir.realpath()), "camera.sock.ring")
+    writer = SharedFrameRing.create(path, num_slots=3, slot_bytes=4 * 6 * 3)
+    reader = SharedFrameRing.open(path)
+    assert reader.get_id() == writer.get_id()
+    assert reader.get_num_slots() == 3
+
+    slot, seq = writer.write(np.full((4, 6, 3), 7, dtype=np.uint8), 100)
+    view = reader.read(slot, seq)
+    assert view.shape == (4, 6, 3)
+    assert np.all(view == 7)
+    assert not view.flags.writeable
+
+    # The slot remains valid until the writer wraps around.
+    [writer.write(np.zeros((4, 6, 3), dtype=np.uint8), 101 + i) for i in range(2)]
+    assert reader.is_valid(slot, seq)
+    writer.write(np.zeros((4, 6, 3), dtype=np.uint8), 104)
+    assert not reader.is_valid(slot, seq)
+    assert reader.read(slot, seq) is None
+
+
+def test_image_publisher_shared_memory(tmpdir):
+    url = "ipc://" + os.path.join(str(tmpdir.realpath()), "camera.sock")
+    event = multiprocessing.Event()
+    publisher = ImagePublisher(
+        url=url, topic="aav/camera/0", shared_memory=True, num_slots=4
+    )
+    camera = CameraThread(url=url, topic=b"aav/camera/0", event=event)
+    camera.start()
+    try:
+        # Allow the subscription to propagate.
+        time.sleep(0.2)
+        for i in range(5):
+            publisher.publish(np.full((24, 32, 3), i, dtype=np.uint8))
+            time.sleep(0.02)
+        md, image = camera.capture()
+        assert md.get("shape") == [24, 32, 3]
+        assert image.shape == (24, 32, 3)
+        assert np.all(image == 4)
+        # A larger frame results in a new ring.
+        publisher.publish(np.full((48, 64, 3), 9, dtype=np.uint8))
+        time.sleep(0.05)
+        md, image = camera.capture()
+        assert image.shape == (48, 64, 3)
+        assert np.all(image == 9)
+    finally:
+        event.set()
+        camera.join()
+
+
+def test_schema_codec_round_trip():
+    message = dict(
+        time=timestamp(),
+        action=0.25,
+        obstacle=1,
+        navigation_point=-1,
+        navigation_path=[0.1 * i for i in range(10)],
+        internal=[0.0],
+        _unknown_field=dict(a=1),
+    )
+    codec = get_topic_codec("aav/inference/state")
+    decoded = codec.decode(codec.encode(message))
+    assert decoded.get("time") == message.get("time")
+    assert decoded.get("action") == 0.25
+    assert decoded.get("obstacle") == 1.0
+    assert decoded.get("navigation_point") == -1
+    assert decoded.get("navigation_path") == message.get("navigation_path")
+    assert decoded.get("_unknown_field") == dict(a=1)
+    # Absent fields stay absent and a type mismatch travels in the json tail.
+    assert "total_penalty" not in decoded
+    decoded = codec.decode(codec.encode(dict(action="fallback", total_penalty=None)))
+    assert decoded == dict(action="fallback")
+    # So does an array which is not a flat list of numbers.
+    for path in ([None, 1.0], ["0.1"], [[0.1, 0.2]]):
+        decoded = codec.decode(codec.encode(dict(navigation_path=path)))
+        assert decoded == dict(navigation_path=path)
+
+
+class _PilotRecord(SchemaRecord):
+    __slots__ = PILOT_OUTPUT.get_names()
+    codec = PILOT_OUTPUT
+
+
+def test_schema_record():
+    record = _PilotRecord()
+    record.steering = 0.5
+    record["driver"] = "driver_mode.teleop.direct"
+    record["cid"] = 7
+    record.save_event = "no"
+    assert (
+        record.get("steering") == 0.5
+        and record["driver"] == "driver_mode.teleop.direct"
+    )
+    assert "cid" in record and "throttle" in record and "other" not in record
+    assert record.get("other", 1) == 1
+    decoded = PILOT_OUTPUT.decode(PILOT_OUTPUT.encode(record))
+    assert decoded == dict(
+        steering=0.5, driver="driver_mode.teleop.direct", cid=7, save_event="no"
+    )
+    assert decoded == dict((k, v) for k, v in record.to_dict().items() if v is not None)
+    # The record is reused.
+    record.clear()
+    assert PILOT_OUTPUT.decode(PILOT_OUTPUT.encode(record)) == {}
+    try:
+        record.unknown_field = 1
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_json_publisher_codecs(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    _json = JSONPublisher(
+        url="ipc://" + os.path.join(directory, "json.sock"), topic="aav/pilot/output"
+    )
+    _binary = JSONPublisher(
+        url="ipc://" + os.path.join(directory, "binary.sock"),
+        topic="aav/pilot/output",
+        binary=True,
+    )
+    receivers = [
+        JSONReceiver(
+            url="ipc://" + os.path.join(directory, name),
+            topic=b"aav/pilot/output",
+            receive_timeout_ms=100,
+        )
+        for name in ("json.sock", "binary.sock")
+    ]
+    time.sleep(0.2)
+    message = dict(
+        time=timestamp(),
+        driver="driver_mode.teleop.direct",
+        steering=0.5,
+        save_event=False,
+        navigator=dict(route=None),
+    )
+    _json.publish(message)
+    _binary.publish(message)
+    [r.consume() for r in receivers]
+    assert receivers[0].get() == message
+    assert receivers[1].get() == message
+    event.set()
+
+
+def test_ipc_hub_collectors(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    publishers = [
+        JSONPublisher(
+            url="ipc://" + os.path.join(directory, "{}.sock".format(i)),
+            topic="aav/test/{}".format(i),
+        )
+        for i in range(3)
+    ]
+    collectors = [
+        json_collector(
+            url="ipc://" + os.path.join(directory, "{}.sock".format(i)),
+            topic="aav/test/{}".format(i).encode(),
+            event=event,
+        )
+        for i in range(3)
+    ]
+    [c.start() for c in collectors]
+    try:
+        time.sleep(0.2)
+        for n in range(5):
+            [p.publish(dict(index=i, n=n)) for i, p in enumerate(publishers)]
+            time.sleep(0.02)
+        assert [c.get() for c in collectors] == [dict(index=i, n=4) for i in range(3)]
+        # The collectors of the process share the one hub thread.
+        assert isinstance(collectors[0]._hub, IPCHub)
+        assert len(set(id(c._hub) for c in collectors)) == 1
+    finally:
+        event.set()
+        [c.join() for c in collectors]
+    assert not collectors[0].is_alive()
+
+
+def test_ipc_hub_quit_collector(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    urls = ["ipc://" + os.path.join(directory, "{}.sock".format(i)) for i in range(2)]
+    publishers = [
+        JSONPublisher(url=url, topic="aav/test/{}".format(i))
+        for i, url in enumerate(urls)
+    ]
+    hub = IPCHub(poll_timeout_ms=10)
+    collectors = [
+        HubCollector(
+            JSONReceiver(url, "aav/test/{}".format(i).encode()), event=event, hub=hub
+        )
+        for i, url in enumerate(urls)
+    ]
+    [c.start() for c in collectors]
+    try:
+        time.sleep(0.2)
+        collectors[0].quit()
+        time.sleep(0.1)
+        # The subscription which quit is closed while the hub serves the other.
+        assert collectors[0]._receiver.get_socket().closed
+        assert not collectors[1]._receiver.get_socket().closed
+        [p.publish(dict(index=i)) for i, p in enumerate(publishers)]
+        time.sleep(0.1)
+        assert collectors[0].get() is None
+        assert collectors[1].get() == dict(index=1)
+    finally:
+        event.set()
+        [c.join() for c in collectors]
+    assert hub.is_finished()
+    try:
+        collectors[1].start()
+        assert False, "A finished hub cannot be started again."
+    except RuntimeError:
+        pass
+
+
+def test_json_client_scatter_gather(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    urls = [
+        "ipc://" + os.path.join(directory, "{}_c.sock".format(name))
+        for name in ("pilot", "inference", "down")
+    ]
+    servers = [
+        LocalIPCServer(name, url, event)
+        for name, url in zip(("pilot", "inference"), urls)
+    ]
+    [s.register_start(errors=[], capabilities=dict(name=s._name)) for s in servers]
+    [s.start() for s in servers]
+    client = JSONZmqClient(urls=urls, receive_timeout_ms=200)
+    aio_client = AsyncJSONZmqClient(urls=urls, receive_timeout_ms=200)
+    try:
+        expected = dict(pilot=dict(name="pilot"), inference=dict(name="inference"))
+        _start = time.time()
+        assert client.call(dict(request="system/service/capabilities")) == expected
+        # The endpoint which is down costs one deadline and not one timeout per endpoint.
+        assert time.time() - _start < 0.4
+        # The sockets are reused and the late endpoint does not disturb the next request.
+        assert client.call(dict(request="system/service/capabilities")) == expected
+        _loop = asyncio.new_event_loop()
+        try:
+            assert (
+                _loop.run_until_complete(
+                    aio_client.call(dict(request="system/service/capabilities"))
+                )
+                == expected
+            )
+        finally:
+            _loop.close()
+    finally:
+        client.quit()
+        aio_client.quit()
+        event.set()
+        [s.join() for s in servers]
+
+
+def _garbage_server(url, event):
+    # Replies to every request with a body which is not json.
+    socket = zmq.Context.instance().socket(zmq.ROUTER)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.bind(url)
+    while not event.is_set():
+        if socket.poll(10):
+            socket.send_multipart(socket.recv_multipart()[:-1] + [b"{not json"])
+    socket.close()
+
+
+def test_json_client_malformed_reply(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    urls = [
+        "ipc://" + os.path.join(directory, "{}_c.sock".format(name))
+        for name in ("pilot", "garbage")
+    ]
+    server = LocalIPCServer("pilot", urls[0], event)
+    server.register_start(errors=[], capabilities=dict(name="pilot"))
+    server.start()
+    garbage = threading.Thread(target=_garbage_server, args=(urls[1], event))
+    garbage.start()
+    client = JSONZmqClient(urls=urls, receive_timeout_ms=200)
+    aio_client = AsyncJSONZmqClient(urls=urls, receive_timeout_ms=200)
+    try:
+        expected = dict(pilot=dict(name="pilot"))
+        # The malformed reply is dropped and the other endpoints are still answered.
+        for _ in range(2):
+            assert client.call(dict(request="system/service/capabilities")) == expected
+        _loop = asyncio.new_event_loop()
+        try:
+            assert (
+                _loop.run_until_complete(
+                    aio_client.call(dict(request="system/service/capabilities"))
+                )
+                == expected
+            )
+        finally:
+            _loop.close()
+    finally:
+        client.quit()
+        aio_client.quit()
+        event.set()
+        server.join()
+        garbage.join()
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(1, 10, 100))
+    assert histogram.percentile(50) is None
+    [histogram.record(v) for v in (0.5, 5, 5, 50, 500)]
+    _dict = histogram.to_dict()
+    assert _dict["count"] == 5
+    assert _dict["buckets"] == [1, 2, 1, 1]
+    assert _dict["min"] == 0.5 and _dict["max"] == 500
+    assert histogram.percentile(50) == 10
+    assert histogram.percentile(99) == 500
+
+
+def test_command_latency():
+    latency = CommandLatency(window=2)
+    hops = [
+        ["teleop", 1000000],
+        ["pilot", 1002000],
+        ["relay", 1003000],
+        ["ras/received", 1004000],
+        ["ras/actuated", 1005000],
+    ]
+    assert latency.on_confirmation(1, hops, received=1010000) == 10
+    # The command is applied again on later steps.
+    assert latency.on_confirmation(1, hops, received=1020000) is None
+    assert latency.on_confirmation(2, hops, received=1020000) == 20
+    _dict = latency.to_dict()
+    assert _dict["total_ms"]["count"] == 2
+    assert list(_dict["hops_ms"].keys())[0] == "teleop > pilot"
+    assert _dict["hops_ms"]["teleop > pilot"]["mean"] == 2
+    # Out of the window the id counts again.
+    latency.on_confirmation(3, hops, received=1010000)
+    assert latency.on_confirmation(1, hops, received=1010000) == 10
+
+
+def test_clock_offset_estimator():
+    clock = ClockOffsetEstimator(window=3)
+    assert clock.get_offset() is None and clock.to_local(100) is None
+    # The remote clock is ahead by 5000 with symmetric legs of 1000.
+    clock.add(t0=0, t1=6000, t2=6500, t3=2500)
+    assert clock.get_offset() == 5000 and clock.get_delay() == 2000
+    # A queued reply skews the exchange - the one with the smallest delay is kept.
+    clock.add(t0=10000, t1=16000, t2=16500, t3=22500)
+    assert clock.get_offset() == 5000
+    assert clock.to_local(106000) == 101000
+    # The old samples leave the window.
+    [
+        clock.add(t0=t, t1=t + 4500, t2=t + 4700, t3=t + 1200)
+        for t in (30000, 40000, 50000)
+    ]
+    assert clock.get_offset() == 4000 and clock.get_delay() == 1000
+    assert clock.to_dict()["samples"] == 3
+
+
+def test_json_client_clock(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    urls = [
+        "ipc://" + os.path.join(directory, name)
+        for name in ("pilot_c.sock", "ras.sock")
+    ]
+    servers = [
+        LocalIPCServer("pilot", urls[0], event),
+        JSONRouterServerThread(urls[1], event),
+    ]
+    received = []
+    servers[1].add_listener(lambda m: received.append(m))
+    [s.start() for s in servers]
+    client = JSONZmqClient(urls=urls, receive_timeout_ms=500, clock=True)
+    try:
+        time.sleep(0.1)
+        for _ in range(3):
+            # The clock timestamps do not show in the reply.
+            assert client.call(dict(request="system/service/capabilities")) == {}
+        assert "clock" in received[-1]
+        for i in range(2):
+            clock = client.get_clock(i)
+            assert clock.to_dict()["samples"] == 3
+            # The same host shares the monotonic clock.
+            assert abs(clock.get_offset()) <= clock.get_delay() / 2.0 + 1
+        assert JSONZmqClient(urls=urls[0]).get_clock() is None
+    finally:
+        client.quit()
+        event.set()
+        [s.join() for s in servers]
+
+
+def test_sequence_filter():
+    sequence = SequenceFilter()
+    assert [sequence.accept(1, n) for n in (1, 2, 5, 4, 5, 6)] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+        True,
+    ]
+    # A restarted sender starts a new session.
+    assert sequence.accept(2, 1) and sequence.accept(None, None)
+    assert sequence.to_dict() == dict(accepted=5, stale=2, lost=2)
+
+
+def test_json_push_pull(tmpdir):
+    event = multiprocessing.Event()
+    url = "ipc://" + os.path.join(str(tmpdir.realpath()), "drive.sock")
+    client = JSONPushClient(url=url)
+    try:
+        # Without a receiver the messages are dropped at once instead of queued.
+        _start = time.time()
+        assert not client.send(dict(steering=0.1))
+        assert time.time() - _start < 0.05
+        puller = JSONPullThread(url=url, event=event)
+        received = []
+        puller.add_listener(lambda m: received.append(m))
+        puller.start()
+        deadline = time.time() + 2
+        while not client.send(dict(steering=0.2)) and time.time() < deadline:
+            time.sleep(0.01)
+        while not received and time.time() < deadline:
+            time.sleep(0.01)
+        assert received[-1]["steering"] == 0.2 and received[-1]["seq"] > 1
+        assert client.get_stats()["dropped"] >= 1
+        # The messages of a burst arrive in order or are skipped.
+        [client.send(dict(steering=i * 0.01)) for i in range(100)]
+        while puller.get_latest()["steering"] != 0.99 and time.time() < deadline:
+            time.sleep(0.01)
+        assert puller.get_latest()["steering"] == 0.99
+        assert [m["seq"] for m in received] == sorted(m["seq"] for m in received)
+        assert puller.get_stats()["stale"] == 0
+    finally:
+        client.quit()
+        event.set()
+    puller.join()
+
+
+def test_ipc_topic_stats(tmpdir):
+    event = multiprocessing.Event()
+    directory = str(tmpdir.realpath())
+    url = "ipc://" + os.path.join(directory, "stats.sock")
+    publisher = JSONPublisher(url=url, topic="aav/test/stats")
+    receiver = JSONReceiver(url=url, topic=b"aav/test/stats", receive_timeout_ms=100)
+    server = LocalIPCServer(
+        "test", "ipc://" + os.path.join(directory, "test_c.sock"), event
+    )
+    server.start()
+    client = JSONZmqClient(urls="ipc://" + os.path.join(directory, "test_c.sock"))
+    try:
+        time.sleep(0.2)
+        for i in range(3):
+            publisher.publish(dict(time=timestamp(), i=i))
+            receiver.consume()
+            time.sleep(0.02)
+        # Nobody looked at the first two messages.
+        assert receiver.get() == dict(time=receiver.peek()["time"], i=2)
+        stats = topic_stats("aav/test/stats").to_dict()
+        assert stats["published"] == 3
+        assert stats["consumed"] == 3
+        assert stats["drops_overwritten"] == 2
+        assert stats["age_ms"]["count"] == 3
+        assert stats["jitter_ms"]["count"] == 1
+        assert stats["queue_length"] == 1 and stats["queue_hwm"] == 1
+        reply = client.call(dict(request="system/ipc/stats"))
+        assert reply["test"]["aav/test/stats"]["consumed"] == 3
+        # On the same host the age is taken by the monotonic timestamp, which a step of the wall clock does not affect.
+        publisher.publish(dict(time=timestamp() - 3600e6, mono=monotonic_timestamp()))
+        receiver.consume()
+        assert topic_stats("aav/test/stats").to_dict()["age_ms"]["max"] < 1000
+    finally:
+        client.quit()
+        event.set()
+        server.join()
+
+
+def test_is_same_host():
+    assert is_same_host("ipc:///tmp/pilot.sock")
+    assert is_same_host("tcp://127.0.0.1:5555")
+    assert not is_same_host("tcp://192.168.1.32:5555")
+    # The monotonic timestamp of another host is not comparable to the local one.
+    message = dict(time=timestamp() - 2000, mono=monotonic_timestamp() + 10**9)
+    assert 2000 <= receive_age(message, same_host=False) < 1e6
+    assert receive_age(message, same_host=True) < 0
+    assert receive_age(dict(mono=monotonic_timestamp()), same_host=False) is None
+
+
+def test_async_json_subscriber(tmpdir):
+    url = "ipc://" + os.path.join(str(tmpdir.realpath()), "pilot.sock")
+    publisher = JSONPublisher(url=url, topic="aav/pilot/output", binary=True)
+    subscriber = AsyncJSONSubscriber(
+        url=url, topic=b"aav/pilot/output", consumer="websocket"
+    )
+    receiver = JSONReceiver(url=url, topic=b"aav/pilot/output", receive_timeout_ms=100)
+
+    async def _publish(n):
+        for i in range(n):
+            await asyncio.sleep(0.02)
+            publisher.publish(dict(time=timestamp(), steering=float(i)))
+
+    async def _scenario():
+        subscriber.start()
+        await asyncio.sleep(0.2)
+        # Nothing arrives within the timeout.
+        assert await subscriber.wait(timeout=0.05) == 0
+        _task = asyncio.ensure_future(_publish(3))
+        seq = await subscriber.wait(after=0, timeout=1)
+        assert seq >= 1 and subscriber.peek()["steering"] == 0.0
+        streamed = []
+        async for message in subscriber.stream():
+            streamed.append(message["steering"])
+            if message["steering"] == 2.0:
+                break
+        await _task
+        return streamed
+
+    _consumed = topic_stats("aav/pilot/output").to_dict()["consumed"]
+
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    try:
+        assert _loop.run_until_complete(_scenario()) == [1.0, 2.0]
+        receiver.consume()
+        # Each subscription counts its own messages.
+        assert (
+            topic_stats("aav/pilot/output@websocket").to_dict()["consumed"]
+            == subscriber.get_seq()
+        )
+        assert topic_stats("aav/pilot/output").to_dict()["consumed"] == _consumed + 1
+    finally:
+        subscriber.quit()
+        _loop.run_until_complete(asyncio.sleep(0))
+        _loop.close()
+        asyncio.set_event_loop(None)
+
+
+class _SlowIntrospectionServer(JSONRouterServerThread):
+    def serve(self, request):
+        if request.get("request") == "system/service/capabilities":
+            time.sleep(0.3)
+        return dict(answer=request.get("request", request.get("method")))
+
+
+def test_router_server_priorities(tmpdir):
+    event = multiprocessing.Event()
+    url = "ipc://" + os.path.join(str(tmpdir.realpath()), "ras.sock")
+    server = _SlowIntrospectionServer(url, event)
+    received = []
+    server.add_listener(lambda m: received.append(m))
+    server.start()
+    slow_client = JSONZmqClient(urls=url, receive_timeout_ms=1000)
+    drive_client = JSONZmqClient(urls=url, receive_timeout_ms=1000)
+    try:
+        time.sleep(0.1)
+        slow = []
+        _thread = threading.Thread(
+            target=lambda: slow.append(
+                slow_client.call(dict(request="system/service/capabilities"))
+            )
+        )
+        _thread.start()
+        time.sleep(0.05)
+        # The drive command is answered while the introspection request is still being served.
+        for i in range(5):
+            _start = time.time()
+            assert drive_client.call(
+                dict(method="ras/servo/drive", data=dict(i=i))
+            ) == dict(answer="ras/servo/drive")
+            assert time.time() - _start < 0.1
+        assert not slow
+        _thread.join()
+        assert slow == [dict(answer="system/service/capabilities")]
+        assert len(received) == 6
+        assert server.get_latest() == dict(method="ras/servo/drive", data=dict(i=4))
+        assert server.get_latest("system/service/capabilities") is not None
+    finally:
+        slow_client.quit()
+        drive_client.quit()
+        event.set()
+        server.join()
+
+
+class _FailingServer(JSONRouterServerThread):
+    def serve(self, request):
+        return dict(speed=request["data"]["speed"])
+
+
+def test_router_server_failed_inline_request(tmpdir):
+    event = multiprocessing.Event()
+    url = "ipc://" + os.path.join(str(tmpdir.realpath()), "ras.sock")
+    server = _FailingServer(url, event)
+    server.start()
+    client = JSONZmqClient(urls=url, receive_timeout_ms=200)
+    try:
+        time.sleep(0.1)
+        # The failed drive is not answered but the socket thread carries on.
+        assert client.call(dict(method="ras/servo/drive")) == {}
+        assert server.is_alive()
+        assert client.call(
+            dict(method="ras/servo/drive", data=dict(speed=0.5))
+        ) == dict(speed=0.5)
+        # A configuration does not displace the pending drive.
+        client.call(dict(method="ras/driver/config", data=dict(speed=1.0)))
+        assert server.get_latest()["method"] == "ras/driver/config"
+        assert server.pop_latest("ras/servo/drive")["data"] == dict(speed=0.5)
+        assert server.pop_latest("ras/servo/drive") is None
+        assert server.pop_latest() is not None
+        assert server.get_latest() is None
+    finally:
+        client.quit()
+        event.set()
+        server.join()
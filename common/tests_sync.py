@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+
+from byodr.utils.sync import Synchronizer, TimeSeries
+
+
+def test_time_series_nearest():
+    series = TimeSeries(maxlen=5)
+    assert series.nearest(100) is None
+    # One message arrives late.
+    [series.add(dict(time=t)) for t in (10, 20, 40, 30, 50, 60)]
+    assert len(series) == 5
+    assert [m["time"] for m in series.since(None)] == [20, 30, 40, 50, 60]
+    assert series.nearest(34)["time"] == 30
+    assert series.nearest(36)["time"] == 40
+    assert series.nearest(0)["time"] == 20
+    assert series.nearest(1000)["time"] == 60
+    assert series.nearest(70, tolerance=5) is None
+    assert [m["time"] for m in series.since(30, 50)] == [40, 50]
+    assert series.latest()["time"] == 60
+
+
+def test_time_series_interpolate():
+    series = TimeSeries()
+    series.add(dict(time=100, velocity=1.0, steering=-1.0, driver="a"))
+    series.add(dict(time=200, velocity=2.0, steering=1.0, driver="b"))
+    result = series.interpolate(125, fields=("velocity", "steering", "driver"))
+    assert result == dict(time=125, velocity=1.25, steering=-0.5, driver="a")
+    assert series.interpolate(300, fields=("velocity",)) == dict(time=300, velocity=2.0)
+    assert series.interpolate(500, fields=("velocity",), tolerance=100) is None
+
+
+def test_synchronizer_join():
+    synchronizer = Synchronizer(topics=("pilot", "vehicle"))
+    _pilot, _vehicle = synchronizer.listener("pilot"), synchronizer.listener("vehicle")
+    [_pilot(dict(time=t)) for t in (0, 50, 100)]
+    [_vehicle(dict(time=t)) for t in (10, 90)]
+    pilot, vehicle = synchronizer.join(60, tolerance=20)
+    assert pilot["time"] == 50 and vehicle is None
+    pilot, vehicle = synchronizer.join(95)
+    assert pilot["time"] == 100 and vehicle["time"] == 90
+
+
+def test_synchronizer_take():
+    synchronizer = Synchronizer(topics=("pilot",))
+    _pilot = synchronizer.listener("pilot")
+    [_pilot(dict(time=t)) for t in (900, 990, 1000, 1050)]
+    # A new reader begins at the start and every message is taken once.
+    taken = [m["time"] for m in synchronizer.take("pilot", "logbox", start=950)]
+    assert taken == [990, 1000, 1050]
+    assert synchronizer.take("pilot", "logbox") == []
+    _pilot(dict(time=1070))
+    taken += [m["time"] for m in synchronizer.take("pilot", "logbox")]
+    assert taken == [990, 1000, 1050, 1070]
+    # The readers are independent.
+    assert len(synchronizer.take("pilot", "other")) == 5
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+from byodr.utils import timestamp
+from byodr.utils.trace import Tracer, chrome_trace
+
+
+def test_tracer_spans():
+    tracer = Tracer(capacity=4)
+    with tracer.span("step"):
+        with tracer.span("phase"):
+            time.sleep(0.01)
+    _open = tracer.span("open").__enter__()
+    spans = tracer.recent()
+    # The open span is left out.
+    assert [s[0] for s in spans] == ["step", "phase"]
+    assert spans[0][2] >= spans[1][2] >= 10000
+    assert spans[0][3] == threading.current_thread().name
+    _open.__exit__()
+    assert tracer.recent(since=spans[1][1])[-1][0] == "open"
+
+    # The oldest records are reused.
+    for i in range(6):
+        with tracer.span("span_{}".format(i)):
+            pass
+    assert [s[0] for s in tracer.recent()] == ["span_2", "span_3", "span_4", "span_5"]
+
+    tracer.enabled = False
+    with tracer.span("disabled"):
+        pass
+    assert "disabled" not in [s[0] for s in tracer.recent()]
+
+
+def test_chrome_trace():
+    _now = timestamp()
+    trace = chrome_trace(
+        {
+            "pilot": [
+                ("pilot/step", _now, 500, "MainThread"),
+                ("pilot/driver", _now + 100, 200, "MainThread"),
+            ],
+            "teleop": [("logbox/pull", _now, 1000, "logbox")],
+        }
+    )
+    events = trace["traceEvents"]
+    complete = [e for e in events if e["ph"] == "X"]
+    assert [e["name"] for e in complete] == [
+        "pilot/step",
+        "pilot/driver",
+        "logbox/pull",
+    ]
+    assert complete[0]["pid"] != complete[2]["pid"]
+    assert complete[0]["tid"] == complete[1]["tid"]
+    names = dict(
+        ((e["pid"], e["tid"]), e["args"]["name"]) for e in events if e["ph"] == "M"
+    )
+    assert names[(complete[2]["pid"], 0)] == "teleop"
+    assert names[(complete[2]["pid"], complete[2]["tid"])] == "logbox"
@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+import threading
+import time
+
+from byodr.utils import (
+    AcceleratedClock,
+    Application,
+    ManualClock,
+    OVERRUN_CATCH_UP,
+    OVERRUN_SKIP,
+    monotonic,
+    monotonic_timestamp,
+    set_clock,
+    timestamp,
+)
+from byodr.utils.profiling import MODE_SAMPLING, ProfileSession
+from byodr.utils.testing import virtual_clock
+
+
+class _StepTimes(Application):
+    def __init__(self, n_steps, slow_step=None, **kwargs):
+        super(_StepTimes, self).__init__(quit_event=multiprocessing.Event(), **kwargs)
+        self._n_steps = n_steps
+        self._slow_step = slow_step
+        self.times = []
+
+    def step(self):
+        self.times.append(monotonic())
+        if len(self.times) == self._slow_step:
+            time.sleep(0.035)
+        if len(self.times) >= self._n_steps:
+            self.quit()
+
+
+def test_application_deadlines_do_not_drift():
+    application = _StepTimes(n_steps=21, run_hz=100, deadlines=True)
+    application.run()
+    # Twenty periods on the grid - the relative sleep would add the step overhead every period.
+    assert abs((application.times[-1] - application.times[0]) - 0.2) < 0.01
+    stats = application.get_schedule_stats()
+    assert stats["jitter_ms"]["count"] == 21
+    assert stats["skipped"] == 0
+
+
+def test_application_deadlines_overrun_skip():
+    application = _StepTimes(
+        n_steps=10, slow_step=3, run_hz=100, deadlines=True, overrun=OVERRUN_SKIP
+    )
+    application.run()
+    stats = application.get_schedule_stats()
+    assert stats["overrun_ms"]["count"] == 1
+    assert stats["skipped"] == 3
+    # The next step is on the original grid.
+    _offset = (application.times[3] - application.times[0]) % 0.01
+    assert min(_offset, 0.01 - _offset) < 0.003
+
+
+def test_application_deadlines_overrun_catch_up():
+    application = _StepTimes(
+        n_steps=10, slow_step=3, run_hz=100, deadlines=True, overrun=OVERRUN_CATCH_UP
+    )
+    application.run()
+    assert application.get_schedule_stats()["skipped"] == 0
+    # The missed steps are run back to back.
+    assert application.times[4] - application.times[3] < 0.003
+    assert abs((application.times[-1] - application.times[0]) - 0.09) < 0.01
+
+
+def test_application_tasks():
+    application = _StepTimes(n_steps=50, run_hz=100, deadlines=True)
+    calls = dict(fast=0, slow=0)
+    application.add_task(
+        lambda: calls.update(fast=calls["fast"] + 1), hz=20, name="fast"
+    )
+    application.add_task(
+        lambda: calls.update(slow=calls["slow"] + 1), hz=5, priority=-1, name="slow"
+    )
+    application.run()
+    # Half a second at the task rates - the first run is immediate.
+    assert 9 <= calls["fast"] <= 12
+    assert 2 <= calls["slow"] <= 4
+    stats = application.get_task_stats()
+    assert stats["fast"]["runs"] == calls["fast"]
+    assert stats["slow"]["duration_ms"]["count"] == calls["slow"]
+    assert stats["step"]["duration_ms"]["count"] == 50
+
+
+def test_application_background_task_is_deferred():
+    application = _StepTimes(n_steps=30, run_hz=100, deadlines=True)
+    application.add_task(
+        lambda: time.sleep(0.02), hz=50, priority=-1, name="background"
+    )
+    application.run()
+    stats = application.get_task_stats()["background"]
+    # The task does not fit in the period and is postponed until it is a period late.
+    assert stats["deferred"] > 0
+    assert stats["runs"] > 0
+
+
+def test_application_reactive_wake():
+    application = _StepTimes(n_steps=8, run_hz=10, deadlines=True)
+    application.set_reactive(True)
+    wakes = []
+
+    def _wake():
+        # The first steps are on the clock.
+        time.sleep(0.25)
+        for _ in range(4):
+            wakes.append(monotonic())
+            application.wake()
+            time.sleep(0.02)
+
+    thread = threading.Thread(target=_wake)
+    thread.start()
+    application.run()
+    thread.join()
+    assert application.get_schedule_stats()["woken"] == 4
+    # A step follows every wake call without waiting for the 100ms tick.
+    for _wake_time in wakes:
+        assert min(t - _wake_time for t in application.times if t >= _wake_time) < 0.005
+    # The clock continues as the watchdog after the last message.
+    assert abs(application.times[-1] - application.times[-2] - 0.1) < 0.01
+
+
+def _busy(seconds):
+    _end = monotonic() + seconds
+    while monotonic() < _end:
+        pass
+
+
+def test_application_latest_by_monotonic_age():
+    _latest = Application._latest_or_none
+    assert _latest(lambda: None, patience=1e6) is None
+    assert _latest(lambda: dict(time=timestamp()), patience=1e6) is not None
+    assert _latest(lambda: dict(time=timestamp() - 2e6), patience=1e6) is None
+    # A step of the wall clock does not age a message with a monotonic timestamp.
+    assert (
+        _latest(
+            lambda: dict(time=timestamp() - 3600e6, mono=monotonic_timestamp()),
+            patience=1e6,
+        )
+        is not None
+    )
+    assert (
+        _latest(
+            lambda: dict(time=timestamp(), mono=monotonic_timestamp() - 2e6),
+            patience=1e6,
+        )
+        is None
+    )
+
+
+def test_manual_clock():
+    clock = ManualClock(start=1000.0)
+    _previous = set_clock(clock)
+    try:
+        assert timestamp() == 1000 * 1e6 and monotonic_timestamp() == 0
+        clock.advance(0.5)
+        assert timestamp() == 1000.5 * 1e6 and monotonic() == 0.5
+        assert (
+            Application._latest_or_none(lambda: dict(mono=0), patience=1e6) is not None
+        )
+        clock.advance(1)
+        assert Application._latest_or_none(lambda: dict(mono=0), patience=1e6) is None
+    finally:
+        set_clock(_previous)
+    assert abs(timestamp() - time.time() * 1e6) < 1e6
+
+
+def test_application_virtual_clock():
+    with virtual_clock(start=1000.0) as clock:
+        application = _StepTimes(n_steps=10**6, run_hz=10, deadlines=True)
+        calls = dict(task=0)
+        application.add_task(lambda: calls.update(task=calls["task"] + 1), hz=1)
+        _start = time.time()
+        application.step_for(1000)
+        # A hundred seconds of steps on the virtual clock in a fraction of that in real time.
+        assert time.time() - _start < 10
+        assert len(application.times) == 1000
+        assert [round(t, 6) for t in application.times[:3]] == [0, 0.1, 0.2]
+        assert (
+            abs(clock.monotonic() - 100) < 1e-6 and abs(timestamp() - 1100 * 1e6) < 10
+        )
+        assert calls["task"] == 100
+        # The run continues where it left off.
+        application.step_for(10)
+        assert len(application.times) == 1010
+        application.set_reactive(True)
+        application.wake()
+        application.step_for(2)
+        assert abs(application.times[-1] - application.times[-2]) < 1e-6
+
+
+class _Lifecycle(Application):
+    def __init__(self, **kwargs):
+        super(_Lifecycle, self).__init__(quit_event=multiprocessing.Event(), **kwargs)
+        self.calls = dict(setup=0, step=0, finish=0)
+
+    def setup(self):
+        self.calls["setup"] += 1
+
+    def step(self):
+        self.calls["step"] += 1
+
+    def finish(self):
+        self.calls["finish"] += 1
+
+
+def test_application_step_for_lifecycle():
+    with virtual_clock():
+        application = _Lifecycle(run_hz=10)
+        [application.step_for(5) for _ in range(3)]
+        # The service is set up once and is not finished in between.
+        assert application.calls == dict(setup=1, step=15, finish=0)
+        application.quit()
+        application.step_for(5)
+        assert application.calls == dict(setup=1, step=15, finish=1)
+
+
+def test_application_own_clock():
+    clock = AcceleratedClock(factor=100.0)
+    application = Application(run_hz=10, clock=clock)
+    assert application.get_clock() is clock and Application().get_clock() is not clock
+    _start = time.time()
+    application.step_for(20)
+    # Twenty periods of 0.1 second in a hundredth of the time.
+    assert time.time() - _start < 0.5
+    assert clock.monotonic() >= 1.9
+
+
+def test_application_profile_deterministic(tmpdir):
+    application = _StepTimes(n_steps=1000, run_hz=100)
+    application.profiler = ProfileSession("test", directory=str(tmpdir.realpath()))
+    thread = threading.Thread(target=application.run)
+    thread.start()
+    try:
+        assert "error" not in application.profiler.start()
+        time.sleep(0.1)
+        result = application.profiler.stop()
+    finally:
+        application.quit()
+        thread.join()
+    assert "error" not in result
+    assert os.path.exists(result["file"]) and result["file"].endswith(".stats")
+    assert any("(step)" in f[0] for f in result["functions"])
+    # A profile can be taken again.
+    assert application.profiler.stop()["error"]
+
+
+def test_profile_sampling_all_threads(tmpdir):
+    session = ProfileSession("test", directory=str(tmpdir.realpath()))
+    thread = threading.Thread(target=_busy, args=(0.3,), name="busy")
+    thread.start()
+    assert session.start(mode=MODE_SAMPLING, hz=200)["mode"] == MODE_SAMPLING
+    time.sleep(0.2)
+    result = session.stop()
+    thread.join()
+    assert result["samples"] > 10
+    assert result["file"].endswith(".folded")
+    with open(result["file"]) as f:
+        assert any(line.startswith("busy;") for line in f)
+    assert "tests_utils.py:_busy" in [name for name, _ in result["self"]]
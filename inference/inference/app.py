@@ -15,10 +15,12 @@ from scipy.special import softmax
 from six.moves import range
 from sklearn.metrics.pairwise import cosine_distances
 
-from byodr.utils import timestamp, Configurable, Application
+from byodr.utils import timestamp, monotonic_timestamp, Configurable, Application
 from byodr.utils.ipc import CameraThread, JSONPublisher, LocalIPCServer, json_collector
 from byodr.utils.navigate import FileSystemRouteDataSource, ReloadableDataSource
 from byodr.utils.option import parse_option, PropertyError
+from byodr.utils.profiling import ProfileSession, register_profiler
+from byodr.utils.trace import register_tracer, span
 from .image import get_registered_function
 from .torched import DynamicMomentum, TRTDriver
 
@@ -195,14 +197,16 @@ class Navigator(object):
     def forward(self, image, route=None):
         # This runs at the service process frequency.
         self._check_state(route)
-        _dave_img = self._fn_dave_image(image)
-        _alex_img = self._fn_alex_image(image)
+        with span('inference/preprocess'):
+            _dave_img = self._fn_dave_image(image)
+            _alex_img = self._fn_alex_image(image)
         _destination = self._destination
         _command = 0 if _destination is None else 1
-        _out = self._network.forward(dave_image=_dave_img,
-                                     alex_image=_alex_img,
-                                     maneuver_command=_command,
-                                     destination=_destination)
+        with span('inference/run'):
+            _out = self._network.forward(dave_image=_dave_img,
+                                         alex_image=_alex_img,
+                                         maneuver_command=_command,
+                                         destination=_destination)
         action, critic, surprise, command, path, brake, brake_critic, coordinates, query = _out
 
         # noinspection PyUnusedLocal
@@ -210,7 +214,8 @@ class Navigator(object):
         _acquired = self._lock.acquire(False)
         try:
             if _acquired and self._store.is_open() and self._memory.is_open():
-                nav_point_id, nav_image_id, nav_distance, _destination = self._memory.match(coordinates, query)
+                with span('inference/match'):
+                    nav_point_id, nav_image_id, nav_distance, _destination = self._memory.match(coordinates, query)
         finally:
             if _acquired:
                 self._lock.release()
@@ -304,18 +309,21 @@ class TFRunner(Configurable):
         return raw * (self._steering_scale_left if raw < 0 else self._steering_scale_right)
 
     def forward(self, image, route=None):
-        _out = self._navigator.forward(image, route)
+        with span('inference/forward'):
+            _out = self._navigator.forward(image, route)
         action, critic, surprise, brake, brake_critic, nav_point_id, nav_image_id, nav_distance, command, path = _out
         _command_index = int(np.argmax(command))
-        _steer_penalty = min(1, max(0, self._fn_steer_mu(surprise=max(0, surprise), loss=abs(surprise - critic))))
-        _obstacle_penalty = min(1, max(0, self._fn_brake_mu(surprise=max(0, brake), loss=max(0, brake_critic))))
-        # The total penalty is smoothed over the instant values.
-        _total_running_penalty = min(1, max(0, self._total_penalty_filter.calculate(_steer_penalty + _obstacle_penalty)))
-        # Smooth the instant individual values for reporting purposes.
-        _normalized_brake_critic = self._fn_brake_mu(surprise=0, loss=max(0, brake_critic))
-        _steer_running_confidence = 1. - min(1, max(0, self._steer_confidence_filter.calculate(_steer_penalty)))
-        _brake_running_confidence = 1. - min(1, max(0, self._brake_confidence_filter.calculate(_normalized_brake_critic)))
+        with span('inference/penalties'):
+            _steer_penalty = min(1, max(0, self._fn_steer_mu(surprise=max(0, surprise), loss=abs(surprise - critic))))
+            _obstacle_penalty = min(1, max(0, self._fn_brake_mu(surprise=max(0, brake), loss=max(0, brake_critic))))
+            # The total penalty is smoothed over the instant values.
+            _total_running_penalty = min(1, max(0, self._total_penalty_filter.calculate(_steer_penalty + _obstacle_penalty)))
+            # Smooth the instant individual values for reporting purposes.
+            _normalized_brake_critic = self._fn_brake_mu(surprise=0, loss=max(0, brake_critic))
+            _steer_running_confidence = 1. - min(1, max(0, self._steer_confidence_filter.calculate(_steer_penalty)))
+            _brake_running_confidence = 1. - min(1, max(0, self._brake_confidence_filter.calculate(_normalized_brake_critic)))
         return dict(time=timestamp(),
+                    mono=monotonic_timestamp(),
                     action=float(self._dnn_steering(action)),
                     obstacle=float(brake),
                     surprise_out=float(surprise),
@@ -336,8 +344,8 @@ class TFRunner(Configurable):
 
 
 class InferenceApplication(Application):
-    def __init__(self, runner=None, config_dir=os.getcwd(), internal_models=os.getcwd(), user_models=None, navigation_routes=None):
-        super(InferenceApplication, self).__init__()
+    def __init__(self, runner=None, config_dir=os.getcwd(), internal_models=os.getcwd(), user_models=None, navigation_routes=None, clock=None):
+        super(InferenceApplication, self).__init__(clock=clock)
         self._config_dir = config_dir
         self._internal_models = internal_models
         self._user_models = user_models
@@ -353,6 +361,7 @@ class InferenceApplication(Application):
         self.ipc_server = None
         self.teleop = None
         self.ipc_chatter = None
+        self.add_task(self.check_chatter, hz=5, name='chatter')
 
     @staticmethod
     def _glob(directory, pattern):
@@ -382,13 +391,6 @@ class InferenceApplication(Application):
     def finish(self):
         self._runner.quit()
 
-    # def run(self):
-    #     from byodr.utils import Profiler
-    #     profiler = Profiler()
-    #     with profiler():
-    #         super(InferenceApplication, self).run()
-    #     profiler.dump_stats('/config/inference.stats')
-
     def step(self):
         # Leave the state as is on empty teleop state.
         c_teleop = self.teleop()
@@ -399,6 +401,8 @@ class InferenceApplication(Application):
             state = self._runner.forward(image=image, route=c_route)
             state['_fps'] = self.get_actual_hz()
             self.publisher.publish(state)
+
+    def check_chatter(self):
         chat = self.ipc_chatter()
         if chat is not None:
             if chat.get('command') == 'restart':
@@ -422,9 +426,13 @@ def main():
     teleop = json_collector(url='ipc:///byodr/teleop.sock', topic=b'aav/teleop/input', event=quit_event)
     ipc_chatter = json_collector(url='ipc:///byodr/teleop_c.sock', topic=b'aav/teleop/chatter', pop=True, event=quit_event)
 
-    application.publisher = JSONPublisher(url='ipc:///byodr/inference.sock', topic='aav/inference/state')
+    application.publisher = JSONPublisher(url='ipc:///byodr/inference.sock', topic='aav/inference/state', binary=True)
     application.camera = CameraThread(url='ipc:///byodr/camera_0.sock', topic=b'aav/camera/0', event=quit_event)
     application.ipc_server = LocalIPCServer(url='ipc:///byodr/inference_c.sock', name='inference', event=quit_event)
+    application.ipc_server.register_request('system/task/stats', lambda m: application.get_task_stats())
+    application.profiler = ProfileSession('inference', directory=args.config)
+    register_profiler(application.ipc_server, application.profiler)
+    register_tracer(application.ipc_server)
     application.teleop = lambda: teleop.get()
     application.ipc_chatter = lambda: ipc_chatter.get()
 
@@ -18,6 +18,8 @@ from byodr.utils import Application, ApplicationExit
 from byodr.utils.ipc import JSONPublisher, LocalIPCServer, json_collector
 from byodr.utils.navigate import FileSystemRouteDataSource, ReloadableDataSource
 from byodr.utils.option import parse_option
+from byodr.utils.profiling import ProfileSession, register_profiler
+from byodr.utils.trace import register_tracer, span
 from byodr.utils.usbrelay import SearchUsbRelayFactory, StaticRelayHolder, TransientMemoryRelay
 from .core import CommandProcessor
 from .relay import RealMonitoringRelay, NoopMonitoringRelay
@@ -37,8 +39,8 @@ def _interrupt():
 
 
 class PilotApplication(Application):
-    def __init__(self, event, processor, relay, config_dir=os.getcwd()):
-        super(PilotApplication, self).__init__(quit_event=event)
+    def __init__(self, event, processor, relay, config_dir=os.getcwd(), clock=None):
+        super(PilotApplication, self).__init__(quit_event=event, deadlines=True, clock=clock)
         self._config_dir = config_dir
         self._processor = processor
         self._monitor = None
@@ -46,6 +48,7 @@ class PilotApplication(Application):
         self.publisher = None
         self.ipc_server = None
         self.ipc_chatter = None
+        self.add_task(self.check_chatter, hz=5, name='chatter')
         self.teleop = None
         self.ros = None
         self.vehicle = None
@@ -94,26 +97,37 @@ class PilotApplication(Application):
                 self.ipc_server.register_start(_errors + self._processor.get_errors())
                 _frequency = self._processor.get_frequency()
                 self.set_hz(_frequency)
+                self.set_reactive(self._processor.is_wake_on_message())
                 self.logger.info("Processing at {} Hz - patience is {:2.2f} ms.".format(_frequency, self._processor.get_patience_ms()))
 
     def finish(self):
         self._monitor.quit()
         self._processor.quit()
 
-    # def run(self):
-    #     from byodr.utils import Profiler
-    #     profiler = Profiler()
-    #     with profiler():
-    #         super(PilotApplication, self).run()
-    #     profiler.dump_stats('/config/pilot.stats')
+    def get_link_stats(self):
+        return {} if self._monitor is None else self._monitor.get_link_stats()
+
+    def _correlate(self, pilot, teleop):
+        # The output carries the correlation id of the operator command and the confirmations of commands as received from ras.
+        if teleop is not None and 'cid' in teleop:
+            pilot['cid'] = teleop['cid']
+            pilot['hops'] = teleop.get('hops', []) + [['pilot', pilot['time']]]
+        _actuation = self._monitor.pop_actuation()
+        if _actuation is not None:
+            pilot['actuation'] = _actuation
 
     def step(self):
-        teleop = self.teleop()
-        commands = (teleop, self.ros(), self.vehicle(), self.inference())
-        pilot = self._processor.next_action(*commands)
-        self._monitor.step(pilot, teleop)
-        if pilot is not None:
-            self.publisher.publish(pilot)
+        with span('pilot/step'):
+            teleop = self.teleop()
+            commands = (teleop, self.ros(), self.vehicle(), self.inference())
+            pilot = self._processor.next_action(*commands)
+            if pilot is not None:
+                self._correlate(pilot, teleop)
+            self._monitor.step(pilot, teleop)
+            if pilot is not None:
+                self.publisher.publish(pilot)
+
+    def check_chatter(self):
         chat = self.ipc_chatter()
         if chat is not None:
             if chat.get('command') == 'restart':
@@ -143,9 +157,18 @@ def main():
     application.ros = lambda: ros.get()
     application.vehicle = lambda: vehicle.get()
     application.inference = lambda: inference.get()
+    # These messages trigger a step when the application runs reactive.
+    teleop.add_listener(lambda m: application.wake())
+    inference.add_listener(lambda m: application.wake())
     application.ipc_chatter = lambda: ipc_chatter.get()
-    application.publisher = JSONPublisher(url='ipc:///byodr/pilot.sock', topic='aav/pilot/output')
+    application.publisher = JSONPublisher(url='ipc:///byodr/pilot.sock', topic='aav/pilot/output', binary=True)
     application.ipc_server = LocalIPCServer(url='ipc:///byodr/pilot_c.sock', name='pilot', event=quit_event)
+    application.ipc_server.register_request('system/loop/stats', lambda m: application.get_schedule_stats())
+    application.ipc_server.register_request('system/task/stats', lambda m: application.get_task_stats())
+    application.ipc_server.register_request('system/link/stats', lambda m: application.get_link_stats())
+    application.profiler = ProfileSession('pilot', directory=args.config)
+    register_profiler(application.ipc_server, application.profiler)
+    register_tracer(application.ipc_server)
     threads = [teleop, ros, vehicle, inference, ipc_chatter, application.ipc_server, threading.Thread(target=application.run)]
     if quit_event.is_set():
         return 0
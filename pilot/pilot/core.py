@@ -14,9 +14,17 @@ import six
 from simple_pid import PID as pid_control
 from six.moves import zip
 
-from byodr.utils import timestamp, Configurable
+from byodr.utils import (
+    timestamp,
+    monotonic,
+    monotonic_timestamp,
+    message_age,
+    Configurable,
+)
+from byodr.utils.codec import PILOT_OUTPUT, SchemaRecord
 from byodr.utils.navigate import NavigationCommand, NavigationInstructions
 from byodr.utils.option import parse_option
+from byodr.utils.trace import span
 
 logger = logging.getLogger(__name__)
 
@@ -44,47 +52,40 @@ class OriginType(ClassificationType):
     BACKEND_AUTOPILOT = "src.backend.autopilot"
 
 
-class AttrDict(dict):
-    """Access dictionary items through instance attributes."""
+def _is_forced_value(value):
+    return abs(0 if value is None else value) > 0
 
-    def __init__(self, **kwargs):
-        super(AttrDict, self).__init__(**kwargs)
-        self.__dict__ = self
 
+def _run(target, synchronous, *args):
+    # Background work runs inline in simulations so that the outcome of a step does not depend on thread timing.
+    if synchronous:
+        target(*args)
+    else:
+        threading.Thread(target=target, args=args).start()
 
-def _is_forced_value(value):
-    return abs(0 if value is None else value) > 0
 
+class PilotCommand(SchemaRecord):
+    """The pilot output of a step with a slot per field of the pilot output schema."""
 
-class Blob(AttrDict):
-    def __init__(self, **kwargs):
-        super(Blob, self).__init__(**kwargs)
+    __slots__ = PILOT_OUTPUT.get_names()
+    codec = PILOT_OUTPUT
+
+    def reset(self, command=None):
+        """Start over as the command, typically the teleop one, with the time of now and the field defaults."""
+        self.clear()
+        self.steering = 0
+        self.steering_scale = 1
+        self.throttle = 0
+        self.navigation_match_image = -1
+        self.navigation_match_distance = 1
+        self.inference_brake = 0
+        if command:
+            self.update(command)
         self.time = timestamp()
-        self.cruise_speed = kwargs.get("cruise_speed")
-        self.desired_speed = kwargs.get("desired_speed")
-        self.driver = kwargs.get("driver")
-        self.driver_activation_time = kwargs.get("driver_activation_time")
-        self.forced_acceleration = kwargs.get("forced_acceleration")
-        self.forced_deceleration = kwargs.get("forced_deceleration")
-        self.forced_steering = kwargs.get("forced_steering")
-        self.forced_throttle = kwargs.get("forced_throttle")
-        self.instruction = kwargs.get("instruction")
-        self.save_event = kwargs.get("save_event")
-        self.speed_driver = kwargs.get("speed_driver")
-        self.steering = kwargs.get("steering", 0)
-        self.steering_scale = kwargs.get("steering_scale", 1)
-        self.steering_driver = kwargs.get("steering_driver")
-        self.throttle = kwargs.get("throttle", 0)
-        self.arrow_up = kwargs.get("arrow_up")
-        self.arrow_down = kwargs.get("arrow_down")
-        self.button_left = kwargs.get("button_left")
-        self.button_right = kwargs.get("button_right")
-        self.navigation_active = kwargs.get("navigation_active")
-        self.navigation_route = kwargs.get("navigation_route")
-        self.navigation_match_image = kwargs.get("navigation_match_image", -1)
-        self.navigation_match_distance = kwargs.get("navigation_match_distance", 1)
-        self.navigation_match_point = kwargs.get("navigation_match_point")
-        self.inference_brake = kwargs.get("inference_brake", 0)
+        self.mono = monotonic_timestamp()
+        return self
+
+    def resolve_forced(self):
         if self.forced_steering is None:
             self.forced_steering = _is_forced_value(self.steering)
         if self.forced_throttle is None:
@@ -235,7 +236,8 @@ class PidThrottleControl(AbstractThrottleControl):
     def __init__(self, pid_config, stop_p, min_desired_speed, max_desired_speed):
         super(PidThrottleControl, self).__init__(min_desired_speed, max_desired_speed)
         (p, i, d) = pid_config
-        self._pid = pid_control(p, i, d, setpoint=0)
+        # The pid reads the time of the process clock, which is virtual in simulations.
+        self._pid = pid_control(p, i, d, setpoint=0, time_fn=monotonic)
         self._pid.output_limits = (-1, 1)
         self._stop_p = stop_p
         self._min_desired_speed = min_desired_speed
@@ -585,8 +587,9 @@ def _translate_navigation_direction(direction):
 
 
 class Navigator(object):
-    def __init__(self, route_store):
+    def __init__(self, route_store, synchronous=False):
         self._store = route_store
+        self._synchronous = synchronous
         self._open_lock = threading.Lock()
         self._override_requests = collections.deque(maxlen=1)
         self._match_point = None
@@ -637,9 +640,9 @@ class Navigator(object):
         if route is None:
             self.close()
         elif route not in self._store.list_routes():
-            threading.Thread(target=self.reload).start()
+            _run(self.reload, self._synchronous)
         elif route != self._store.get_selected_route():
-            threading.Thread(target=self._open_store, args=(route,)).start()
+            _run(self._open_store, self._synchronous, route)
 
     def set_override_request(self, request):
         self._override_requests.append(request)
@@ -694,9 +697,10 @@ class Navigator(object):
 
 
 class DriverManager(Configurable):
-    def __init__(self, route_store):
+    def __init__(self, route_store, synchronous=False):
         super(DriverManager, self).__init__()
-        self._navigator = Navigator(route_store)
+        self._synchronous = synchronous
+        self._navigator = Navigator(route_store, synchronous=synchronous)
         self._navigation_queue = deque(maxlen=10)
         self._principal_steer_scale = 0
         # Static conversion factor of m/s to km/h.
@@ -708,6 +712,13 @@ class DriverManager(Configurable):
         self._lock = multiprocessing.RLock()
         self._driver = None
         self._driver_ctl = None
+        # The outputs are taken from a ring of records in turn which keeps an output valid for the next few steps.
+        self._commands = [PilotCommand() for _ in range(4)]
+        self._command_count = 0
+
+    def _next_command(self, command=None):
+        self._command_count += 1
+        return self._commands[self._command_count % len(self._commands)].reset(command)
 
     def internal_quit(self, restarting=False):
         for driver in self._driver_cache.values():
@@ -858,15 +869,16 @@ class DriverManager(Configurable):
                 # The switch must be immediate. Do not force wait on the previous driver to deactivate.
                 if control != self._driver_ctl:
                     if self._driver is not None:
-                        threading.Thread(target=self._driver.deactivate).start()
+                        _run(self._driver.deactivate, self._synchronous)
                     self._driver_ctl = control
                     self._navigation_queue.clear()
                     self._driver = self._get_driver(control=control)
-                    threading.Thread(target=self._activate).start()
+                    _run(self._activate, self._synchronous)
                     logger.info("Pilot switch control to '{}'.".format(control))
 
     def noop(self):
-        blob = Blob()
+        blob = self._next_command()
+        blob.resolve_forced()
         self._driver.noop(blob)
         return blob
 
@@ -892,19 +904,18 @@ class DriverManager(Configurable):
             _driver_activation_time = self._driver.get_activation_timestamp()
             if _driver_activation_time is not None:
                 _driver_activation_time = (timestamp() - _driver_activation_time) * 1e-3
-            blob = Blob(
-                driver=self._driver_ctl,
-                driver_activation_time=_driver_activation_time,
-                cruise_speed=self._pilot_state.cruise_speed,
-                instruction=self._pilot_state.instruction,
-                navigation_active=_nav_active,
-                navigation_route=_nav_route,
-                navigation_match_image=_nav_match_image,
-                navigation_match_distance=_nav_match_distance,
-                navigation_match_point=_nav_match_point,
-                inference_brake=_inference_brake,
-                **teleop
-            )
+            blob = self._next_command(teleop)
+            blob.driver = self._driver_ctl
+            blob.driver_activation_time = _driver_activation_time
+            blob.cruise_speed = self._pilot_state.cruise_speed
+            blob.instruction = self._pilot_state.instruction
+            blob.navigation_active = _nav_active
+            blob.navigation_route = _nav_route
+            blob.navigation_match_image = _nav_match_image
+            blob.navigation_match_distance = _nav_match_distance
+            blob.navigation_match_point = _nav_match_point
+            blob.inference_brake = _inference_brake
+            blob.resolve_forced()
             # Scale teleop before interpretation by the driver.
             blob.steering_scale = self._principal_steer_scale
             blob.steering = self._principal_steer_scale * blob.steering
@@ -914,10 +925,14 @@ class DriverManager(Configurable):
 
 
 class CommandProcessor(Configurable):
-    def __init__(self, route_store):
+    def __init__(self, route_store, synchronous=False):
+        """
+        :param synchronous: Switch drivers and load routes on the calling thread instead of in the background.
+        """
         super(CommandProcessor, self).__init__()
-        self._driver = DriverManager(route_store)
+        self._driver = DriverManager(route_store, synchronous=synchronous)
         self._process_frequency = 10
+        self._wake_on_message = False
         self._button_north_ctl = None
         self._button_west_ctl = None
         self._patience_micro = 1000.0
@@ -929,6 +944,9 @@ class CommandProcessor(Configurable):
     def get_frequency(self):
         return self._process_frequency
 
+    def is_wake_on_message(self):
+        return self._wake_on_message
+
     def internal_quit(self, restarting=False):
         if not restarting:
             self._driver.quit()
@@ -937,6 +955,10 @@ class CommandProcessor(Configurable):
         _errors = []
         self._driver.restart(**kwargs)
         self._process_frequency = parse_option("clock.hz", int, 80, _errors, **kwargs)
+        # Step on the arrival of teleop and inference messages with the clock as the minimum rate.
+        self._wake_on_message = (
+            parse_option("clock.wake.on.message", int, 0, _errors, **kwargs) == 1
+        )
         self._patience_micro = (
             parse_option("patience.ms", int, 200, _errors, **kwargs) * 1000.0
         )
@@ -953,7 +975,7 @@ class CommandProcessor(Configurable):
         # Avoid processing the same command more than once.
         # TTL is specified in seconds.
         self._cache = cachetools.TTLCache(
-            maxsize=100, ttl=(self._patience_micro * 1e-6)
+            maxsize=100, ttl=(self._patience_micro * 1e-6), timer=monotonic
         )
         return _errors + self._driver.get_errors()
 
@@ -1042,32 +1064,35 @@ class CommandProcessor(Configurable):
             )
 
     def _unpack_commands(self, teleop, ros, vehicle, inference):
-        _patience, _ts = self._patience_micro, timestamp()
+        _patience = self._patience_micro
         # The teleop, vehicle or inference commands could be none, old or repeated.
-        teleop_time = 0 if teleop is None else teleop.get("time", 0)
-        vehicle_time = 0 if vehicle is None else vehicle.get("time", 0)
-        inference_time = 0 if inference is None else inference.get("time", 0)
-
+        # Their age is by the monotonic clock, when they carry its timestamp, so that clock adjustments do not drop them.
         teleop = (
-            teleop if teleop is not None and (_ts - teleop_time < _patience) else None
+            teleop if teleop is not None and message_age(teleop) < _patience else None
         )
         vehicle = (
             vehicle
-            if vehicle is not None and (_ts - vehicle_time < _patience)
+            if vehicle is not None and message_age(vehicle) < _patience
             else None
         )
         inference = (
             inference
-            if inference is not None and (_ts - inference_time < _patience)
+            if inference is not None and message_age(inference) < _patience
             else None
         )
         # The external and ros commands need to be handled each occurrence.
         return teleop, ros, vehicle, inference
 
+    def _driver_action(self, *args):
+        with span("pilot/driver"):
+            return self._driver.next_action(*args)
+
     def next_action(self, *args):
-        teleop, ros, vehicle, inference = self._unpack_commands(*args)
+        with span("pilot/unpack"):
+            teleop, ros, vehicle, inference = self._unpack_commands(*args)
         # Handle instructions first.
-        self._process(teleop, ros, inference)
+        with span("pilot/process"):
+            self._process(teleop, ros, inference)
         # What to do on message timeout depends on which driver is active.
         _ctl = self._driver.get_driver_ctl()
         # Switch off autopilot on internal errors.
@@ -1081,12 +1106,12 @@ class CommandProcessor(Configurable):
         if None not in (teleop, vehicle, inference) or (
             None not in (teleop, vehicle) and _ctl == "driver_mode.teleop.direct"
         ):
-            return self._driver.next_action(teleop, vehicle, inference)
+            return self._driver_action(teleop, vehicle, inference)
         # Autopilot drives without teleop commands.
         if None not in (vehicle, inference) and _ctl == "driver_mode.inference.dnn":
-            return self._driver.next_action(dict(), vehicle, inference)
+            return self._driver_action(dict(), vehicle, inference)
         # Vehicle control by backend.
         if vehicle is not None and _ctl == "driver_mode.automatic.backend":
-            return self._driver.next_action(dict(), vehicle, inference)
+            return self._driver_action(dict(), vehicle, inference)
         # Ignore old or repetitive teleop commands.
         return None
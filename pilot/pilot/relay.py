@@ -5,20 +5,26 @@ import collections
 import glob
 import logging
 import os
+import threading
 from abc import ABCMeta, abstractmethod
 
 import six
 from six.moves.configparser import SafeConfigParser
 
-from byodr.utils import timestamp
-from byodr.utils.ipc import ReceiverThread, JSONZmqClient
+from byodr.utils import timestamp, monotonic, monotonic_timestamp, message_age
+from byodr.utils.ipc import ReceiverThread, JSONPushClient, JSONZmqClient
+from byodr.utils.metrics import Histogram
 from byodr.utils.option import parse_option, hash_dict
 from byodr.utils.protocol import MessageStreamProtocol
+from byodr.utils.trace import span
 from byodr.utils.usbrelay import SingleChannelUsbRelay
 
 logger = logging.getLogger(__name__)
 log_format = "%(levelname)s: %(filename)s %(funcName)s %(message)s"
 
+# The first and the longest wait in seconds between attempts to reconnect to the pi.
+RECONNECT_BACKOFF = (0.5, 10.0)
+
 
 def execute(arguments):
     _device = SingleChannelUsbRelay()
@@ -47,14 +53,80 @@ class PiClientFactory(object):
 
     @staticmethod
     def create(master_uri):
-        return JSONZmqClient(urls="{}:5550".format(master_uri))
+        return JSONZmqClient(urls="{}:5550".format(master_uri), clock=True)
+
+
+class DriveClientFactory(object):
+    @staticmethod
+    def create(master_uri):
+        return JSONPushClient(url="{}:5551".format(master_uri))
+
+
+class PiLinkThread(threading.Thread):
+    """
+    The acknowledged requests to the pi run on this thread so that a slow or absent pi cannot block the pilot step. The
+    configuration is sent until the pi confirms it and in between the clock exchanges keep up the offset of the pi clock.
+    """
+
+    def __init__(self, client_factory, master_uri, clock_hz=1.0):
+        super(PiLinkThread, self).__init__()
+        self.daemon = True
+        self._client_factory = client_factory
+        self._master_uri = master_uri
+        self._period = 1.0 / clock_hz
+        self._client = None
+        self._config = collections.deque(maxlen=1)
+        self._wake_event = threading.Event()
+        self._quit_event = threading.Event()
+        self._reconnect = False
+
+    def send_config(self, data):
+        self._config.append(data)
+        self._wake_event.set()
+
+    def is_pending(self):
+        return bool(self._config)
+
+    def reconnect(self):
+        self._reconnect = True
+        self._wake_event.set()
+
+    def get_clock(self):
+        _client = self._client
+        return None if _client is None else _client.get_clock()
+
+    def quit(self):
+        self._quit_event.set()
+        self._wake_event.set()
+
+    def _call(self):
+        _config = self._config.popleft() if self._config else None
+        if _config is None:
+            self._client.call(dict(time=timestamp(), method="ras/clock/sync"))
+            return
+        _reply = self._client.call(
+            dict(time=timestamp(), method="ras/driver/config", data=_config)
+        )
+        if not _reply.get("ack") and not self._config:
+            self._config.append(_config)
+
+    def run(self):
+        self._client = self._client_factory.create(self._master_uri)
+        while not self._quit_event.is_set():
+            if self._reconnect:
+                self._reconnect = False
+                self._client.quit()
+                self._client = self._client_factory.create(self._master_uri)
+            self._call()
+            self._wake_event.wait(self._period)
+            self._wake_event.clear()
+        self._client.quit()
 
 
 class AbstractRelay(six.with_metaclass(ABCMeta, object)):
     @staticmethod
     def _latest_or_none(candidate, patience):
-        _time = 0 if candidate is None else candidate.get("time", 0)
-        _on_time = (timestamp() - _time) < patience
+        _on_time = candidate is not None and message_age(candidate) < patience
         return candidate if _on_time else None
 
     @abstractmethod
@@ -64,6 +136,18 @@ class AbstractRelay(six.with_metaclass(ABCMeta, object)):
     def step(self, pilot, teleop):
         pass
 
+    def pop_actuation(self):
+        """
+        :return: The correlation id and hops of the latest command confirmed by the drive or None.
+        """
+        return None
+
+    def get_link_stats(self):
+        """
+        :return: The clock offset and latencies of the link to the drive.
+        """
+        return {}
+
     def quit(self):
         pass
 
@@ -81,7 +165,12 @@ class NoopMonitoringRelay(AbstractRelay):
 
 class RealMonitoringRelay(AbstractRelay):
     def __init__(
-        self, relay, client_factory=None, status_factory=None, config_dir=os.getcwd()
+        self,
+        relay,
+        client_factory=None,
+        status_factory=None,
+        drive_factory=None,
+        config_dir=os.getcwd(),
     ):
         super(RealMonitoringRelay, self).__init__()
         self._relay = relay
@@ -93,43 +182,69 @@ class RealMonitoringRelay(AbstractRelay):
         self._client_factory = (
             PiClientFactory() if client_factory is None else client_factory
         )
+        self._drive_factory = (
+            DriveClientFactory() if drive_factory is None else drive_factory
+        )
         self._relay_closed_calltrace = collections.deque(maxlen=1)
         self._patience_micro = 100.0
         self._config_hash = -1
         self._pi_config = None
-        self._pi_client = None
+        self._pi_link = None
+        self._pi_drive = None
         self._pi_status = None
         self._servo_config = None
+        self._config_sent = None
+        # Reconnects after a long loss of the pi wait longer each time until the stream is back.
+        self._backoff = RECONNECT_BACKOFF[0]
+        self._reconnect_at = None
+        self._n_reconnects = 0
+        self._actuations = collections.deque(maxlen=1)
+        # The one-way latency of the drive status in milliseconds, by the estimated offset of the clock of the pi.
+        self._status_latency = Histogram()
 
     def _send_config(self, data):
-        if self._pi_client is not None and data is not None:
-            self._pi_client.call(
-                dict(time=timestamp(), method="ras/driver/config", data=data)
-            )
-
-    def _send_drive(self, throttle=0.0, steering=0.0, reverse_gear=False, wakeup=False):
-        if self._pi_client is not None:
+        if self._pi_link is not None and data is not None:
+            self._pi_link.send_config(data)
+            self._config_sent = monotonic()
+
+    def _send_drive(
+        self,
+        throttle=0.0,
+        steering=0.0,
+        reverse_gear=False,
+        wakeup=False,
+        cid=None,
+        hops=None,
+    ):
+        if self._pi_drive is not None:
             throttle = max(-1.0, min(1.0, throttle))
             steering = max(-1.0, min(1.0, steering))
             _reverse = 1 if reverse_gear else 0
             _wakeup = 1 if wakeup else 0
-            self._pi_client.call(
-                dict(
-                    time=timestamp(),
-                    method="ras/servo/drive",
-                    data=dict(
-                        steering=steering,
-                        throttle=throttle,
-                        reverse=_reverse,
-                        wakeup=_wakeup,
-                    ),
-                )
+            _time = timestamp()
+            message = dict(
+                time=_time,
+                mono=monotonic_timestamp(),
+                method="ras/servo/drive",
+                data=dict(
+                    steering=steering,
+                    throttle=throttle,
+                    reverse=_reverse,
+                    wakeup=_wakeup,
+                ),
             )
+            if cid is not None:
+                message.update(cid=cid, hops=(hops or []) + [["relay", _time]])
+            self._pi_drive.send(message)
 
     def _drive(self, pilot, teleop):
         pi_status = None if self._pi_status is None else self._pi_status.pop_latest()
         if pi_status is not None and not bool(pi_status.get("configured")):
-            self._send_config(self._servo_config)
+            # The pi reports the configuration a few steps after the acknowledgement.
+            _pending = self._pi_link is not None and self._pi_link.is_pending()
+            _due = self._config_sent is None or monotonic() - self._config_sent > 1
+            if _due and not _pending:
+                self._send_config(self._servo_config)
         if pilot is None:
             self._send_drive()
         else:
@@ -140,6 +255,8 @@ class RealMonitoringRelay(AbstractRelay):
                 throttle=pilot.get("throttle"),
                 reverse_gear=_reverse,
                 wakeup=_wakeup,
+                cid=pilot.get("cid"),
+                hops=pilot.get("hops"),
             )
 
     def _config(self):
@@ -148,7 +265,25 @@ class RealMonitoringRelay(AbstractRelay):
         return dict(parser.items("vehicle")) if parser.has_section("vehicle") else {}
 
     def _on_receive(self, msg):
-        self._integrity.on_message(msg.get("time"))
+        self._integrity.on_message(msg.get("mono", msg.get("time")))
+        _clock = None if self._pi_link is None else self._pi_link.get_clock()
+        _sent = None if _clock is None else _clock.to_local(msg.get("mono"))
+        if _sent is not None:
+            self._status_latency.record((monotonic_timestamp() - _sent) * 1e-3)
+        if msg.get("cid") is not None:
+            self._actuations.append(dict(cid=msg.get("cid"), hops=msg.get("hops")))
+
+    def pop_actuation(self):
+        return self._actuations.popleft() if self._actuations else None
+
+    def get_link_stats(self):
+        _clock = None if self._pi_link is None else self._pi_link.get_clock()
+        return dict(
+            clock=None if _clock is None else _clock.to_dict(),
+            status_latency_ms=self._status_latency.to_dict(),
+            drive=None if self._pi_drive is None else self._pi_drive.get_stats(),
+            reconnects=self._n_reconnects,
+        )
 
     def setup(self):
         _hash = hash_dict(**self._config())
@@ -167,16 +302,13 @@ class RealMonitoringRelay(AbstractRelay):
         _pi_uri = parse_option(
             "ras.master.uri", str, "tcp://192.168.1.32", errors, **_config
         )
-        if self._pi_client is not None:
-            self._pi_client.quit()
-        if self._pi_status is not None:
-            self._pi_status.quit()
+        self._quit_pi()
         logger.info("Processing pi at uri '{}'.".format(_pi_uri))
         self._pi_config = _pi_uri
-        self._pi_client = self._client_factory.create(_pi_uri)
-        self._pi_status = self._status_factory.create(_pi_uri)
-        self._pi_status.add_listener(self._on_receive)
-        self._pi_status.start()
+        self._pi_link = PiLinkThread(self._client_factory, _pi_uri)
+        self._pi_link.start()
+        self._pi_drive = self._drive_factory.create(_pi_uri)
+        self._start_status()
         _steering_offset = parse_option(
             "ras.driver.steering.offset", float, 0.0, errors, **_config
         )
@@ -187,9 +319,41 @@ class RealMonitoringRelay(AbstractRelay):
             app_version=2, steering_offset=_steering_offset, motor_scale=_motor_scale
         )
         self._integrity.reset()
+        self._status_latency.reset()
+        self._backoff, self._reconnect_at = RECONNECT_BACKOFF[0], None
         self._send_config(self._servo_config)
         return errors
 
+    def _start_status(self):
+        self._pi_status = self._status_factory.create(self._pi_config)
+        self._pi_status.add_listener(self._on_receive)
+        self._pi_status.start()
+
+    def _quit_pi(self):
+        if self._pi_link is not None:
+            self._pi_link.quit()
+        if self._pi_drive is not None:
+            self._pi_drive.quit()
+        if self._pi_status is not None:
+            self._pi_status.quit()
+
+    def _reconnect(self):
+        # ZeroMQ over tcp does not allow connection timeouts to be set - while the timeout is too high.
+        _now = monotonic()
+        if self._reconnect_at is None:
+            self._reconnect_at = _now + self._backoff
+        elif _now >= self._reconnect_at:
+            logger.info(
+                "Reconnecting to the pi after {:2.1f} seconds.".format(self._backoff)
+            )
+            self._n_reconnects += 1
+            self._pi_link.reconnect()
+            self._pi_drive.reconnect()
+            self._pi_status.quit()
+            self._start_status()
+            self._backoff = min(RECONNECT_BACKOFF[1], self._backoff * 2)
+            self._reconnect_at = _now + self._backoff
+
     def _open_relay(self):
         self._relay.open()
         self._relay_closed_calltrace.clear()
@@ -206,27 +370,27 @@ class RealMonitoringRelay(AbstractRelay):
 
     def quit(self):
         self._open_relay()
-        if self._pi_client is not None:
-            self._pi_client.quit()
-        if self._pi_status is not None:
-            self._pi_status.quit()
+        self._quit_pi()
 
     def step(self, pilot, teleop):
-        # Always consume the latest commands.
-        c_pilot = self._latest_or_none(pilot, patience=self._patience_micro)
-        c_teleop = self._latest_or_none(teleop, patience=self._patience_micro)
-        n_violations = self._integrity.check()
-        if n_violations < -5:
-            self._close_relay()
-            self._drive(c_pilot, c_teleop)
-        elif n_violations > 200:
-            # ZeroMQ ipc over tcp does not allow connection timeouts to be set - while the timeout is too high.
-            self._reboot()  # Resets the protocol.
-        elif n_violations > 5:
-            self._open_relay()
-            self._drive(None, None)
-        else:
-            self._drive(None, None)
+        with span("relay/step"):
+            # Always consume the latest commands.
+            c_pilot = self._latest_or_none(pilot, patience=self._patience_micro)
+            c_teleop = self._latest_or_none(teleop, patience=self._patience_micro)
+            n_violations = self._integrity.check()
+            if n_violations < -5:
+                self._backoff, self._reconnect_at = RECONNECT_BACKOFF[0], None
+                self._close_relay()
+                self._drive(c_pilot, c_teleop)
+            elif n_violations > 200:
+                self._open_relay()
+                self._drive(None, None)
+                self._reconnect()
+            elif n_violations > 5:
+                self._open_relay()
+                self._drive(None, None)
+            else:
+                self._drive(None, None)
 
 
 def main():
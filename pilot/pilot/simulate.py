@@ -0,0 +1,341 @@
+"""
+Offline simulation of the pilot command processing on a virtual clock, many times faster than real time.
+
+A scenario is a list of segments, each of which repeats the same teleop, ros and inference messages for a number of steps.
+The vehicle messages come from a simple velocity model that is driven by the throttle of the pilot, which closes the loop
+of the cruise control. The outputs of the steps reduce to a trace that is compared with a golden trace of an earlier run.
+
+    {"name": "cruise", "hz": 80, "config": {"driver.cc.control.type": "pid"}, "segments": [
+        {"steps": 10, "teleop": {"button_y": 1}, "inference": {}},
+        {"steps": 5, "teleop": {"arrow_up": 1}, "inference": {}},
+        {"steps": 800, "teleop": {}, "inference": {"action": 0.1}}]}
+
+A message that is absent from a segment is not sent; delay_ms ages the messages of a segment by topic.
+The segments of a scenario can instead come from a bag recording, relative to the scenario file, with a step per period of
+the pilot and the teleop, ros and inference messages as they arrived by then - the vehicle still comes from the model.
+
+    {"name": "session", "hz": 80, "bag": "session.bag"}
+
+A scenario without a golden trace fails unless the golden traces are being updated.
+
+    python -m pilot.simulate scenarios/*.json --golden scenarios/golden [--update] [--synthetic 1000]
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import time
+
+import numpy as np
+
+from byodr.utils import ManualClock, set_clock
+from byodr.utils.bag import BagReader
+from byodr.utils.metrics import Histogram
+from byodr.utils.navigate import FileSystemRouteDataSource, ReloadableDataSource
+from .core import CommandProcessor
+
+logger = logging.getLogger(__name__)
+
+# The fields of the pilot output in a trace.
+TRACE_FIELDS = ("driver", "instruction", "steering", "throttle", "desired_speed")
+
+# The cost of a step in microseconds.
+_COST_BOUNDS_US = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_INFERENCE_DEFAULTS = dict(
+    action=0.0,
+    obstacle=0.0,
+    surprise_out=0.0,
+    critic_out=0.0,
+    steer_penalty=0.0,
+    brake_penalty=0.0,
+    total_penalty=0.0,
+    navigation_point=-1,
+    navigation_image=-1,
+    navigation_distance=1.0,
+)
+
+# A fixed start of the virtual wall time keeps the traces reproducible.
+_EPOCH = 1.6e9
+
+# The recorded topics that make up the steps of a bag scenario.
+BAG_TOPICS = dict(
+    teleop="aav/teleop/input", ros="aav/ros/input", inference="aav/inference/state"
+)
+
+
+class VehicleModel(object):
+    """
+    First order response of the velocity to the throttle. The velocity moves towards the throttle share of the top speed
+    with the time constant and negative throttle brakes towards standstill. The vehicle does not reverse.
+    """
+
+    def __init__(self, top_speed=3.0, time_constant=0.5, brake_constant=0.2):
+        self._top_speed = top_speed
+        self._time_constant = time_constant
+        self._brake_constant = brake_constant
+        self.velocity = 0.0
+
+    def update(self, throttle, dt):
+        throttle = 0.0 if throttle is None else throttle
+        _target = max(0.0, throttle) * self._top_speed
+        _constant = self._brake_constant if throttle < 0 else self._time_constant
+        self.velocity += (_target - self.velocity) * min(1.0, dt / _constant)
+        return self.velocity
+
+
+def _stamp(message, clock, delay_ms=0):
+    _delay = delay_ms * 1e-3
+    message["time"] = int((clock.time() - _delay) * 1e6)
+    message["mono"] = int((clock.monotonic() - _delay) * 1e6)
+    return message
+
+
+def _round(value):
+    return round(value, 4) if isinstance(value, float) else value
+
+
+def _trace_row(output, velocity):
+    if output is None:
+        return None
+    return [_round(output.get(field)) for field in TRACE_FIELDS] + [round(velocity, 4)]
+
+
+def simulate(scenario, routes=None):
+    """
+    Run the scenario on a fresh command processor with the process clock replaced by a virtual one.
+    :param routes: Directory with the navigation routes or None for none.
+    :return: The trace, one row of the trace fields and the vehicle velocity per step or None for a step without output,
+    and the cost of the steps in microseconds of real time.
+    """
+    _hz = float(scenario.get("hz", 80))
+    _dt = 1.0 / _hz
+    clock = ManualClock(start=_EPOCH)
+    _previous = set_clock(clock)
+    np.random.seed(scenario.get("seed", 0))
+    route_store = ReloadableDataSource(
+        FileSystemRouteDataSource(directory=routes, load_instructions=True)
+    )
+    processor = CommandProcessor(route_store, synchronous=True)
+    vehicle = VehicleModel(**scenario.get("vehicle", {}))
+    cost = Histogram(bounds=_COST_BOUNDS_US)
+    trace = []
+    try:
+        processor.restart(**scenario.get("config", {}))
+        for segment in scenario.get("segments", []):
+            _delays = segment.get("delay_ms", {})
+            for _ in range(int(segment.get("steps", 1))):
+                clock.advance(_dt)
+                teleop, ros, inference = None, None, None
+                if segment.get("teleop") is not None:
+                    teleop = dict(dict(navigator=dict()), **segment.get("teleop"))
+                    _stamp(teleop, clock, _delays.get("teleop", 0))
+                if segment.get("ros") is not None:
+                    ros = dict(segment.get("ros"))
+                if segment.get("inference") is not None:
+                    inference = dict(_INFERENCE_DEFAULTS, **segment.get("inference"))
+                    _stamp(inference, clock, _delays.get("inference", 0))
+                c_vehicle = None
+                if segment.get("vehicle", True):
+                    c_vehicle = dict(velocity=vehicle.velocity, trust_velocity=1)
+                    _stamp(c_vehicle, clock, _delays.get("vehicle", 0))
+                _start = time.time()
+                output = processor.next_action(teleop, ros, c_vehicle, inference)
+                cost.record((time.time() - _start) * 1e6)
+                # The relay stops the vehicle without pilot output.
+                vehicle.update(None if output is None else output.get("throttle"), _dt)
+                trace.append(_trace_row(output, vehicle.velocity))
+    finally:
+        processor.quit()
+        set_clock(_previous)
+    return trace, cost
+
+
+def compare_traces(trace, golden, tolerance=1e-3, limit=10):
+    """
+    :return: Up to limit differences as step, field, actual and expected value - the numbers within the tolerance.
+    """
+    _fields = TRACE_FIELDS + ("velocity",)
+    differences = []
+    if len(trace) != len(golden):
+        differences.append((None, "steps", len(trace), len(golden)))
+    for step, (actual, expected) in enumerate(zip(trace, golden)):
+        if actual is None or expected is None:
+            if actual != expected:
+                differences.append((step, "output", actual, expected))
+        else:
+            for field, a, e in zip(_fields, actual, expected):
+                _numbers = isinstance(a, (int, float)) and isinstance(e, (int, float))
+                if (abs(a - e) > tolerance) if _numbers else (a != e):
+                    differences.append((step, field, a, e))
+        if len(differences) >= limit:
+            break
+    return differences[:limit]
+
+
+def synthetic_scenario(seed, n_segments=20, hz=80):
+    """
+    :return: A scenario of random segments of driving by hand, switching to the autopilot, changing the cruise speed and
+    late or missing messages.
+    """
+    _random = random.Random(seed)
+
+    def _teleop():
+        return dict(
+            steering=round(_random.uniform(-1, 1), 2),
+            throttle=round(_random.choice([0, 0, _random.uniform(-1, 1)]), 2),
+        )
+
+    def _inference():
+        return dict(
+            action=round(_random.uniform(-1, 1), 2),
+            total_penalty=round(_random.uniform(0, 0.5), 2),
+        )
+
+    _kinds = (
+        lambda: dict(teleop=_teleop(), inference=_inference()),
+        lambda: dict(teleop=dict(button_y=1), inference=_inference()),
+        lambda: dict(teleop=dict(button_b=1), inference=_inference()),
+        lambda: dict(teleop=dict(arrow_up=1), inference=_inference()),
+        lambda: dict(teleop=dict(arrow_down=1), inference=_inference()),
+        lambda: dict(teleop=dict(), inference=_inference()),
+        lambda: dict(teleop=dict(), ros={"pilot.maximum.speed": _random.uniform(0, 5)}),
+        lambda: dict(teleop=_teleop(), delay_ms=dict(teleop=500)),
+        lambda: dict(teleop=dict(), inference=_inference(), vehicle=False),
+    )
+    segments = []
+    for _ in range(n_segments):
+        segment = _random.choice(_kinds)()
+        segment["steps"] = _random.randint(1, 200)
+        segments.append(segment)
+    return dict(name="synthetic-{}".format(seed), hz=hz, seed=seed, segments=segments)
+
+
+def _bag_segment(latest, step_time):
+    segment, delays = dict(steps=1), dict()
+    for key, message in latest.items():
+        # The messages are stamped anew at every step with the age they had in the recording.
+        segment[key] = dict(
+            (k, v) for k, v in message.items() if k not in ("time", "mono")
+        )
+        if key != "ros" and "time" in message:
+            delays[key] = round(max(0.0, (step_time - message["time"]) * 1e-3), 3)
+    if delays:
+        segment["delay_ms"] = delays
+    return segment
+
+
+def bag_scenario(path, hz=80):
+    """
+    :return: The scenario of a bag recording with a step per period of the frequency. A step has the latest teleop and
+    inference message up to the end of the step and the ros message of the step, if any, as the pilot would have taken them.
+    """
+    _topics = dict((topic, key) for key, topic in BAG_TOPICS.items())
+    _period = 1e6 / hz
+    segments, latest = [], dict()
+    _step_end = None
+    reader = BagReader(path)
+    try:
+        for ts, topic, message in reader.records():
+            key = _topics.get(topic)
+            if key is None:
+                continue
+            _step_end = (ts + _period) if _step_end is None else _step_end
+            while ts > _step_end:
+                segments.append(_bag_segment(latest, _step_end))
+                # The ros messages are taken once.
+                latest.pop("ros", None)
+                _step_end += _period
+            latest[key] = message
+        if latest:
+            segments.append(_bag_segment(latest, _step_end))
+    finally:
+        reader.close()
+    return dict(
+        name=os.path.splitext(os.path.basename(path))[0], hz=hz, segments=segments
+    )
+
+
+def load_scenario(path):
+    with open(path) as f:
+        scenario = json.load(f)
+    scenario.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    if "bag" in scenario:
+        _bag = os.path.join(os.path.dirname(path), scenario["bag"])
+        scenario["segments"] = bag_scenario(_bag, hz=scenario.get("hz", 80))["segments"]
+    return scenario
+
+
+def _golden_path(directory, name):
+    return os.path.join(directory, "{}.trace.json".format(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pilot simulation.")
+    parser.add_argument("scenarios", nargs="*", help="Scenario files.")
+    parser.add_argument(
+        "--golden", type=str, default="golden", help="Directory of the golden traces."
+    )
+    parser.add_argument(
+        "--routes", type=str, default=None, help="Directory with the navigation routes."
+    )
+    parser.add_argument(
+        "--synthetic", type=int, default=0, help="Number of synthetic scenarios to add."
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Replace the golden traces with the outcome.",
+    )
+    args = parser.parse_args(argv)
+
+    scenarios = []
+    for pattern in args.scenarios:
+        scenarios.extend(load_scenario(path) for path in sorted(glob.glob(pattern)))
+    scenarios.extend(synthetic_scenario(seed) for seed in range(args.synthetic))
+    if args.update and not os.path.exists(args.golden):
+        os.makedirs(args.golden)
+
+    _failed, _steps, _cost_us = 0, 0, 0.0
+    _start = time.time()
+    for scenario in scenarios:
+        trace, cost = simulate(scenario, routes=args.routes)
+        _steps += len(trace)
+        _cost_us += (cost.get_mean() or 0) * cost.get_count()
+        _path = _golden_path(args.golden, scenario["name"])
+        if args.update:
+            with open(_path, "w") as f:
+                json.dump(dict(name=scenario["name"], trace=trace), f)
+        elif os.path.exists(_path):
+            with open(_path) as f:
+                differences = compare_traces(trace, json.load(f)["trace"])
+            if differences:
+                _failed += 1
+                logger.error("{} differs: {}".format(scenario["name"], differences))
+        else:
+            _failed += 1
+            logger.error(
+                "{} has no golden trace in '{}' - run with --update to create it.".format(
+                    scenario["name"], args.golden
+                )
+            )
+    _duration = time.time() - _start
+    logger.info(
+        "{} scenarios, {} failed, {} steps in {:2.2f} seconds - {:2.1f} us per step on average.".format(
+            len(scenarios), _failed, _steps, _duration, _cost_us / max(1, _steps)
+        )
+    )
+    return 1 if _failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s: %(asctime)s %(filename)s %(funcName)s %(message)s"
+    )
+    logging.getLogger().setLevel(logging.INFO)
+    exit(main())
@@ -61,7 +61,7 @@ def test_create_and_setup(tmpdir):
         #
         # Issue the restart request.
         ipc_chatter.add(dict(command='restart'))
-        app.step()
+        app.check_chatter()
         assert len(ipc_server.collect()) == 2
         assert not bool(ipc_server.get_latest())
         assert app.get_process_frequency() == new_process_frequency
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+
+import json
+import os
+
+from byodr.utils.bag import BagWriter
+from pilot.simulate import (
+    VehicleModel,
+    bag_scenario,
+    compare_traces,
+    main,
+    simulate,
+    synthetic_scenario,
+)
+
+_SCENARIOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scenarios")
+
+_CRUISE = dict(
+    name="cruise",
+    hz=80,
+    config={"controller.button.north.mode": "driver_mode.inference.dnn"},
+    segments=[
+        dict(steps=5, teleop=dict(button_y=1), inference={}),
+        dict(steps=1, teleop=dict(arrow_up=1), inference={}),
+        dict(steps=40, teleop=dict(), inference={}),
+        dict(steps=1, teleop=dict(arrow_up=1), inference={}),
+        dict(steps=800, teleop=dict(), inference=dict(action=0.1)),
+        # Teleop commands that are too old are ignored.
+        dict(steps=10, teleop=dict(button_b=1), delay_ms=dict(teleop=1000)),
+        dict(steps=10, teleop=dict(button_b=1), inference={}),
+    ],
+)
+
+
+def test_vehicle_model():
+    vehicle = VehicleModel(top_speed=2.0, time_constant=0.5)
+    [vehicle.update(0.5, 0.1) for _ in range(100)]
+    assert abs(vehicle.velocity - 1.0) < 1e-3
+    [vehicle.update(-1, 0.1) for _ in range(100)]
+    assert vehicle.velocity < 1e-3
+
+
+def test_simulate_cruise_control():
+    trace, cost = simulate(_CRUISE)
+    assert len(trace) == 867
+    assert cost.get_count() == 867
+    assert trace[0][0] == "driver_mode.inference.dnn"
+    # Two steps of the cruise speed of 0.5 km/h and the pid brings the vehicle up to speed.
+    driver, instruction, steering, throttle, desired_speed, velocity = trace[845]
+    assert abs(desired_speed - 1.0 / 3.6) < 1e-3
+    assert abs(velocity - desired_speed) < 0.01
+    assert steering == 0.1
+    assert trace[850] is None
+    assert trace[-1][0] == "driver_mode.teleop.direct"
+    # The virtual clock makes the outcome reproducible.
+    assert compare_traces(simulate(_CRUISE)[0], trace) == []
+
+
+def test_compare_traces():
+    trace, _ = simulate(synthetic_scenario(seed=1, n_segments=5))
+    golden = [None if row is None else list(row) for row in trace]
+    assert compare_traces(trace, golden) == []
+    _step = next(i for i, row in enumerate(golden) if row is not None)
+    golden[_step][3] += 0.1
+    assert [d[:2] for d in compare_traces(trace, golden)] == [(_step, "throttle")]
+    assert compare_traces(trace[:-1], golden)[0][:2] == (None, "steps")
+
+
+def test_bag_scenario(tmpdir):
+    path = str(tmpdir.join("session.bag"))
+    writer = BagWriter(path)
+    _start = 1600000000000000
+    # Teleop at 20 hz with the autopilot button once, inference at 10 hz and a ros message, over half a second.
+    for i in range(10):
+        _ts = _start + i * 50000
+        writer.write_json(
+            "aav/teleop/input",
+            dict(time=_ts - 2000, button_y=int(i == 2), navigator=dict()),
+            ts=_ts,
+        )
+        if i % 2 == 0:
+            writer.write_json(
+                "aav/inference/state", dict(time=_ts - 5000, action=0.2), ts=_ts + 1000
+            )
+    writer.write_json("aav/ros/input", {"pilot.maximum.speed": 2.0}, ts=_start + 100000)
+    writer.write_json(
+        "aav/pilot/output", dict(time=_start, steering=0.5), ts=_start + 200000
+    )
+    writer.close()
+
+    scenario = bag_scenario(path, hz=80)
+    segments = scenario["segments"]
+    assert scenario["name"] == "session"
+    assert 36 <= len(segments) <= 38
+    assert all(segment["steps"] == 1 for segment in segments)
+    # The recorded pilot output is not part of the scenario and the ros message is taken once.
+    assert sum(1 for segment in segments if "ros" in segment) == 1
+    assert all(
+        set(segment.keys()) <= {"steps", "teleop", "ros", "inference", "delay_ms"}
+        for segment in segments
+    )
+    # A message ages until the next one arrives.
+    _delays = [segment["delay_ms"]["teleop"] for segment in segments]
+    assert min(_delays) >= 2 and max(_delays) < 2 + 50 + 12.5
+    trace, _ = simulate(scenario)
+    assert len(trace) == len(segments)
+    assert trace[-1][0] == "driver_mode.inference.dnn"
+
+
+def test_golden_traces(tmpdir):
+    # The committed scenarios match their golden traces.
+    assert (
+        main(
+            [
+                os.path.join(_SCENARIOS, "*.json"),
+                "--golden",
+                os.path.join(_SCENARIOS, "golden"),
+            ]
+        )
+        == 0
+    )
+    # A scenario without a golden trace fails unless the traces are updated.
+    _golden = str(tmpdir.join("golden"))
+    _args = [os.path.join(_SCENARIOS, "cruise.json"), "--golden", _golden]
+    assert main(_args) == 1
+    assert main(_args + ["--update"]) == 0
+    assert main(_args) == 0
+    with open(os.path.join(_golden, "cruise.trace.json")) as f:
+        assert json.load(f)["name"] == "cruise"
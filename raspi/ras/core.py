@@ -1,4 +1,5 @@
 import logging
+import struct
 import threading
 
 import pyvesc
@@ -6,8 +7,10 @@ import serial
 from gpiozero import DigitalInputDevice
 from pyvesc.VESC.messages import GetValues, SetDutyCycle, SetRPM
 
-from byodr.utils import timestamp
+from byodr.utils import timestamp, monotonic, monotonic_timestamp
+from byodr.utils.metrics import Histogram
 from byodr.utils.option import parse_option
+from .hall import EdgeRing, estimate_rps, save_edge_trace
 
 logger = logging.getLogger(__name__)
 
@@ -42,50 +45,31 @@ class CommandHistory(object):
 
 
 class HallRps(object):
-    """This class seems to be related to a Hall sensor (probably for measuring rotations per second, RPS).
-    It monitors a specific GPIO pin (pin=16 by default) for changes, likely detecting rotations.
-    The sensor's detections are used to calculate rotations per second (rps).
+    """
+    Rotations per second from the edges of a hall sensor on the gpio pin, see ras.hall.
+    The edges are only timestamped in the callback and the speed is estimated when it is asked for.
     """
 
-    def __init__(self, pin=16, moment=0.05, debug=False):
-        self._moment = moment
-        self._debug = debug
-        self._lock = threading.Lock()
-        self._rps = 0
-        self._detect_time = 0
-        self._detect_duration = 0
-        self._num_detections = 0
+    def __init__(self, pin=16, window=0.5):
+        self._window = window
+        self._edges = EdgeRing()
         self._sensor = DigitalInputDevice(pin=pin, pull_up=True)
         self._sensor.when_activated = self._detect
 
-    def tick(self):
-        with self._lock:
-            # Drop to zero when stopped.
-            _elapsed = timestamp() - self._detect_time
-            if self._detect_duration > 0 and _elapsed / self._detect_duration > 1:
-                self._rps *= (1 - self._moment) if self._rps > 1e-2 else 0
+    def _detect(self):
+        self._edges.record(monotonic())
 
     def rps(self):
-        with self._lock:
-            return self._rps
+        _now = monotonic()
+        return estimate_rps(
+            self._edges.recent(_now - self._window), _now, window=self._window
+        )
 
     def detections(self):
-        with self._lock:
-            return self._num_detections
+        return len(self._edges)
 
-    def _detect(self):
-        with self._lock:
-            _now = timestamp()
-            self._detect_duration = _now - self._detect_time
-            _rps = 1e6 / self._detect_duration
-            self._rps = (
-                (self._moment * _rps + (1.0 - self._moment) * self._rps)
-                if self._rps > 0
-                else _rps
-            )
-            self._detect_time = _now
-            if self._debug:
-                self._num_detections += 1
+    def edges(self):
+        return self._edges.recent()
 
 
 class HallOdometer(object):
@@ -94,7 +78,9 @@ class HallOdometer(object):
             "odometer.distance.cm_per_revolution", float, 15, **kwargs
         )
         self._debug = parse_option("odometer.debug", int, 0, **kwargs) == 1
-        self._alpha = parse_option("odometer.moment.alpha", float, 0.10, **kwargs)
+        self._window = parse_option("odometer.window.ms", int, 500, **kwargs) * 1e-3
+        # The edges of the sensor are saved to this file at the end when given.
+        self._trace_file = parse_option("odometer.trace.file", str, "", **kwargs)
         self._enabled = parse_option("drive.type", str, **kwargs) == "gpio_with_hall"
         self._hall = None
 
@@ -103,36 +89,84 @@ class HallOdometer(object):
 
     def setup(self):
         if self._enabled:
-            self._hall = HallRps(moment=self._alpha, debug=self._debug)
+            self._hall = HallRps(window=self._window)
             logger.info(
-                "Created hall odometer with cm/rev={:2.2f} alpha={:2.2f} and debug={}.".format(
-                    self._cm_per_revolution, self._alpha, self._debug
+                "Created hall odometer with cm/rev={:2.2f} window={:2.2f}s and debug={}.".format(
+                    self._cm_per_revolution, self._window, self._debug
                 )
             )
 
     def quit(self):
+        if self._hall is not None and self._trace_file:
+            save_edge_trace(self._trace_file, self._hall.edges())
+            logger.info("Saved the hall sensor edges to {}.".format(self._trace_file))
         self._enabled = False
         self._hall = None
 
     def velocity(self):
-        _velocity = (
-            self._hall.rps() * self._cm_per_revolution * 1e-2
-        )  # Convert to meters per second.
-        self._hall.tick()
+        _rps = self._hall.rps()
         if self._debug:
-            logger.info(
-                "{:2.2f} n={}".format(self._hall.rps(), self._hall.detections())
-            )
-        return _velocity
+            logger.info("{:2.2f} n={}".format(_rps, self._hall.detections()))
+        return _rps * self._cm_per_revolution * 1e-2  # Convert to meters per second.
+
+
+# The telemetry of a vesc that is older than this number of seconds no longer counts.
+VESC_TELEMETRY_MAX_AGE = 0.5
+# A few telemetry frames - the buffer does not hold more than this without a frame in it unless the head is garbage.
+VESC_MAX_UNDECODED_BYTES = 4 * 80
+
+
+def _vesc_field(response, *names):
+    # The names of the values differ between versions of pyvesc.
+    for name in names:
+        if hasattr(response, name):
+            return getattr(response, name)
+    return None
 
 
 class VESCDrive(object):
-    def __init__(self, serial_port="/dev/ttyACM0", rpm_drive=True, cm_per_pole_pair=1):
+    """
+    The telemetry is requested and read on an io thread per serial port so that the drive commands only wait for other
+    writes. The requests are pipelined at the telemetry frequency without waiting for the responses, which are decoded from
+    a stream buffer however they are split over the reads.
+    Efforts can also be submitted to a writer thread of the port, which writes the latest one, so that the drives of more
+    than one port are written at the same time.
+    """
+
+    def __init__(
+        self,
+        serial_port="/dev/ttyACM0",
+        rpm_drive=True,
+        cm_per_pole_pair=1,
+        telemetry_hz=50,
+    ):
         self._port = serial_port
         self._rpm_drive = rpm_drive
         self._cm_per_pp = cm_per_pole_pair
+        self._period = 1.0 / telemetry_hz
+        self._request = pyvesc.encode_request(GetValues)
+        # The lock guards the port and the writes.
         self._lock = threading.Lock()
         self._ser = None
+        self._buffer = bytearray()
+        self._telemetry = None
+        self._n_frames = 0
+        self._n_discarded = 0
+        self._quit_event = threading.Event()
+        # The latest submitted effort with the time of submission and the submission time and end of the last write.
+        self._submitted = None
+        self._submit_event = threading.Event()
+        self._written = None
+        self._write_latency = Histogram()
+        self._reader = threading.Thread(
+            target=self._run, name="vesc:{}".format(serial_port)
+        )
+        self._writer = threading.Thread(
+            target=self._run_writer, name="vesc:{}:write".format(serial_port)
+        )
+        for _thread in (self._reader, self._writer):
+            _thread.daemon = True
+            _thread.start()
 
     def _close(self):
         if self._ser is not None:
@@ -146,7 +180,9 @@ class VESCDrive(object):
         _good = False
         try:
             if self._ser is None:
-                self._ser = serial.Serial(self._port, baudrate=115200, timeout=0.05)
+                self._ser = serial.Serial(
+                    self._port, baudrate=115200, timeout=self._period
+                )
                 logger.info("Connected serial port {}.".format(self._port))
             _good = self._ser.isOpen()
         except serial.serialutil.SerialException:
@@ -159,29 +195,88 @@ class VESCDrive(object):
             return self._open()
 
     def close(self):
+        self._quit_event.set()
+        self._submit_event.set()
         with self._lock:
             self._close()
 
+    def _on_failure(self, port):
+        with self._lock:
+            # The port may have been replaced in the meantime.
+            if self._ser is port:
+                self._close()
+
+    def _decode(self, data):
+        self._buffer.extend(data)
+        while self._buffer:
+            try:
+                response, consumed = pyvesc.decode(bytes(self._buffer))
+            except (KeyError, struct.error):
+                # A valid frame with an unknown or short message - skip to the next start byte.
+                response, consumed = None, 1
+            if consumed == 0:
+                if len(self._buffer) <= VESC_MAX_UNDECODED_BYTES:
+                    # The rest of the frame is yet to arrive.
+                    break
+                # A stray start byte with a length beyond the frames that are sent - skip to the next start byte.
+                consumed = 1
+            del self._buffer[:consumed]
+            if response is None:
+                self._n_discarded += consumed
+            elif isinstance(response, GetValues):
+                self._n_frames += 1
+                # The age is taken on the monotonic clock, the wall time is what is published.
+                self._telemetry = dict(
+                    time=timestamp(),
+                    mono=monotonic_timestamp(),
+                    rpm=response.rpm,
+                    current=_vesc_field(response, "avg_motor_current", "current_motor"),
+                    voltage=_vesc_field(response, "v_in"),
+                    temperature=_vesc_field(response, "temp_fet", "temp_mos1"),
+                )
+
+    def _run(self):
+        _due = 0
+        while not self._quit_event.is_set():
+            _ser = self._ser
+            if _ser is None:
+                self._quit_event.wait(self._period)
+                continue
+            try:
+                if monotonic() >= _due:
+                    _due = monotonic() + self._period
+                    with self._lock:
+                        _ser.write(self._request)
+                # Returns after the first byte or the timeout of the port.
+                self._decode(_ser.read(max(1, _ser.in_waiting)))
+            except (serial.serialutil.SerialException, OSError, TypeError):
+                # A port that is closed while reading can fail with any of these.
+                self._on_failure(_ser)
+                self._buffer = bytearray()
+
+    def get_telemetry(self):
+        """
+        :return: The latest rpm, motor current, input voltage and temperature with the time they were received or None.
+        """
+        _telemetry = self._telemetry
+        if (
+            _telemetry is None
+            or monotonic_timestamp() - _telemetry["mono"]
+            > VESC_TELEMETRY_MAX_AGE * 1e6
+        ):
+            return None
+        return _telemetry
+
     def get_velocity(self):
         return (
             (self.get_rpm() / 60.0) * self._cm_per_pp * 1e-2
         )  # Convert to meters per second.
 
     def get_rpm(self):
-        with self._lock:
-            if self._open():
-                try:
-                    self._ser.write(pyvesc.encode_request(GetValues))
-                    if self._ser.in_waiting > 78:
-                        (response, consumed) = pyvesc.decode(self._ser.read(79))
-                        return response.rpm
-                    else:
-                        raise AssertionError(
-                            "Protocol violation on the response length."
-                        )
-                except serial.serialutil.SerialException:
-                    self._close()
-                    raise AssertionError("The serial connection is not operational.")
+        _telemetry = self.get_telemetry()
+        if _telemetry is None:
+            raise AssertionError("There is no recent telemetry of the vesc.")
+        return _telemetry["rpm"]
 
     def set_effort(self, value):
         with self._lock:
@@ -198,3 +293,37 @@ class VESCDrive(object):
                     self._close()
                     _operational = False
             return _operational
+
+    def submit(self, value, submitted=None):
+        """
+        Hand the effort to the writer thread without waiting for the port - a next effort replaces one not yet written.
+        :param submitted: The monotonic time of submission which is shared by the efforts of one step.
+        """
+        self._submitted = (value, monotonic() if submitted is None else submitted)
+        self._submit_event.set()
+
+    def _run_writer(self):
+        while not self._quit_event.is_set():
+            if not self._submit_event.wait(1):
+                continue
+            self._submit_event.clear()
+            _submitted = self._submitted
+            if _submitted is not None and self.set_effort(_submitted[0]):
+                _end = monotonic()
+                self._write_latency.record((_end - _submitted[1]) * 1e3)
+                self._written = (_submitted[1], _end)
+
+    def get_written(self):
+        """
+        :return: The submission time and the end of the last write or None.
+        """
+        return self._written
+
+    def get_io_stats(self):
+        return dict(
+            port=self._port,
+            write_latency_ms=self._write_latency.to_dict(),
+            telemetry=self.get_telemetry() is not None,
+            telemetry_frames=self._n_frames,
+            discarded_bytes=self._n_discarded,
+        )
@@ -0,0 +1,147 @@
+"""
+Rotation speed from the edges of a hall sensor. The callback of the sensor records the time of each edge in a preallocated
+ring without taking a lock and the speed is estimated on demand from the edges in a recent window.
+An edge trace holds one edge time in microseconds per line and replays the estimation without the sensor e.g.
+    python -m ras.hall odometer.edges --hz 50 --window 0.5
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import time
+
+import numpy as np
+
+_TRACE_HEADER = "# hall edges in microseconds"
+
+
+class EdgeRing(object):
+    """
+    The edge times in seconds in a preallocated array. The single writer - the thread of the sensor - fills the slot before
+    it moves the count so that readers only see complete slots. The oldest slots are overwritten once the capacity is
+    reached, which the window of the estimation should stay well within.
+    """
+
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self._times = np.zeros(capacity, dtype=np.float64)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def record(self, edge_time):
+        self._times[self._count % self._capacity] = edge_time
+        self._count += 1
+
+    def recent(self, since=None):
+        """
+        :return: The edge times after since, oldest first.
+        """
+        _count = self._count
+        _times = self._times[
+            np.arange(max(0, _count - self._capacity), _count) % self._capacity
+        ]
+        return (
+            _times
+            if since is None
+            else _times[np.searchsorted(_times, since, side="right") :]
+        )
+
+
+def estimate_rps(edges, now, window=0.5, max_deviation=3.0):
+    """
+    The number of edges per second is the least squares slope of the edge count over time in the window, which leans
+    towards the recent edges as there are more of them at speed. The outliers - missed or bouncing edges - are told apart by
+    their interval: a bouncing edge is left out and a missed edge still counts. The speed drops off once the time since the
+    last edge exceeds the usual interval and is zero without two edges in the window.
+    :param max_deviation: The number of median absolute deviations from the median beyond which an interval is an outlier.
+    """
+    edges = edges[edges > now - window]
+    if edges.size < 2:
+        return 0.0
+    intervals = np.diff(edges)
+    _median = np.median(intervals)
+    if _median <= 0:
+        return 0.0
+    _deviation = np.abs(intervals - _median)
+    # Regular edges have next to no deviation, which leaves room for a tenth of the interval.
+    _inlier = _deviation <= max(max_deviation * np.median(_deviation), 0.1 * _median)
+    # The number of edges an interval stands for.
+    _counts = np.where(_inlier, 1, np.round(intervals / _median))
+    _kept = np.concatenate(([True], _counts > 0))
+    _times = edges[_kept]
+    if _times[-1] <= _times[0]:
+        return 0.0
+    _index = np.concatenate(([0], np.cumsum(_counts)))[_kept]
+    _rps = max(0.0, np.polyfit(_times - _times[0], _index, 1)[0])
+    _since = now - edges[-1]
+    return min(_rps, 1.0 / _since) if _since * _rps > 1 else _rps
+
+
+def save_edge_trace(path, edges):
+    with open(path, "w") as f:
+        f.write(_TRACE_HEADER + "\n")
+        f.writelines("{}\n".format(int(round(t * 1e6))) for t in edges)
+
+
+def load_edge_trace(path):
+    """
+    :return: The edge times in seconds.
+    """
+    with open(path) as f:
+        return np.array(
+            [
+                int(line) * 1e-6
+                for line in f
+                if line.strip() and not line.startswith("#")
+            ],
+            dtype=np.float64,
+        )
+
+
+def replay(edges, hz=50, window=0.5):
+    """
+    Estimate the speed at the frequency of the ras steps over the span of the edges as if they came from the sensor.
+    :return: The step times and the rotations per second at each.
+    """
+    ring = EdgeRing(capacity=max(2, edges.size))
+    _steps = (
+        np.arange(edges[0], edges[-1] + window, 1.0 / hz) if edges.size else np.zeros(0)
+    )
+    rps = np.zeros(_steps.size)
+    _next = 0
+    for i, now in enumerate(_steps):
+        while _next < edges.size and edges[_next] <= now:
+            ring.record(edges[_next])
+            _next += 1
+        rps[i] = estimate_rps(ring.recent(now - window), now, window=window)
+    return _steps, rps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a hall sensor edge trace.")
+    parser.add_argument("trace", type=str, help="Edge trace file.")
+    parser.add_argument(
+        "--hz", type=float, default=50, help="Frequency of the estimation."
+    )
+    parser.add_argument(
+        "--window", type=float, default=0.5, help="Window of the estimation in seconds."
+    )
+    args = parser.parse_args()
+
+    edges = load_edge_trace(args.trace)
+    _start = time.time()
+    steps, rps = replay(edges, hz=args.hz, window=args.window)
+    _duration = time.time() - _start
+    print(
+        "{} edges, {} steps, {:2.1f} us per estimate.".format(
+            edges.size, steps.size, _duration * 1e6 / max(1, steps.size)
+        )
+    )
+    if rps.size:
+        print("rps mean {:2.2f} max {:2.2f}.".format(np.mean(rps), np.max(rps)))
+
+
+if __name__ == "__main__":
+    main()
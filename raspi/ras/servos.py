@@ -15,8 +15,9 @@ from configparser import ConfigParser as SafeConfigParser
 import numpy as np
 from gpiozero import AngularServo #interfacing with the GPIO pins of the Raspberry Pi
 
-from byodr.utils import timestamp, Application
-from byodr.utils.ipc import JSONPublisher, JSONServerThread
+from byodr.utils import timestamp, monotonic, monotonic_timestamp, Application
+from byodr.utils.ipc import JSONPublisher, JSONPullThread, JSONRouterServerThread
+from byodr.utils.metrics import Histogram
 from byodr.utils.option import parse_option
 from byodr.utils.protocol import MessageStreamProtocol
 from byodr.utils.usbrelay import SearchUsbRelayFactory, StaticRelayHolder
@@ -36,6 +37,28 @@ def _interrupt():
     quit_event.set()
 
 
+def _request_priority(message):
+    # Only the drive commands are served right away.
+    return 0 if isinstance(message, dict) and message.get('method') == 'ras/servo/drive' else 1
+
+
+class DriverServer(JSONRouterServerThread):
+    def __init__(self, url, event, **kwargs):
+        super().__init__(url, event, **kwargs)
+        self._handlers = dict()
+
+    def register_request(self, request, fn):
+        self._handlers[request] = fn
+
+    def serve(self, message):
+        # The configuration is acknowledged so that the relay can send it again until it arrives.
+        if message.get('method') == 'ras/driver/config':
+            return dict(ack=1)
+        if message.get('request') in self._handlers:
+            return {'ras': self._handlers[message.get('request')](message)}
+        return {}
+
+
 class AbstractDriver(ABC):
     def __init__(self, relay):
         self._relay = relay
@@ -71,6 +94,22 @@ class AbstractDriver(ABC):
     def velocity(self):
         raise NotImplementedError()
 
+    def telemetry(self):
+        """
+        :return: The recent telemetry of the motor controllers or None.
+        """
+        return None
+
+    def get_io_stats(self):
+        return {}
+
+    def get_written(self):
+        """
+        :return: The monotonic time up to which the drives are written to the motors and the timestamp of the end of that
+        write or None. The drives of the drivers that write on the calling thread are written once drive returns.
+        """
+        return monotonic(), timestamp()
+
     @abstractmethod
     def drive(self, steering, throttle):
         raise NotImplementedError()
@@ -257,6 +296,9 @@ class SingularVescDriver(AbstractSteerServoDriver):
             logger.warning(e)
             return 0
 
+    def telemetry(self):
+        return [self._drive.get_telemetry()]
+
     def drive(self, steering, throttle):
         _motor_effort = self._throttle_config.get('scale') * throttle
         _operational = self._drive.set_effort(_motor_effort)
@@ -287,6 +329,9 @@ class DualVescDriver(AbstractDriver):
         self._axes_ordered = kwargs.get('drive.axes.mount.order', 'normal') == 'normal'
         self._axis0_multiplier = 1 if kwargs.get('drive.axis0.mount.direction', 'forward') == 'forward' else -1
         self._axis1_multiplier = 1 if kwargs.get('drive.axis1.mount.direction', 'forward') == 'forward' else -1
+        # The difference in milliseconds between the ends of the writes to both axes of the same step.
+        self._skew = Histogram()
+        self._skew_step = None
 
     def has_sensors(self):
         return self.is_configured()
@@ -314,6 +359,26 @@ class DualVescDriver(AbstractDriver):
             logger.warning(e)
             return 0
 
+    def telemetry(self):
+        return [self._drive1.get_telemetry(), self._drive2.get_telemetry()]
+
+    def _record_skew(self):
+        _w1, _w2 = self._drive1.get_written(), self._drive2.get_written()
+        if _w1 is not None and _w2 is not None and _w1[0] == _w2[0] != self._skew_step:
+            self._skew_step = _w1[0]
+            self._skew.record(abs(_w1[1] - _w2[1]) * 1e3)
+
+    def get_io_stats(self):
+        return dict(skew_ms=self._skew.to_dict(), axes=[self._drive1.get_io_stats(), self._drive2.get_io_stats()])
+
+    def get_written(self):
+        # A drive is written when the writes to both axes are done.
+        _w1, _w2 = self._drive1.get_written(), self._drive2.get_written()
+        if _w1 is None or _w2 is None:
+            return None
+        _end = max(_w1[1], _w2[1]) if _w1[0] == _w2[0] else (_w1 if _w1[0] < _w2[0] else _w2)[1]
+        return min(_w1[0], _w2[0]), timestamp() - int((monotonic() - _end) * 1e6)
+
     def drive(self, steering, throttle):
         _motor_scale = self._throttle_config.get('scale')
         # Scale down throttle for one wheel, the other retains its value.
@@ -324,8 +389,12 @@ class DualVescDriver(AbstractDriver):
         right = throttle if steering < 0 else throttle * effect
         a = (right if self._axes_ordered else left) * self._axis0_multiplier * _motor_scale
         b = (left if self._axes_ordered else right) * self._axis1_multiplier * _motor_scale
-        self._drive1.set_effort(a)
-        self._drive2.set_effort(b)
+        # The writes of the previous step are done by now, mostly.
+        self._record_skew()
+        # Both axes are written at once by their own threads.
+        _submitted = monotonic()
+        self._drive1.submit(a, _submitted)
+        self._drive2.submit(b, _submitted)
         return np.mean([a, b])
 
     def quit(self):
@@ -335,15 +404,18 @@ class DualVescDriver(AbstractDriver):
 
 
 class MainApplication(Application):
-    def __init__(self, event, relay, hz=50, **kwargs):
-        super(MainApplication, self).__init__(run_hz=hz, quit_event=event)
+    def __init__(self, event, relay, hz=50, clock=None, **kwargs):
+        super(MainApplication, self).__init__(run_hz=hz, quit_event=event, deadlines=True, clock=clock)
         self._integrity = MessageStreamProtocol(max_age_ms=100, max_delay_ms=100)
         self._cmd_history = CommandHistory(hz=hz)
         self._config_queue = collections.deque(maxlen=1)
         self._drive_queue = collections.deque(maxlen=1)
+        # The command that waits for its drive to be written with the monotonic time of the drive.
+        self._actuation = None
         self._odometer = HallOdometer(**kwargs)
         self._chassis = None
         self.platform = None
+        self.drive = None
         self.publisher = None
         # Setup the chassis.
         _drive_type = parse_option('drive.type', str, **kwargs)
@@ -356,6 +428,9 @@ class MainApplication(Application):
         else:
             raise AssertionError("Unknown drive type '{}'.".format(_drive_type))
 
+    def get_io_stats(self):
+        return self._chassis.get_io_stats()
+
     def _pop_config(self):
         return self._config_queue.popleft() if bool(self._config_queue) else None
 
@@ -363,14 +438,28 @@ class MainApplication(Application):
         return self._drive_queue.popleft() if bool(self._drive_queue) else None
 
     def _on_message(self, message):
-        self._integrity.on_message(message.get('time'))
-        if message.get('method') == 'ras/driver/config':
+        _method = message.get('method') if isinstance(message, dict) else None
+        if _method == 'ras/driver/config':
             self._config_queue.appendleft(message.get('data'))
-        else:
+            return
+        if _method != 'ras/servo/drive':
+            # E.g. the clock exchanges of the relay.
+            return
+        # The monotonic timestamp of the sender, when there is one, is not affected by adjustments of its clock.
+        self._integrity.on_message(message.get('mono', message.get('time')))
+        if not isinstance(message.get('data'), dict):
+            logger.warning("Drive without data '{}'.".format(message))
+        elif message.get('cid') is None:
             self._drive_queue.appendleft(message.get('data'))
+        else:
+            # The correlation id is returned with the status once the command is applied.
+            _hops = message.get('hops', []) + [['ras/received', timestamp()]]
+            self._drive_queue.appendleft(dict(message.get('data'), cid=message.get('cid'), hops=_hops))
 
     def setup(self):
         self.platform.add_listener(self._on_message)
+        if self.drive is not None:
+            self.drive.add_listener(self._on_message)
         self._integrity.reset()
         self._cmd_history.reset()
         self._odometer.setup()
@@ -401,12 +490,24 @@ class MainApplication(Application):
 
         # Immediately zero out throttle when violations start occurring.
         v_throttle = 0 if n_violations > 0 else v_throttle
+        _submitted = monotonic()
         _effort = self._chassis.drive(v_steering, v_throttle)
-        _data = dict(time=timestamp(), configured=int(self._chassis.is_configured()), motor_effort=_effort)
+        _data = dict(time=timestamp(), mono=monotonic_timestamp(), configured=int(self._chassis.is_configured()), motor_effort=_effort)
+        if c_drive is not None and c_drive.get('cid') is not None:
+            self._actuation = (_submitted, c_drive.get('cid'), c_drive.get('hops'))
+        # The command is confirmed with the status after its drive, or a later one, is written which can be a next step.
+        _written = self._chassis.get_written()
+        if self._actuation is not None and _written is not None and _written[0] >= self._actuation[0]:
+            _, _cid, _hops = self._actuation
+            _data.update(dict(cid=_cid, hops=_hops + [['ras/actuated', _written[1]]]))
+            self._actuation = None
         if self._chassis.has_sensors():
             _data.update(dict(velocity=self._chassis.velocity()))
         elif self._odometer.is_enabled():
             _data.update(dict(velocity=self._odometer.velocity()))
+        _telemetry = self._chassis.telemetry()
+        if _telemetry is not None:
+            _data.update(dict(telemetry=_telemetry))
 
         # Let the communication partner know we are operational.
         self.publisher.publish(data=_data)
@@ -432,9 +533,14 @@ def main():
             application = MainApplication(quit_event, relay=holder, hz=50, **kwargs)
 
             application.publisher = JSONPublisher(url='tcp://0.0.0.0:5555', topic='ras/drive/status')
-            application.platform = JSONServerThread(url='tcp://0.0.0.0:5550', event=quit_event, receive_timeout_ms=50)
-
-            threads = [application.platform]
+            # Drive commands are answered ahead of the configuration and introspection requests.
+            application.platform = DriverServer(url='tcp://0.0.0.0:5550', event=quit_event, receive_timeout_ms=50,
+                                                priority=_request_priority)
+            # The relay pushes the drive commands without waiting for an answer.
+            application.drive = JSONPullThread(url='tcp://0.0.0.0:5551', event=quit_event)
+            application.platform.register_request('ras/driver/io/stats', lambda m: application.get_io_stats())
+
+            threads = [application.platform, application.drive]
             if quit_event.is_set():
                 return 0
 
@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from ras.hall import EdgeRing, estimate_rps, load_edge_trace, replay, save_edge_trace
+
+
+def test_edge_ring():
+    ring = EdgeRing(capacity=4)
+    assert ring.recent().size == 0
+    [ring.record(t) for t in (1.0, 2.0, 3.0)]
+    assert list(ring.recent(since=1.0)) == [2.0, 3.0]
+    [ring.record(t) for t in (4.0, 5.0, 6.0)]
+    # The oldest edges are overwritten.
+    assert len(ring) == 6
+    assert list(ring.recent()) == [3.0, 4.0, 5.0, 6.0]
+
+
+def test_estimate_rps():
+    edges = np.arange(0, 1, 0.05)
+    assert abs(estimate_rps(edges, now=0.96) - 20) < 1e-6
+    # A missed edge and a bouncing one do not count.
+    _noisy = np.sort(np.concatenate([np.delete(edges, 10), [0.751]]))
+    assert abs(estimate_rps(_noisy, now=0.96) - 20) < 0.1
+    # The speed drops off after the last edge and there is none without edges in the window.
+    assert abs(estimate_rps(edges, now=1.2) - 1 / (1.2 - 0.95)) < 1e-6
+    assert estimate_rps(edges, now=2.0) == 0
+
+
+def test_estimate_rps_accelerating():
+    # Speeding up steadily from 10 to 30 rotations per second over a second - the edge count is quadratic in time.
+    edges = (-10 + np.sqrt(100 + 40 * np.arange(20))) / 20
+    now = edges[-1]
+    _rps = estimate_rps(edges, now=now)
+    _current = 10 + 20 * now
+    _window = edges[edges > now - 0.5]
+    # The mean interval gives the average speed over the window, the fit is closer to the current one.
+    _mean_interval = (_window.size - 1) / (_window[-1] - _window[0])
+    assert abs(_rps - np.polyfit(_window, np.arange(_window.size), 1)[0]) < 1e-6
+    assert _mean_interval < _rps < _current
+
+
+def test_edge_trace_replay(tmpdir):
+    path = str(tmpdir.join("odometer.edges"))
+    # Speeding up from 5 to 20 rotations per second.
+    edges = np.cumsum(1.0 / np.linspace(5, 20, 100))
+    save_edge_trace(path, edges)
+    loaded = load_edge_trace(path)
+    assert np.allclose(loaded, edges, atol=1e-6)
+    steps, rps = replay(loaded, hz=50, window=0.5)
+    assert steps.size == rps.size
+    _end = np.searchsorted(steps, edges[-1])
+    assert abs(rps[_end - 1] - 20) < 1 and rps[-1] == 0
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+
+import collections
+import struct
+import threading
+import time
+
+from pyvesc.VESC.messages import GetValues
+
+from ras.core import VESC_MAX_UNDECODED_BYTES, VESC_TELEMETRY_MAX_AGE, VESCDrive
+
+
+def _crc16(data):
+    # The crc-ccitt of the vesc frames (xmodem).
+    crc = 0
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def _frame(rpm):
+    _kinds = [field[1] for field in GetValues.fields]
+    _values = [
+        b"\x00" if kind == "c" else (rpm if field[0] == "rpm" else 0)
+        for field, kind in zip(GetValues.fields, _kinds)
+    ]
+    payload = struct.pack(">B" + "".join(_kinds), GetValues.id, *_values)
+    return (
+        struct.pack(">BB", 2, len(payload))
+        + payload
+        + struct.pack(">HB", _crc16(payload), 3)
+    )
+
+
+class _FakeSerial(object):
+    """
+    The port returns one read after the other as they arrive on the wire.
+    """
+
+    def __init__(self, reads):
+        self._reads = collections.deque(reads)
+        self.done = threading.Event()
+
+    @property
+    def in_waiting(self):
+        return len(self._reads[0]) if self._reads else 0
+
+    # noinspection PyPep8Naming
+    def isOpen(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+    # noinspection PyUnusedLocal
+    def read(self, size=1):
+        if not self._reads:
+            self.done.set()
+            time.sleep(0.01)
+            return b""
+        return self._reads.popleft()
+
+    def close(self):
+        pass
+
+
+def _read(reads):
+    drive = VESCDrive(serial_port="fake")
+    port = _FakeSerial(reads)
+    drive._ser = port
+    assert port.done.wait(2)
+    drive.close()
+    return drive
+
+
+def test_vesc_frames_split_across_reads():
+    frame = _frame(1200)
+    drive = _read([frame[:1], frame[1:5], frame[5:30], frame[30:]])
+    assert drive.get_rpm() == 1200
+    assert drive.get_io_stats()["telemetry_frames"] == 1
+    assert drive.get_io_stats()["discarded_bytes"] == 0
+
+
+def test_vesc_two_frames_in_one_read():
+    drive = _read([_frame(10) + _frame(20)])
+    assert drive.get_rpm() == 20
+    assert drive.get_io_stats()["telemetry_frames"] == 2
+
+
+def _frames():
+    # More frames than the bytes the buffer waits for a frame.
+    return [
+        _frame(rpm)
+        for rpm in range(1, 2 + VESC_MAX_UNDECODED_BYTES // len(_frame(0)) + 1)
+    ]
+
+
+def test_vesc_corrupt_crc():
+    corrupt = bytearray(_frame(10))
+    corrupt[-3] ^= 0xFF
+    drive = _read([bytes(corrupt) + _frame(20)])
+    assert drive.get_rpm() == 20
+    assert drive.get_io_stats()["telemetry_frames"] == 1
+    # On its own the corrupt frame is skipped up to its terminator, which reads as the start byte of a long frame.
+    frames = _frames()
+    drive = _read([bytes(corrupt)] + frames)
+    assert drive.get_rpm() == len(frames)
+    assert drive.get_io_stats()["telemetry_frames"] == len(frames)
+
+
+def test_vesc_leading_garbage():
+    # A long frame start byte with a length which never arrives holds up the frames behind it.
+    frames = _frames()
+    drive = _read([b"\x00\x03\xff\xff"] + frames)
+    assert drive.get_rpm() == len(frames)
+    assert drive.get_io_stats()["telemetry_frames"] == len(frames)
+    assert drive.get_io_stats()["discarded_bytes"] >= 2
+
+
+def test_vesc_telemetry_age_on_monotonic_clock():
+    drive = _read([_frame(10)])
+    # A step of the wall clock does not make the telemetry stale.
+    drive._telemetry["time"] -= 3600 * 1e6
+    assert drive.get_telemetry()["rpm"] == 10
+    drive._telemetry["mono"] -= (VESC_TELEMETRY_MAX_AGE + 1) * 1e6
+    assert drive.get_telemetry() is None
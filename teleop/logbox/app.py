@@ -8,6 +8,7 @@ import traceback
 from datetime import datetime
 
 from byodr.utils import Application
+from byodr.utils.trace import span
 from .core import *
 from .store import Event, create_data_source
 
@@ -214,6 +215,10 @@ class LogApplication(Application):
         self._queue_operator.append(timestamp())
 
     def _insert(self, trigger, content, save_image=False):
+        with span('logbox/insert'):
+            self._insert_event(trigger, content, save_image)
+
+    def _insert_event(self, trigger, content, save_image):
         _time, pil, veh, inf, image_md, image = content
         _img_fields = prepare_image_persist(image, persist=save_image)
         _pil_steering_scale = _float(pil, 'steering_scale', default=1.)
@@ -259,7 +264,8 @@ class LogApplication(Application):
 
     def step(self):
         # The pilot message is nil when no party is driving.
-        _time, pil, veh, inf, image_md, image, pilot_all = self._state.pull()
+        with span('logbox/pull'):
+            _time, pil, veh, inf, image_md, image, pilot_all = self._state.pull()
         _contents = (_time, pil, veh, inf, image_md, image)
         # The pilot message save_event attribute is set to true by the autopilot driver to indicate the image needs recording.
         _operator = pil is not None and pil.get('driver') is not None
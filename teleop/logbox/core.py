@@ -63,43 +63,30 @@ class SharedUser(object):
         return timestamp() - self.get() < (wait_sec * 1e6)
 
 
-def _nearest(items, ts, default=None):
-    r = default
-    dt = abs(ts - get_timestamp(r))
-    for item in ([] if items is None else items):
-        delta = abs(ts - get_timestamp(item))
-        if delta < dt:
-            dt = delta
-            r = item
-    return r
-
-
 class SharedState(object):
-    def __init__(self, channels, hz=20):
+    def __init__(self, camera, synchronizer, hz=20):
+        """
+        :param camera: The primary channel.
+        :param synchronizer: Receives the pilot, vehicle and inference messages under those topic names.
+        """
         self._hz = hz
         self._patience = (1e6 / hz)
-        self._camera, self._pilot, self._vehicle, self._inference = channels
-        self._cached = (None, None, None)
-
-    def _expire(self, cmd, stamp):
-        return None if cmd is None or abs(stamp - get_timestamp(cmd)) > self._patience else cmd
+        self._camera = camera
+        self._synchronizer = synchronizer
 
     def get_hz(self):
         return self._hz
 
     def pull(self):
-        # The non camera channels are set to collect and pop.
         image_md, image = self._camera.capture()
-        # Start with the return values.
-        pil, veh, inf = self._cached
+        # A frame from shared memory is a view on a ring slot which the publisher overwrites before the event is stored.
+        image = None if image is None else np.array(image)
         # The image is the primary event.
         _time = get_timestamp(image_md, default=timestamp())
         # Gather the messages around the primary time.
-        pilots = self._pilot()
-        pil = self._expire(_nearest(pilots, _time, pil), _time)
-        veh = self._expire(_nearest(self._vehicle(), _time, veh), _time)
-        inf = self._expire(_nearest(self._inference(), _time, inf), _time)
-        self._cached = (pil, veh, inf)
+        pil, veh, inf = self._synchronizer.join(_time, tolerance=self._patience, topics=('pilot', 'vehicle', 'inference'))
+        # The pilot messages that were not pulled before, each exactly once - the first pull starts around the image.
+        pilots = self._synchronizer.take('pilot', 'logbox', start=_time - self._patience)
         return _time, pil, veh, inf, image_md, image, pilots
 
 
@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from byodr.utils.sharedmem import SharedFrameRing
+from byodr.utils.sync import Synchronizer
+from byodr.utils.testing import QueueCamera
+
+from .core import SharedState
+
+
+class _RingCamera(object):
+    def __init__(self, ring):
+        self._ring = ring
+        self._latest = None
+
+    def publish(self, image, ts):
+        self._latest = (dict(time=ts), self._ring.write(image, ts))
+
+    def capture(self):
+        md, (slot, seq) = self._latest
+        return md, self._ring.read(slot, seq)
+
+
+def test_shared_state_pull_pilots_once():
+    camera = QueueCamera()
+    synchronizer = Synchronizer(topics=("pilot", "vehicle", "inference"))
+    state = SharedState(camera=camera, synchronizer=synchronizer, hz=20)
+    _pilot = synchronizer.listener("pilot")
+    # Older messages than the first frame are not pulled.
+    [_pilot(dict(time=t)) for t in range(0, 1000, 10)]
+    [_pilot(dict(time=t)) for t in (1000, 100000, 100050)]
+    camera.add(dict(time=100000), None)
+    pulled = [m["time"] for m in state.pull()[-1]]
+    assert pulled == [100000, 100050]
+    # The messages newer than the previous frame come with the next one and none of them twice.
+    _pilot(dict(time=100070))
+    camera.add(dict(time=100060), None)
+    pulled += [m["time"] for m in state.pull()[-1]]
+    assert pulled == [100000, 100050, 100070]
+    assert state.pull()[-1] == []
+
+
+def test_shared_state_pull_keeps_shared_memory_frame(tmpdir):
+    ring = SharedFrameRing.create(
+        str(tmpdir.join("camera_0.sock.ring")), num_slots=2, slot_bytes=4 * 6 * 3
+    )
+    camera = _RingCamera(ring)
+    state = SharedState(
+        camera=camera,
+        synchronizer=Synchronizer(topics=("pilot", "vehicle", "inference")),
+        hz=20,
+    )
+    camera.publish(np.full((4, 6, 3), 1, dtype=np.uint8), ts=1000)
+    image = state.pull()[5]
+    # The publisher wraps the ring before the event is stored.
+    [
+        camera.publish(np.full((4, 6, 3), i, dtype=np.uint8), ts=1000 + i)
+        for i in range(2, 5)
+    ]
+    assert np.all(image == 1)
+    ring.close()
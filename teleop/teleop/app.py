@@ -22,8 +22,13 @@ import tornado.ioloop
 import tornado.web
 
 from byodr.utils import Application, hash_dict, ApplicationExit
-from byodr.utils.ipc import CameraThread, JSONPublisher, JSONZmqClient, json_collector
+from byodr.utils.aio import AsyncJSONSubscriber, AsyncJSONZmqClient
+from byodr.utils.ipc import CameraThread, JSONPublisher, json_collector
+from byodr.utils.metrics import CommandLatency, ipc_stats
 from byodr.utils.navigate import FileSystemRouteDataSource, ReloadableDataSource
+from byodr.utils.profiling import ProfileSession
+from byodr.utils.sync import Synchronizer
+from byodr.utils.trace import chrome_trace, get_tracer
 from logbox.app import LogApplication, PackageApplication
 from logbox.core import MongoLogBox, SharedUser, SharedState
 from logbox.web import DataTableRequestHandler, JPEGImageRequestHandler
@@ -269,15 +274,25 @@ def main():
         hwm=20,
     )
 
+    # The confirmations of the operator commands come back with the pilot output.
+    command_latency = CommandLatency()
+
+    def on_pilot_output(message):
+        _actuation = message.get("actuation")
+        if _actuation is not None:
+            command_latency.on_confirmation(
+                _actuation.get("cid"), _actuation.get("hops")
+            )
+
+    pilot.add_listener(on_pilot_output)
+
     logbox_user = SharedUser()
+    logbox_synchronizer = Synchronizer(topics=("pilot", "vehicle", "inference"))
+    pilot.add_listener(logbox_synchronizer.listener("pilot"))
+    vehicle.add_listener(logbox_synchronizer.listener("vehicle"))
+    inference.add_listener(logbox_synchronizer.listener("inference"))
     logbox_state = SharedState(
-        channels=(
-            camera_front,
-            (lambda: pilot.get()),
-            (lambda: vehicle.get()),
-            (lambda: inference.get()),
-        ),
-        hz=16,
+        camera=camera_front, synchronizer=logbox_synchronizer, hz=16
     )
     log_application = LogApplication(
         _mongo, logbox_user, logbox_state, event=quit_event, config_dir=args.config
@@ -286,6 +301,8 @@ def main():
         _mongo, logbox_user, event=quit_event, hz=0.100, sessions_dir=args.sessions
     )
 
+    # The deterministic profile of teleop covers the logbox thread.
+    log_application.profiler = ProfileSession("teleop", directory=args.config)
     logbox_thread = threading.Thread(target=log_application.run)
     package_thread = threading.Thread(target=package_application.run)
 
@@ -310,25 +327,40 @@ def main():
     chatter = JSONPublisher(
         url="ipc:///byodr/teleop_c.sock", topic="aav/teleop/chatter"
     )
-    zm_client = JSONZmqClient(
-        urls=[
-            "ipc:///byodr/pilot_c.sock",
-            "ipc:///byodr/inference_c.sock",
-            "ipc:///byodr/vehicle_c.sock",
-            "ipc:///byodr/relay_c.sock",
-            "ipc:///byodr/camera_c.sock",
-        ]
-    )
 
     def on_options_save():
         chatter.publish(dict(time=timestamp(), command="restart"))
         application.setup()
 
-    def list_process_start_messages():
-        return zm_client.call(dict(request="system/startup/list"))
+    async def list_process_start_messages():
+        return await zm_client.call(dict(request="system/startup/list"))
+
+    async def list_service_capabilities():
+        return await zm_client.call(dict(request="system/service/capabilities"))
+
+    async def list_ipc_stats():
+        stats = await zm_client.call(dict(request="system/ipc/stats"))
+        stats["teleop"] = ipc_stats()
+        return stats
+
+    async def call_profiler(action, message):
+        replies = await profile_client.call(
+            dict(message, request="system/profile/{}".format(action))
+        )
+        _session = log_application.profiler
+        if action == "start":
+            replies["teleop"] = _session.start(mode=message["mode"], hz=message["hz"])
+        else:
+            # Stopping waits on the profiled thread.
+            replies["teleop"] = await asyncio.get_event_loop().run_in_executor(
+                thread_pool, _session.stop
+            )
+        return replies
 
-    def list_service_capabilities():
-        return zm_client.call(dict(request="system/service/capabilities"))
+    async def list_trace_spans():
+        spans = await zm_client.call(dict(request="system/trace/spans"))
+        spans["teleop"] = get_tracer().recent()
+        return chrome_trace(spans)
 
     def get_navigation_image(image_id):
         return route_store.get_image(image_id)
@@ -341,6 +373,36 @@ def main():
     asyncio.set_event_loop_policy(AnyThreadEventLoopPolicy())
     asyncio.set_event_loop(asyncio.new_event_loop())
 
+    # The websocket state is read on the event loop of the server itself.
+    # These are second subscriptions next to the collectors, with their own statistics.
+    pilot_state = AsyncJSONSubscriber(
+        url="ipc:///byodr/pilot.sock", topic=b"aav/pilot/output", consumer="websocket"
+    )
+    vehicle_state = AsyncJSONSubscriber(
+        url="ipc:///byodr/vehicle.sock",
+        topic=b"aav/vehicle/state",
+        consumer="websocket",
+    )
+    inference_state = AsyncJSONSubscriber(
+        url="ipc:///byodr/inference.sock",
+        topic=b"aav/inference/state",
+        consumer="websocket",
+    )
+    subscribers = [pilot_state, vehicle_state, inference_state]
+    [s.start() for s in subscribers]
+
+    # The asyncio sockets are to be created on the event loop of the server.
+    service_urls = [
+        "ipc:///byodr/pilot_c.sock",
+        "ipc:///byodr/inference_c.sock",
+        "ipc:///byodr/vehicle_c.sock",
+        "ipc:///byodr/relay_c.sock",
+        "ipc:///byodr/camera_c.sock",
+    ]
+    zm_client = AsyncJSONZmqClient(urls=service_urls)
+    # Stopping a profile includes writing the stats to disk.
+    profile_client = AsyncJSONZmqClient(urls=service_urls, receive_timeout_ms=5000)
+
     io_loop = ioloop.IOLoop.instance()
     _conditional_exit = ApplicationExit(quit_event, lambda: io_loop.stop())
     _periodic = ioloop.PeriodicCallback(lambda: _conditional_exit(), 5e3)
@@ -385,8 +447,13 @@ def main():
                     MessageServerSocket,
                     dict(
                         fn_state=(
-                            lambda: (pilot.peek(), vehicle.peek(), inference.peek())
-                        )
+                            lambda: (
+                                pilot_state.peek(),
+                                vehicle_state.peek(),
+                                inference_state.peek(),
+                            )
+                        ),
+                        fn_wait=(lambda seq: pilot_state.wait(after=seq, timeout=0.1)),
                     ),
                 ),
                 (
@@ -425,6 +492,27 @@ def main():
                     JSONMethodDumpRequestHandler,
                     dict(fn_method=list_service_capabilities),
                 ),
+                (
+                    r"/teleop/system/ipc",
+                    JSONMethodDumpRequestHandler,
+                    dict(fn_method=list_ipc_stats),
+                ),
+                (
+                    r"/teleop/system/latency",
+                    JSONMethodDumpRequestHandler,
+                    dict(fn_method=command_latency.to_dict),
+                ),
+                (
+                    # Open the download in chrome://tracing or perfetto.
+                    r"/teleop/system/trace",
+                    JSONMethodDumpRequestHandler,
+                    dict(fn_method=list_trace_spans),
+                ),
+                (
+                    r"/teleop/system/profile/(start|stop)",
+                    ProfileRequestHandler,
+                    dict(fn_profile=call_profiler),
+                ),
                 (
                     r"/teleop/navigation/routes",
                     JSONNavigationHandler,
@@ -451,6 +539,9 @@ def main():
         _periodic.stop()
 
     route_store.quit()
+    zm_client.quit()
+    profile_client.quit()
+    [s.quit() for s in subscribers]
 
     logger.info("Waiting on threads to stop.")
     [t.join() for t in threads]
@@ -3,6 +3,8 @@
 from __future__ import absolute_import
 
 import collections
+import inspect
+import itertools
 import json
 import logging
 import os
@@ -18,7 +20,7 @@ from six.moves.configparser import SafeConfigParser
 from tornado import web, websocket
 from tornado.gen import coroutine
 
-from byodr.utils import timestamp
+from byodr.utils import timestamp, monotonic_timestamp
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +69,7 @@ class MobileControllerCommands(tornado.websocket.WebSocketHandler):
             if self._is_operator():
                 _response = json.dumps(dict(control="operator"))
                 msg["time"] = timestamp()  # add timestamp to the sent command
+                msg["mono"] = monotonic_timestamp()
                 self._fn_control(msg)
             else:  # This block might not be needed if every user is always an operator
                 if msg.get("_operator") == "force":
@@ -88,6 +91,10 @@ class MobileControllerCommands(tornado.websocket.WebSocketHandler):
             logger.error("Error in on_message: {}".format(str(e)))
 
 
+# The correlation ids of the operator commands, which follow a command up to the actuation of the motors.
+_command_ids = itertools.count(timestamp())
+
+
 class ControlServerSocket(websocket.WebSocketHandler):
     # There can be only one operator in control at any time.
     # Do not use a single variable since class attributes mutate to be instance attributes.
@@ -131,6 +138,9 @@ class ControlServerSocket(websocket.WebSocketHandler):
         if self._is_operator():
             _response = json.dumps(dict(control="operator"))
             msg["time"] = timestamp()
+            msg["mono"] = monotonic_timestamp()
+            msg["cid"] = next(_command_ids)
+            msg["hops"] = [["teleop", msg["time"]]]
             self._fn_control(msg)
         elif msg.get("_operator") == "force":
             self.operators.clear()
@@ -150,6 +160,9 @@ class MessageServerSocket(websocket.WebSocketHandler):
     # noinspection PyAttributeOutsideInit
     def initialize(self, **kwargs):
         self._fn_state = kwargs.get("fn_state")
+        # Optional coroutine to wait for state newer than the last sent to this client.
+        self._fn_wait = kwargs.get("fn_wait")
+        self._seq = None
 
     def check_origin(self, origin):
         return True
@@ -208,7 +221,9 @@ class MessageServerSocket(websocket.WebSocketHandler):
             np.mean(path[i * _x : (i + 1) * _x]) for i in range(scope)
         ]
 
-    def on_message(self, *args):
+    async def on_message(self, *args):
+        if self._fn_wait is not None:
+            self._seq = await self._fn_wait(self._seq)
         try:
             state = self._fn_state()
             pilot = None if state is None else state[0]
@@ -454,8 +469,29 @@ class JSONMethodDumpRequestHandler(JSONRequestHandler):
     def initialize(self, **kwargs):
         self._method = kwargs.get("fn_method")
 
-    def get(self):
-        self.write(json.dumps(self._method()))
+    async def get(self):
+        result = self._method()
+        if inspect.isawaitable(result):
+            result = await result
+        self.write(json.dumps(result))
+
+
+class ProfileRequestHandler(JSONRequestHandler):
+    """
+    Start or stop a profile of the services e.g. /teleop/system/profile/start?mode=sampling&hz=200 and later
+    /teleop/system/profile/stop which answers with the saved stats files and a summary per service.
+    """
+
+    # noinspection PyAttributeOutsideInit
+    def initialize(self, **kwargs):
+        self._fn_profile = kwargs.get("fn_profile")
+
+    async def get(self, action):
+        message = dict(
+            mode=self.get_query_argument("mode", "deterministic"),
+            hz=int(self.get_query_argument("hz", "100")),
+        )
+        self.write(json.dumps(await self._fn_profile(action, message)))
 
 
 class NavigationRequestError(Exception):
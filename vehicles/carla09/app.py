@@ -15,6 +15,7 @@ from byodr.utils import Application
 from byodr.utils import Configurable
 from byodr.utils.ipc import JSONPublisher, ImagePublisher, LocalIPCServer, json_collector
 from byodr.utils.option import parse_option
+from byodr.utils.profiling import ProfileSession, register_profiler
 from byodr.utils.websocket import HttpLivePlayerVideoSocket
 from vehicle import CarlaHandler
 from video import NumpyImageVideoSource
@@ -150,13 +151,6 @@ class CarlaApplication(Application):
     def finish(self):
         self._runner.quit()
 
-    # def run(self):
-    #     from byodr.utils import Profiler
-    #     profiler = Profiler()
-    #     with profiler():
-    #         super(CarlaApplication, self).run()
-    #     profiler.dump_stats('/config/carla.stats')
-
     def step(self):
         runner, pilot, teleop, ipc_chatter, ipc_server = self._runner, self.pilot, self.teleop, self.ipc_chatter, self.ipc_server
         c_pilot = self._latest_or_none(pilot, patience=(runner.get_patience_micro()))
@@ -194,6 +188,8 @@ def main():
 
     application.publisher = JSONPublisher(url='ipc:///byodr/vehicle.sock', topic='aav/vehicle/state')
     application.ipc_server = LocalIPCServer(url='ipc:///byodr/vehicle_c.sock', name='platform', event=quit_event)
+    application.profiler = ProfileSession('carla', directory=args.config)
+    register_profiler(application.ipc_server, application.profiler)
     application.pilot = lambda: pilot.get()
     application.teleop = lambda: teleop.get()
     application.ipc_chatter = lambda: ipc_chatter.get()
@@ -10,7 +10,7 @@ import carla
 import numpy as np
 from carla import Transform, Location, Rotation
 
-from byodr.utils import timestamp, Configurable
+from byodr.utils import timestamp, monotonic_timestamp, Configurable
 from byodr.utils.location import GeoTracker
 from byodr.utils.option import parse_option
 
@@ -239,7 +239,8 @@ class CarlaHandler(Configurable):
                     auto_active=ap_active,
                     auto_steering=ap_steering,
                     auto_throttle=ap_throttle,
-                    time=timestamp())
+                    time=timestamp(),
+                    mono=monotonic_timestamp())
 
     def tick(self, _):
         if self._actor is not None and self._actor.is_alive:
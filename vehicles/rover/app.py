@@ -7,11 +7,12 @@ import shutil
 
 from ConfigParser import SafeConfigParser
 
-from byodr.utils import Application, PeriodicCallTrace
-from byodr.utils import timestamp, Configurable
+from byodr.utils import Application
+from byodr.utils import timestamp, monotonic_timestamp, Configurable
 from byodr.utils.ipc import JSONPublisher, ImagePublisher, LocalIPCServer, json_collector, ReceiverThread
 from byodr.utils.location import GeoTracker
 from byodr.utils.option import parse_option, hash_dict
+from byodr.utils.profiling import ProfileSession, register_profiler
 from core import GpsPollerThread, PTZCamera, ConfigurableImageGstSource
 
 logger = logging.getLogger(__name__)
@@ -109,7 +110,8 @@ class Platform(Configurable):
                         heading=bearing,
                         velocity=y_vel,
                         trust_velocity=trust_velocity,
-                        time=timestamp())
+                        time=timestamp(),
+                        mono=monotonic_timestamp())
 
     def internal_quit(self, restarting=False):
         self._quit_odometer()
@@ -135,7 +137,6 @@ class RoverHandler(Configurable):
         self._platform = Platform()
         self._process_frequency = 10
         self._patience_micro = 100.
-        self._gst_calltrace = PeriodicCallTrace(seconds=10.0)
         self._gst_sources = []
         self._ptz_cameras = []
 
@@ -161,8 +162,10 @@ class RoverHandler(Configurable):
         self._platform.restart(**kwargs)
         errors.extend(self._platform.get_errors())
         if not self._gst_sources:
-            front_camera = ImagePublisher(url='ipc:///byodr/camera_0.sock', topic='aav/camera/0')
-            rear_camera = ImagePublisher(url='ipc:///byodr/camera_1.sock', topic='aav/camera/1')
+            # The frames can be handed to the consumers through shared memory instead of being copied over the socket.
+            _shared = parse_option('camera.ipc.shared.memory', int, 0, errors, **kwargs) == 1
+            front_camera = ImagePublisher(url='ipc:///byodr/camera_0.sock', topic='aav/camera/0', shared_memory=_shared)
+            rear_camera = ImagePublisher(url='ipc:///byodr/camera_1.sock', topic='aav/camera/1', shared_memory=_shared)
             self._gst_sources.append(ConfigurableImageGstSource('front', image_publisher=front_camera))
             self._gst_sources.append(ConfigurableImageGstSource('rear', image_publisher=rear_camera))
         if not self._ptz_cameras:
@@ -181,8 +184,8 @@ class RoverHandler(Configurable):
             'rear': {'ptz': rear.get_ptz()}
         }
 
-    def _check_gst_sources(self):
-        self._gst_calltrace(lambda: list(map(lambda x: x.check(), self._gst_sources)))
+    def check_gst_sources(self):
+        list(map(lambda x: x.check(), self._gst_sources))
 
     def _cycle_ptz_cameras(self, c_pilot, c_teleop):
         # The front camera ptz function is enabled for teleop direct driving only.
@@ -210,13 +213,12 @@ class RoverHandler(Configurable):
 
     def step(self, c_pilot, c_teleop):
         self._cycle_ptz_cameras(c_pilot, c_teleop)
-        self._check_gst_sources()
         return self._platform.state()
 
 
 class RoverApplication(Application):
-    def __init__(self, handler=None, config_dir=os.getcwd()):
-        super(RoverApplication, self).__init__()
+    def __init__(self, handler=None, config_dir=os.getcwd(), clock=None):
+        super(RoverApplication, self).__init__(clock=clock)
         self._config_dir = config_dir
         self._handler = RoverHandler() if handler is None else handler
         self._config_hash = -1
@@ -225,6 +227,9 @@ class RoverApplication(Application):
         self.pilot = None
         self.teleop = None
         self.ipc_chatter = None
+        # The restart requests and the camera health checks do not need to run at the rate of the platform state.
+        self.add_task(self.check_chatter, hz=5, name='chatter')
+        self.add_task(lambda: self._handler.check_gst_sources(), hz=0.1, priority=-1, name='gst_sources')
 
     def _check_user_file(self):
         # One user configuration file is optional and can be used to persist settings.
@@ -261,13 +266,6 @@ class RoverApplication(Application):
     def finish(self):
         self._handler.quit()
 
-    # def run(self):
-    #     from byodr.utils import Profiler
-    #     profiler = Profiler()
-    #     with profiler():
-    #         super(RoverApplication, self).run()
-    #     profiler.dump_stats('/config/rover.stats')
-
 
     # Function that is called continuously
     # Receives commands from pilot and teleop
@@ -277,6 +275,8 @@ class RoverApplication(Application):
         c_teleop = self._latest_or_none(teleop, patience=rover.get_patience_micro())
         _state = rover.step(c_pilot, c_teleop)
         publisher.publish(_state)
+
+    def check_chatter(self):
         chat = self.ipc_chatter()
         if chat and chat.get('command') == 'restart':
             self.setup()
@@ -297,8 +297,11 @@ def main():
     ipc_chatter = json_collector(url='ipc:///byodr/teleop_c.sock', topic=b'aav/teleop/chatter', pop=True, event=quit_event)
 
     # Sockets used to send data to other services
-    application.state_publisher = JSONPublisher(url='ipc:///byodr/vehicle.sock', topic='aav/vehicle/state')
+    application.state_publisher = JSONPublisher(url='ipc:///byodr/vehicle.sock', topic='aav/vehicle/state', binary=True)
     application.ipc_server = LocalIPCServer(url='ipc:///byodr/vehicle_c.sock', name='platform', event=quit_event)
+    application.ipc_server.register_request('system/task/stats', lambda m: application.get_task_stats())
+    application.profiler = ProfileSession('rover', directory=args.config)
+    register_profiler(application.ipc_server, application.profiler)
     
     # Getting data from the received sockets declared above
     application.pilot = lambda: pilot.get()